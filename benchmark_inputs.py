@@ -0,0 +1,337 @@
+"""Throughput benchmark of the image_processing input pipelines.
+
+Writes synthetic TFRecord shards in the parse_example_proto schema, then
+drives inputs() and distorted_inputs() with no model attached over a sweep of
+--num_readers, --num_preprocess_threads, --batch_size and --image_size, in
+both the queue runner and the tf.data pipelines. Every configuration runs in
+a fresh process, so its peak RSS is its own. Runs on a CPU-only host.
+
+Reported per configuration:
+  images_per_sec: batches delivered per second times the batch size.
+  cpu_utilization: process CPU time over wall time, in cores.
+  peak_rss_mb: peak resident set size of the process.
+and, per image size, the sequential per-image latency of the read, parse,
+decode, augment and batch stages.
+
+Usage:
+  python benchmark_inputs.py --sweep_num_readers=1,4 \\
+      --sweep_num_preprocess_threads=4,8 --benchmark_report=report.json
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import dataset
+import image_processing
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('synthetic_dir', '',
+                           """Directory of the synthetic shards, created """
+                           """in a temporary directory if empty.""")
+tf.app.flags.DEFINE_integer('synthetic_shards', 8,
+                            """Number of synthetic shards per subset.""")
+tf.app.flags.DEFINE_integer('synthetic_examples_per_shard', 128,
+                            """Number of synthetic examples per shard.""")
+tf.app.flags.DEFINE_string('benchmark_pipelines', 'queue,tf_data',
+                           """Comma separated pipelines to benchmark.""")
+tf.app.flags.DEFINE_string('benchmark_subsets', 'train,validation',
+                           """Comma separated subsets to benchmark; train """
+                           """drives distorted_inputs, validation inputs.""")
+tf.app.flags.DEFINE_string('sweep_num_readers', '1,4',
+                           """Comma separated --num_readers values.""")
+tf.app.flags.DEFINE_string('sweep_num_preprocess_threads', '4,8',
+                           """Comma separated --num_preprocess_threads.""")
+tf.app.flags.DEFINE_string('sweep_batch_size', '32',
+                           """Comma separated --batch_size values.""")
+tf.app.flags.DEFINE_string('sweep_image_size', '224',
+                           """Comma separated --image_size values.""")
+tf.app.flags.DEFINE_integer('benchmark_warmup_batches', 10,
+                            """Batches delivered before timing starts.""")
+tf.app.flags.DEFINE_integer('benchmark_batches', 50,
+                            """Batches timed per configuration.""")
+tf.app.flags.DEFINE_integer('benchmark_stage_images', 200,
+                            """Images timed per stage latency.""")
+tf.app.flags.DEFINE_string('benchmark_report', '',
+                           """Optional path of the JSON report.""")
+tf.app.flags.DEFINE_string('benchmark_run', '',
+                           """Internal: JSON configuration to run in this """
+                           """process.""")
+
+STAGES = ['read', 'parse', 'decode', 'augment', 'batch']
+
+
+class SyntheticData(dataset.Dataset):
+  """Synthetic data set in the ImageNet TFRecord schema."""
+
+  def __init__(self, subset, num_classes=1000):
+    super(SyntheticData, self).__init__('synthetic', subset)
+    self._num_classes = num_classes
+
+  def num_classes(self):
+    return self._num_classes
+
+  def download_message(self):
+    print('Write synthetic shards with benchmark_inputs.write_synthetic_shards')
+
+
+def _example(image_buffer, label, height, width, bbox):
+  """Returns an Example proto in the parse_example_proto schema."""
+  def _floats(values):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+  def _int64(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+  def _bytes(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+  ymin, xmin, ymax, xmax = bbox
+  return tf.train.Example(features=tf.train.Features(feature={
+      'image/height': _int64(height),
+      'image/width': _int64(width),
+      'image/colorspace': _bytes(b'RGB'),
+      'image/channels': _int64(3),
+      'image/class/label': _int64(label),
+      'image/class/synset': _bytes(b'n%08d' % label),
+      'image/class/text': _bytes(b'synthetic %d' % label),
+      'image/object/bbox/xmin': _floats([xmin]),
+      'image/object/bbox/xmax': _floats([xmax]),
+      'image/object/bbox/ymin': _floats([ymin]),
+      'image/object/bbox/ymax': _floats([ymax]),
+      'image/object/bbox/label': _int64(label),
+      'image/format': _bytes(b'JPEG'),
+      'image/filename': _bytes(b'synthetic_%d.JPEG' % label),
+      'image/encoded': _bytes(image_buffer),
+  }))
+
+
+def write_synthetic_shards(output_dir, subset, num_shards, examples_per_shard,
+                           num_classes=1000, seed=0):
+  """Writes shards of random JPEGs named like the ImageNet shards.
+
+  Images are smooth random fields of ImageNet-like sizes, so JPEG sizes and
+  decode costs are in the range of real photographs.
+
+  Args:
+    output_dir: string directory to write <subset>-NNNNN-of-NNNNN into.
+    subset: string, 'train' or 'validation'.
+    num_shards: integer number of shards.
+    examples_per_shard: integer number of examples per shard.
+    num_classes: integer, labels are drawn from [1, num_classes].
+    seed: integer seed of the images, labels and boxes.
+
+  Returns:
+    list of the written shard paths.
+  """
+  rng = np.random.RandomState(seed)
+  tf.gfile.MakeDirs(output_dir)
+  paths = []
+  with tf.Graph().as_default():
+    pixels = tf.placeholder(tf.uint8, [None, None, 3])
+    encoded = tf.image.encode_jpeg(pixels, quality=90)
+    with tf.Session() as sess:
+      for shard in range(num_shards):
+        path = os.path.join(output_dir, '%s-%05d-of-%05d' %
+                            (subset, shard, num_shards))
+        with tf.python_io.TFRecordWriter(path) as writer:
+          for _ in range(examples_per_shard):
+            height, width = rng.randint(300, 500, size=2)
+            # Upsample coarse noise so the JPEG has natural image structure.
+            coarse = rng.randint(0, 256, size=(height // 16 + 1,
+                                               width // 16 + 1, 3))
+            image = np.kron(coarse, np.ones((16, 16, 1)))[:height, :width]
+            image = np.clip(image + rng.normal(0, 8, image.shape), 0, 255)
+            image_buffer = sess.run(encoded,
+                                    {pixels: image.astype(np.uint8)})
+            ymin, xmin = rng.uniform(0, 0.5, size=2)
+            ymax, xmax = rng.uniform(0.5, 1, size=2)
+            label = int(rng.randint(1, num_classes + 1))
+            writer.write(_example(image_buffer, label, int(height),
+                                  int(width),
+                                  (ymin, xmin, ymax, xmax)).SerializeToString())
+        paths.append(path)
+  return paths
+
+
+def _stage_dataset(data_files, stage, batch_size):
+  """Returns a sequential tf.data pipeline truncated after stage."""
+  records = tf.data.TFRecordDataset(data_files).repeat()
+  if stage == 'read':
+    return records
+  parsed = records.map(image_processing.parse_example_proto)
+  if stage == 'parse':
+    return parsed.map(lambda image_buffer, label, bbox, text: label)
+  if stage == 'decode':
+    return parsed.map(lambda image_buffer, label, bbox, text:
+                      image_processing.decode_jpeg(image_buffer))
+  images = parsed.map(
+      lambda image_buffer, label, bbox, text:
+      image_processing.image_preprocessing(image_buffer, bbox, train=True,
+                                           add_summaries=False))
+  if stage == 'augment':
+    return images
+  return images.batch(batch_size)
+
+
+def measure_stage_latencies(data_files, batch_size, num_images):
+  """Returns the sequential per-image latency in ms of every stage.
+
+  Each stage is timed as a single-threaded pipeline ending at that stage;
+  the latency of a stage is the difference to the pipeline ending at the
+  stage before it, so the per-run overhead cancels out.
+  """
+  cumulative = []
+  for stage in STAGES:
+    with tf.Graph().as_default():
+      per_run = batch_size if stage == 'batch' else 1
+      next_element = _stage_dataset(
+          data_files, stage, batch_size).make_one_shot_iterator().get_next()
+      with tf.Session() as sess:
+        sess.run(next_element)
+        num_runs = max(num_images // per_run, 1)
+        start_time = time.time()
+        for _ in range(num_runs):
+          sess.run(next_element)
+        cumulative.append(1000. * (time.time() - start_time) /
+                          (num_runs * per_run))
+  return {stage: max(latency - previous, 0.)
+          for stage, latency, previous in zip(STAGES, cumulative,
+                                              [0.] + cumulative[:-1])}
+
+
+def measure_throughput(subset, batch_size, num_warmup, num_batches):
+  """Returns the images/sec and CPU use of inputs or distorted_inputs."""
+  with tf.Graph().as_default():
+    data = SyntheticData(subset)
+    if subset == 'train':
+      images, labels = image_processing.distorted_inputs(data, batch_size)
+    else:
+      images, labels = image_processing.inputs(data, batch_size)
+    # Fetch a reduction so the batch is produced but not copied to Python.
+    fetch = [tf.reduce_sum(images), labels]
+    with tf.Session() as sess:
+      coord = tf.train.Coordinator()
+      threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+      for _ in range(num_warmup):
+        sess.run(fetch)
+      start_times = os.times()
+      start_time = time.time()
+      for _ in range(num_batches):
+        sess.run(fetch)
+      elapsed = time.time() - start_time
+      end_times = os.times()
+      coord.request_stop()
+      coord.join(threads, stop_grace_period_secs=5)
+  cpu_seconds = ((end_times[0] - start_times[0]) +
+                 (end_times[1] - start_times[1]))
+  return {'images_per_sec': num_batches * batch_size / elapsed,
+          'cpu_utilization': cpu_seconds / elapsed}
+
+
+def _peak_rss_mb():
+  # ru_maxrss is in kilobytes on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _run_configuration(config):
+  """Runs one benchmark configuration in this process and returns results."""
+  FLAGS.data_dir = config['data_dir']
+  FLAGS.image_size = config['image_size']
+  if config['kind'] == 'stages':
+    data_files = SyntheticData('train').data_files()
+    result = measure_stage_latencies(data_files, config['batch_size'],
+                                     FLAGS.benchmark_stage_images)
+    return {'stage_latency_ms': result}
+  FLAGS.use_tf_data = config['pipeline'] == 'tf_data'
+  FLAGS.num_readers = config['num_readers']
+  FLAGS.num_preprocess_threads = config['num_preprocess_threads']
+  result = measure_throughput(config['subset'], config['batch_size'],
+                              FLAGS.benchmark_warmup_batches,
+                              FLAGS.benchmark_batches)
+  result['peak_rss_mb'] = _peak_rss_mb()
+  return result
+
+
+def _run_in_subprocess(config):
+  """Runs a configuration in a fresh Python process and returns its result."""
+  args = [sys.executable, os.path.abspath(__file__),
+          '--benchmark_run=%s' % json.dumps(config)]
+  for name in ['benchmark_warmup_batches', 'benchmark_batches',
+               'benchmark_stage_images']:
+    args.append('--%s=%d' % (name, getattr(FLAGS, name)))
+  output = subprocess.check_output(args)
+  return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def _int_list(flag_value):
+  return [int(v) for v in flag_value.split(',') if v]
+
+
+def run_benchmarks():
+  """Runs the configured sweep and returns the list of results."""
+  synthetic_dir = FLAGS.synthetic_dir or tempfile.mkdtemp(prefix='synthetic')
+  for subset in ['train', 'validation']:
+    if not tf.gfile.Glob(os.path.join(synthetic_dir, '%s-*' % subset)):
+      write_synthetic_shards(synthetic_dir, subset, FLAGS.synthetic_shards,
+                             FLAGS.synthetic_examples_per_shard,
+                             seed=len(subset))
+
+  results = []
+  for image_size in _int_list(FLAGS.sweep_image_size):
+    config = {'kind': 'stages', 'data_dir': synthetic_dir,
+              'image_size': image_size,
+              'batch_size': _int_list(FLAGS.sweep_batch_size)[0]}
+    config.update(_run_in_subprocess(config))
+    results.append(config)
+    print(json.dumps(config))
+
+  sweep = itertools.product(
+      FLAGS.benchmark_pipelines.split(','),
+      FLAGS.benchmark_subsets.split(','),
+      _int_list(FLAGS.sweep_num_readers),
+      _int_list(FLAGS.sweep_num_preprocess_threads),
+      _int_list(FLAGS.sweep_batch_size),
+      _int_list(FLAGS.sweep_image_size))
+  for (pipeline, subset, num_readers, num_preprocess_threads, batch_size,
+       image_size) in sweep:
+    config = {'kind': 'throughput', 'data_dir': synthetic_dir,
+              'pipeline': pipeline, 'subset': subset,
+              'num_readers': num_readers,
+              'num_preprocess_threads': num_preprocess_threads,
+              'batch_size': batch_size, 'image_size': image_size}
+    config.update(_run_in_subprocess(config))
+    results.append(config)
+    print('%-8s %-10s readers=%d threads=%d batch=%d size=%d: '
+          '%.1f images/sec, %.2f cores, %.0f MB peak RSS' % (
+              pipeline, subset, num_readers, num_preprocess_threads,
+              batch_size, image_size, config['images_per_sec'],
+              config['cpu_utilization'], config['peak_rss_mb']))
+  return results
+
+
+def main(unused_argv=None):
+  if FLAGS.benchmark_run:
+    # The result must be the last line of output, see _run_in_subprocess.
+    print(json.dumps(_run_configuration(json.loads(FLAGS.benchmark_run))))
+    return
+  results = run_benchmarks()
+  if FLAGS.benchmark_report:
+    with tf.gfile.GFile(FLAGS.benchmark_report, 'w') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,118 @@
+"""Writes the pre-processed evaluation images of a dataset subset to disk.
+
+Evaluation preprocessing (central crop and bilinear resize) is deterministic,
+so it is done once here instead of on every validation pass. The cache holds
+one fixed length record per example, see image_processing.py for the layout,
+and is picked up by image_processing.inputs() when --eval_cache_dir is set.
+
+Usage:
+  python build_eval_cache.py --data_dir=/tf/workspace/imagenet \\
+      --eval_cache_dir=/tf/workspace/imagenet/cache --subset=validation
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import image_processing
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('subset', 'validation',
+                           """Dataset subset to cache.""")
+
+
+def build_eval_cache(dataset, cache_path=None, image_size=None):
+  """Preprocesses every example of a dataset subset into an evaluation cache.
+
+  Args:
+    dataset: instance of Dataset class specifying the dataset.
+    cache_path: string, None defaults to image_processing.eval_cache_path().
+    image_size: integer, None defaults to FLAGS.image_size.
+
+  Returns:
+    integer number of cached examples.
+
+  Raises:
+    ValueError: if no cache path is given or configured.
+  """
+  if image_size is None:
+    image_size = FLAGS.image_size
+  if cache_path is None:
+    cache_path = image_processing.eval_cache_path(dataset, image_size)
+  if not cache_path:
+    raise ValueError('Please set --eval_cache_dir or pass a cache_path')
+
+  record_dtype = image_processing.eval_cache_record_dtype(image_size)
+
+  with tf.Graph().as_default():
+    def _preprocess(example_serialized):
+      image_buffer, label, bbox, _ = image_processing.parse_example_proto(
+          example_serialized)
+      image = image_processing.image_preprocessing(image_buffer, bbox,
+                                                   train=False,
+                                                   image_size=image_size)
+      # Map [-1, 1] back onto uint8; cached_eval_dataset inverts this.
+      image = tf.round((image + 1.) * 127.5)
+      image = tf.cast(tf.clip_by_value(image, 0., 255.), tf.uint8)
+      return image, tf.reshape(label, [])
+
+    records = tf.data.TFRecordDataset(sorted(dataset.data_files()))
+    examples = records.map(
+        _preprocess, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    examples = examples.batch(256).prefetch(1)
+    next_batch = examples.make_one_shot_iterator().get_next()
+
+    tmp_path = cache_path + '.tmp'
+    num_examples = 0
+    start_time = time.time()
+    # The cache is memory-mapped by load_eval_cache, so it must be local.
+    with tf.Session() as sess, open(tmp_path, 'wb') as f:
+      f.write(b'\0' * image_processing.EVAL_CACHE_HEADER_BYTES)
+      while True:
+        try:
+          images, labels = sess.run(next_batch)
+        except tf.errors.OutOfRangeError:
+          break
+        records = np.empty(len(labels), dtype=record_dtype)
+        records['label'] = labels
+        records['image'] = images
+        f.write(records.tobytes())
+        num_examples += len(labels)
+        print('%d examples cached (%.1f examples/sec)' %
+              (num_examples, num_examples / (time.time() - start_time)))
+
+    header = json.dumps({
+        'magic': image_processing.EVAL_CACHE_MAGIC,
+        'version': image_processing.EVAL_CACHE_VERSION,
+        'name': dataset.name,
+        'subset': dataset.subset,
+        'image_size': image_size,
+        'fused_decode_crop': FLAGS.fused_decode_crop,
+        'num_examples': num_examples,
+        'record_bytes': record_dtype.itemsize,
+    }).encode('utf-8')
+    assert len(header) < image_processing.EVAL_CACHE_HEADER_BYTES
+    with open(tmp_path, 'r+b') as f:
+      f.write(header)
+    os.rename(tmp_path, cache_path)
+
+  return num_examples
+
+
+def main(unused_argv=None):
+  from imagenet_data import ImagenetData
+  dataset = ImagenetData(subset=FLAGS.subset)
+  num_examples = build_eval_cache(dataset)
+  print('Wrote %d examples to %s' %
+        (num_examples, image_processing.eval_cache_path(dataset)))
+
+
+if __name__ == '__main__':
+  tf.app.run()
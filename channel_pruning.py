@@ -0,0 +1,233 @@
+"""Channel-wise pruning of the pointwise convolutions of MobileNet V1.
+
+prune_low_magnitude masks individual weights, so training runs the dense
+network for all epochs and channels only become removable when the weight
+masks happen to cover them. ChannelPruningCallback instead masks whole output
+channels of the conv_pw_<i> layers: every pruning step of a PolynomialDecay
+schedule it ranks the output channels of each layer by their L1 or L2 norm
+and zeroes the weakest ones, together with their gamma and beta in the
+conv_pw_<i>_bn and conv_dw_<i+1>_bn layers, so a masked channel is exactly
+zero up to conv_pw_<i+1> and removing it at a shrink changes no output.
+
+At the shrink epochs passed to fit_channel_pruned the masked channels are
+removed with channel_surgery, and the remaining epochs train the smaller
+network. The model is recompiled after every shrink, so the optimizer slots
+(e.g. Adam moments) restart from zero.
+
+Usage:
+  pruning = ChannelPruningCallback(schedule)
+  model = fit_channel_pruned(model, compile_fn, pruning, epochs=20,
+                             shrink_epochs=[5, 10, 15], generator=train_gen,
+                             steps_per_epoch=steps)
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+
+import numpy as np
+import tensorflow as tf
+
+import channel_surgery
+import mobilenet_v1
+import tracing
+
+K = tf.keras.backend
+
+
+def schedule_sparsity(schedule, step):
+  """Evaluates a PolynomialDecay pruning schedule in Python.
+
+  Args:
+    schedule: tensorflow_model_optimization PolynomialDecay, or any schedule
+      whose get_config() has the same parameters.
+    step: integer training step.
+
+  Returns:
+    (should_prune, sparsity) of the schedule at step.
+  """
+  config = schedule.get_config()['config']
+  begin_step = config['begin_step']
+  end_step = config['end_step']
+  progress = min(max(step - begin_step, 0) /
+                 float(max(end_step - begin_step, 1)), 1.)
+  sparsity = (config['final_sparsity'] +
+              (config['initial_sparsity'] - config['final_sparsity']) *
+              (1. - progress) ** config.get('power', 3))
+  should_prune = (step >= begin_step and
+                  (end_step == -1 or step <= end_step) and
+                  (step - begin_step) % config['frequency'] == 0)
+  return should_prune, sparsity
+
+
+def channel_norms(kernel, norm='l1'):
+  """Returns the L1 or L2 norm of every output channel (last axis)."""
+  channels = np.abs(kernel.reshape(-1, kernel.shape[-1]))
+  if norm == 'l1':
+    return channels.sum(axis=0)
+  if norm == 'l2':
+    return np.sqrt(np.square(channels).sum(axis=0))
+  raise ValueError('Unknown channel norm %s' % norm)
+
+
+def channel_mask(kernel, num_pruned, norm='l1'):
+  """Returns the float 0/1 mask keeping all but the weakest channels.
+
+  Args:
+    kernel: NumPy array whose last axis is the output channel.
+    num_pruned: integer number of channels to mask; at least one channel is
+      always kept.
+    norm: 'l1' or 'l2', the norm channels are ranked by.
+
+  Returns:
+    float32 array with one entry per output channel.
+  """
+  channels = kernel.shape[-1]
+  num_pruned = min(max(num_pruned, 0), channels - 1)
+  # Channels masked before have norm zero and sort first, so masks only grow.
+  weakest = np.argsort(channel_norms(kernel, norm), kind='mergesort')
+  mask = np.ones(channels, dtype=np.float32)
+  mask[weakest[:num_pruned]] = 0.
+  return mask
+
+
+class ChannelPruningCallback(tf.keras.callbacks.Callback):
+  """Keras callback masking whole output channels on a pruning schedule.
+
+  Sparsities are fractions of the original number of channels of a layer,
+  so they carry over when the layer is shrunk by shrink().
+  """
+
+  def __init__(self, schedule, norm='l1', layer_regex=r'conv_pw_\d+$',
+               layer_sparsity=None):
+    """Initialize the callback.
+
+    Args:
+      schedule: PolynomialDecay pruning schedule, evaluated per batch with
+        schedule_sparsity().
+      norm: 'l1' or 'l2', the norm output channels are ranked by.
+      layer_regex: regex of the names of the layers to prune.
+      layer_sparsity: optional dict of layer name to its final sparsity.
+        Such layers follow the schedule scaled to reach that sparsity
+        instead of the schedule's final_sparsity.
+    """
+    super(ChannelPruningCallback, self).__init__()
+    self._schedule = schedule
+    self._norm = norm
+    self._layer_regex = layer_regex
+    self._layer_sparsity = layer_sparsity or {}
+    self._step = 0
+    self._num_channels = {}
+    self._layers = []
+    self._masks = {}
+    self._mask_values = {}
+    self._apply_op = None
+
+  def set_model(self, model):
+    """Creates the mask variables and masking ops of a (new) model."""
+    super(ChannelPruningCallback, self).set_model(model)
+    self._layers = [layer for layer in model.layers
+                    if re.match(self._layer_regex, layer.name)]
+    self._masks = {}
+    assignments = []
+    for layer in self._layers:
+      channels = int(layer.kernel.shape[-1])
+      self._num_channels.setdefault(layer.name, channels)
+      # Keep the masks of a model that is fitted again without shrinking.
+      value = self._mask_values.get(layer.name)
+      if value is None or len(value) != channels:
+        value = np.ones(channels, dtype=np.float32)
+      mask = K.variable(value, name='%s_channel_mask' % layer.name)
+      self._masks[layer.name] = mask
+      assignments.append(tf.assign(layer.kernel, layer.kernel * mask))
+      for bn_name in mobilenet_v1.channel_batch_norms(layer.name):
+        try:
+          bn = model.get_layer(name=bn_name)
+        except ValueError:
+          continue
+        assignments.append(tf.assign(bn.gamma, bn.gamma * mask))
+        assignments.append(tf.assign(bn.beta, bn.beta * mask))
+    self._apply_op = tf.group(*assignments)
+
+  def layer_target(self, layer_name, sparsity):
+    """Returns the sparsity of a layer when the schedule is at sparsity."""
+    if layer_name not in self._layer_sparsity:
+      return sparsity
+    final_sparsity = self._schedule.get_config()['config']['final_sparsity']
+    return sparsity * self._layer_sparsity[layer_name] / max(final_sparsity,
+                                                             1e-8)
+
+  def update_masks(self, sparsity):
+    """Masks the weakest channels of every layer to reach sparsity."""
+    kernels = K.batch_get_value([layer.kernel for layer in self._layers])
+    values = []
+    for layer, kernel in zip(self._layers, kernels):
+      original = self._num_channels[layer.name]
+      # Channels already removed by shrink() count toward the target.
+      num_pruned = (int(round(self.layer_target(layer.name, sparsity) *
+                              original)) - (original - kernel.shape[-1]))
+      mask = channel_mask(kernel, num_pruned, self._norm)
+      self._mask_values[layer.name] = mask
+      values.append((self._masks[layer.name], mask))
+    K.batch_set_value(values)
+
+  def on_batch_begin(self, batch, logs=None):
+    should_prune, sparsity = schedule_sparsity(self._schedule, self._step)
+    if should_prune:
+      self.update_masks(sparsity)
+      K.get_session().run(self._apply_op)
+
+  def on_batch_end(self, batch, logs=None):
+    # Re-mask after the optimizer step, which moves masked weights again.
+    K.get_session().run(self._apply_op)
+    self._step += 1
+
+  def shrink(self):
+    """Removes the masked channels and returns the smaller model.
+
+    The returned model is uncompiled; fit_channel_pruned recompiles it.
+    """
+    K.get_session().run(self._apply_op)
+    weights = channel_surgery.model_weights(self.model)
+    plan = channel_surgery.plan_surgery(weights)
+    tf.logging.info('Shrinking at step %d:\n%s', self._step, plan)
+    return channel_surgery.operate(
+        weights, plan, input_shape=self.model.input_shape[1:],
+        classes=self.model.output_shape[-1])
+
+
+def fit_channel_pruned(model, compile_fn, pruning, epochs, shrink_epochs=(),
+                       callbacks=None, **fit_kwargs):
+  """Trains with channel pruning, shrinking the model at shrink_epochs.
+
+  Training runs as one fit per segment between shrink epochs; the model of
+  every later segment is the shrunk model of the one before it. The model
+  is shrunk once more after the last epoch.
+
+  Args:
+    model: Keras MobileNet (see mobilenet_v1.MobileNetV1) to prune.
+    compile_fn: function compiling a model in place, called before every
+      segment, e.g. with a new optimizer.
+    pruning: ChannelPruningCallback.
+    epochs: integer total number of epochs.
+    shrink_epochs: epochs after which the masked channels are removed.
+    callbacks: optional list of further Keras callbacks; with --trace they
+      and the pruning callback are timed, see tracing.trace_callbacks().
+    **fit_kwargs: arguments of fit_generator if they include a generator,
+      otherwise of fit.
+
+  Returns:
+    the trained model with all masked channels removed.
+  """
+  callbacks = tracing.trace_callbacks(list(callbacks or []) + [pruning])
+  boundaries = sorted(set(e for e in shrink_epochs if 0 < e < epochs))
+  initial_epoch = 0
+  for end_epoch in boundaries + [epochs]:
+    compile_fn(model)
+    fit = model.fit_generator if 'generator' in fit_kwargs else model.fit
+    fit(initial_epoch=initial_epoch, epochs=end_epoch, callbacks=callbacks,
+        **fit_kwargs)
+    model = pruning.shrink()
+    initial_epoch = end_epoch
+  return model
@@ -0,0 +1,317 @@
+"""Planning of channel surgery on the pointwise convolutions of MobileNet V1.
+
+After pruning, whole output channels of the conv_pw_<i> layers are zero.
+Removing output channel c of conv_pw_<i> also removes
+
+  channel c of the conv_pw_<i>_bn parameters,
+  channel c of the following conv_dw_<i+1> depthwise kernel and its
+    conv_dw_<i+1>_bn parameters,
+  input channel c of conv_pw_<i+1> (or of conv_preds after the last block).
+
+plan_surgery finds the dead channels of every conv_pw kernel with one
+vectorized reduction per layer and records the kept channels of every layer
+affected by their removal in a single SurgeryPlan, which apply_plan hands to
+tfkerassurgeon in one pass.
+
+operate is the native alternative to tfkerassurgeon: it slices the kernels
+and batch norm statistics of the plan directly in NumPy and instantiates a
+mobilenet_v1.MobileNetV1 with the kept widths in a single build.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import re
+
+import numpy as np
+import tensorflow as tf
+
+import mobilenet_v1
+
+PW_KERNEL_RE = re.compile(r'(?:^|/)(conv_pw_(\d+))/kernel$')
+
+
+def model_weights(model):
+  """Returns a dict of weight name, e.g. conv_pw_1/kernel, to NumPy value.
+
+  Names are built from the layer names, as the variable scopes of a model
+  built a second time in the same graph are uniquified (conv_pw_1_1/kernel).
+  """
+  names = []
+  weights = []
+  for layer in model.layers:
+    for weight in layer.weights:
+      names.append('%s/%s' % (layer.name, _weight_key(weight.name)
+                              .split('/')[-1]))
+      weights.append(weight)
+  return dict(zip(names, tf.keras.backend.batch_get_value(weights)))
+
+
+def checkpoint_weights(checkpoint):
+  """Returns a dict of variable name to NumPy value of a checkpoint."""
+  reader = tf.train.NewCheckpointReader(checkpoint)
+  return {name: reader.get_tensor(name)
+          for name in reader.get_variable_to_shape_map()}
+
+
+def load_model_weights(model, path):
+  """Loads Keras .h5 weights or a TensorFlow checkpoint into a model by name.
+
+  Args:
+    model: tf.keras.Model.
+    path: string .h5 file, checkpoint prefix or checkpoint directory.
+  """
+  if path.endswith('.h5') or path.endswith('.hdf5'):
+    model.load_weights(path, by_name=True)
+  else:
+    if tf.gfile.IsDirectory(path):
+      path = tf.train.latest_checkpoint(path)
+    set_model_weights(model, checkpoint_weights(path))
+
+
+def dead_channels(kernel, tolerance=0.):
+  """Returns the output channels of a kernel whose weights are all ~zero.
+
+  Args:
+    kernel: NumPy array whose last axis is the output channel.
+    tolerance: float, channels whose largest absolute weight is at most
+      tolerance are dead.
+
+  Returns:
+    int array of the dead output channels.
+  """
+  channel_max = np.abs(kernel.reshape(-1, kernel.shape[-1])).max(axis=0)
+  return np.flatnonzero(channel_max <= tolerance)
+
+
+class SurgeryPlan(object):
+  """The output channels kept in every conv_pw layer, and their effects."""
+
+  def __init__(self, kept_channels, num_channels):
+    """Initialize the plan.
+
+    Args:
+      kept_channels: dict of conv_pw layer name to the sorted int array of
+        its kept output channels.
+      num_channels: dict of conv_pw layer name to its original number of
+        output channels.
+    """
+    self.kept_channels = kept_channels
+    self.num_channels = num_channels
+
+  def blocks(self):
+    """Returns the block numbers of the planned conv_pw layers, in order."""
+    return sorted(int(name.rsplit('_', 1)[1]) for name in self.kept_channels)
+
+  def removed_channels(self, layer_name):
+    """Returns the removed output channels of a conv_pw layer."""
+    return np.setdiff1d(np.arange(self.num_channels[layer_name]),
+                        self.kept_channels[layer_name])
+
+  def widths(self):
+    """Returns a dict of conv_pw layer name to its number of kept channels."""
+    return {name: len(kept) for name, kept in self.kept_channels.items()}
+
+  def layer_slices(self):
+    """Returns the channels kept in every layer affected by the plan.
+
+    Returns:
+      dict of layer name to a dict with optional 'inputs' and 'outputs'
+      entries, the kept input and output channels of the layer.
+    """
+    slices = {}
+    for block in self.blocks():
+      name = 'conv_pw_%d' % block
+      kept = self.kept_channels[name]
+      slices.setdefault(name, {})['outputs'] = kept
+      slices['%s_bn' % name] = {'outputs': kept}
+      # Blocks are numbered from 1; the last one feeds conv_preds, whether
+      # or not the plan covers every block.
+      if block < len(mobilenet_v1.POINTWISE_FILTERS):
+        slices['conv_dw_%d' % (block + 1)] = {'outputs': kept}
+        slices['conv_dw_%d_bn' % (block + 1)] = {'outputs': kept}
+        slices.setdefault('conv_pw_%d' % (block + 1), {})['inputs'] = kept
+      else:
+        slices['conv_preds'] = {'inputs': kept}
+    return slices
+
+  def to_json(self):
+    return json.dumps({
+        'kept_channels': {k: v.tolist()
+                          for k, v in self.kept_channels.items()},
+        'num_channels': self.num_channels})
+
+  @classmethod
+  def from_json(cls, text):
+    plan = json.loads(text)
+    return cls({k: np.array(v, dtype=np.int64)
+                for k, v in plan['kept_channels'].items()},
+               plan['num_channels'])
+
+  def __str__(self):
+    return '\n'.join('%s: %d/%d channels kept' % (
+        'conv_pw_%d' % block, len(self.kept_channels['conv_pw_%d' % block]),
+        self.num_channels['conv_pw_%d' % block]) for block in self.blocks())
+
+
+def plan_surgery(weights, tolerance=0.):
+  """Plans the removal of the dead output channels of all conv_pw layers.
+
+  A channel is dead when all of its weights are within tolerance of zero,
+  regardless of their signs. A layer always keeps at least its strongest
+  channel.
+
+  Args:
+    weights: dict of weight name to NumPy value, e.g. model_weights(model)
+      or the tensors of a checkpoint. Names may carry a scope prefix.
+    tolerance: float, see dead_channels().
+
+  Returns:
+    SurgeryPlan of all conv_pw kernels in weights.
+  """
+  kept_channels = {}
+  num_channels = {}
+  for name, kernel in weights.items():
+    match = PW_KERNEL_RE.search(name)
+    if not match:
+      continue
+    layer_name = match.group(1)
+    channels = kernel.shape[-1]
+    dead = dead_channels(kernel, tolerance)
+    if len(dead) == channels:
+      norms = np.abs(kernel.reshape(-1, channels)).max(axis=0)
+      dead = np.delete(dead, np.argmax(norms))
+    kept_channels[layer_name] = np.setdiff1d(np.arange(channels), dead)
+    num_channels[layer_name] = channels
+  return SurgeryPlan(kept_channels, num_channels)
+
+
+def apply_plan(model, plan):
+  """Deletes the planned channels from a Keras model with tfkerassurgeon.
+
+  All deletions are queued on one Surgeon, which propagates them through
+  the batch norm, depthwise and following layers and rebuilds the model in a
+  single operate() call.
+
+  Args:
+    model: Keras MobileNet model the plan was made for.
+    plan: SurgeryPlan.
+
+  Returns:
+    the smaller Keras model.
+  """
+  import tfkerassurgeon  # Only needed to operate through tfkerassurgeon.
+  surgeon = tfkerassurgeon.Surgeon(model)
+  for block in plan.blocks():
+    name = 'conv_pw_%d' % block
+    removed = plan.removed_channels(name)
+    if len(removed):
+      surgeon.add_job('delete_channels', model.get_layer(name=name),
+                      channels=removed.tolist())
+  return surgeon.operate()
+
+
+def _weight_key(name):
+  """Returns the layer/parameter key of a weight or variable name."""
+  return '/'.join(name.split(':')[0].split('/')[-2:])
+
+
+def slice_weights(weights, plan):
+  """Removes the planned channels from the weights they affect.
+
+  Kernels lose input channels on their second to last axis and output
+  channels on their last axis; depthwise kernels lose channels on axis 2 and
+  batch norm parameters on axis 0.
+
+  Args:
+    weights: dict of weight name to NumPy value.
+    plan: SurgeryPlan made for these weights.
+
+  Returns:
+    dict of the same names to the sliced values.
+  """
+  slices = plan.layer_slices()
+  sliced = {}
+  for name, value in weights.items():
+    layer, _, parameter = _weight_key(name).partition('/')
+    layer_slices = slices.get(layer)
+    if layer_slices:
+      inputs = layer_slices.get('inputs')
+      outputs = layer_slices.get('outputs')
+      if parameter == 'kernel':
+        if inputs is not None:
+          value = np.take(value, inputs, axis=-2)
+        if outputs is not None:
+          value = np.take(value, outputs, axis=-1)
+      elif parameter == 'depthwise_kernel':
+        if outputs is not None:
+          value = np.take(value, outputs, axis=2)
+      elif outputs is not None and value.ndim == 1:
+        # bias, gamma, beta, moving_mean and moving_variance.
+        value = np.take(value, outputs, axis=0)
+    sliced[name] = value
+  return sliced
+
+
+def build_pruned_model(plan, **kwargs):
+  """Instantiates a MobileNetV1 with the kept widths of a plan.
+
+  Args:
+    plan: SurgeryPlan.
+    **kwargs: further arguments of mobilenet_v1.MobileNetV1.
+
+  Returns:
+    tf.keras.Model with uninitialized weights.
+  """
+  return mobilenet_v1.MobileNetV1(
+      mobilenet_v1.pointwise_filters_from_widths(plan.widths()), **kwargs)
+
+
+def set_model_weights(model, weights):
+  """Assigns every weight of a model from a dict of weights, in one run.
+
+  Args:
+    model: tf.keras.Model.
+    weights: dict of weight name to NumPy value; names are matched on their
+      layer/parameter suffix, so scope prefixes and optimizer slots of
+      checkpoints are ignored.
+
+  Raises:
+    ValueError: if a model weight is missing or has another shape.
+  """
+  values = {_weight_key(name): value for name, value in weights.items()}
+  assignments = []
+  for layer in model.layers:
+    for weight in layer.weights:
+      key = '%s/%s' % (layer.name, _weight_key(weight.name).split('/')[-1])
+      if key not in values:
+        raise ValueError('No value for weight %s' % key)
+      value = values[key]
+      if tuple(value.shape) != tuple(weight.shape.as_list()):
+        raise ValueError('Weight %s has shape %s, expected %s' %
+                         (key, value.shape, weight.shape))
+      assignments.append((weight, value))
+  tf.keras.backend.batch_set_value(assignments)
+
+
+def operate(weights, plan, model=None, **kwargs):
+  """Applies a surgery plan natively and returns the smaller model.
+
+  The model built for a plan can be passed back in to load the weights of
+  another checkpoint pruned to the same channels without rebuilding it.
+
+  Args:
+    weights: dict of weight name to NumPy value of the dense model, e.g.
+      model_weights(model) or checkpoint_weights(path).
+    plan: SurgeryPlan, e.g. plan_surgery(weights).
+    model: optional model returned by build_pruned_model(plan) to reuse.
+    **kwargs: further arguments of mobilenet_v1.MobileNetV1.
+
+  Returns:
+    tf.keras.Model with the planned channels removed.
+  """
+  if model is None:
+    model = build_pruned_model(plan, **kwargs)
+  set_model_weights(model, slice_weights(weights, plan))
+  return model
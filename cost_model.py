@@ -0,0 +1,382 @@
+"""Inference cost model of MobileNet V1 variants.
+
+Reports per layer and in total the parameters, multiply-accumulates (MACs),
+activation memory and estimated latency of the convolutions of a Keras model,
+or of the MobileNet V1 a surgery plan or per-layer sparsity plan would
+produce, without building or training it.
+
+Parameters and MACs are counted for inference with batch norm folded into
+the convolutions, which adds one bias per output channel. The latency of a
+layer is the measured median time of its convolution alone on the local CPU.
+Every distinct convolution shape is benchmarked once, and the timings are
+cached in a JSON file per host and thread count, so ranking many plans only
+benchmarks the widths not seen before. Pooling, activations and the
+classifier reshape are not timed; they are small next to the convolutions of
+MobileNet.
+
+Usage:
+  python cost_model.py --cost_plans=plan_a.json,plan_b.json \\
+      --latency_cache=latency_cache.json
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import multiprocessing
+import os
+import platform
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import channel_surgery
+import mobilenet_v1
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('cost_plans', '',
+                           """Comma separated JSON plans to rank: """
+                           """SurgeryPlan.to_json() files or """
+                           """sensitivity_analysis plans. The dense """
+                           """MobileNet is always included.""")
+tf.app.flags.DEFINE_integer('cost_image_size', 224,
+                            """Input image size of the costed models.""")
+tf.app.flags.DEFINE_integer('cost_batch_size', 1,
+                            """Batch size of the latency estimates.""")
+tf.app.flags.DEFINE_integer('cost_threads', 0,
+                            """Intra-op threads of the latency benchmarks, """
+                            """0 for all CPUs.""")
+tf.app.flags.DEFINE_string('latency_cache', 'latency_cache.json',
+                           """JSON file of the cached latency benchmarks.""")
+tf.app.flags.DEFINE_boolean('cost_per_layer', False,
+                            """Print the per-layer costs of every plan.""")
+
+# One convolution of a model. input_shape is the (height, width, channels)
+# the convolution reads, after any explicit zero padding.
+ConvSpec = collections.namedtuple(
+    'ConvSpec', ['name', 'op', 'input_shape', 'filters', 'kernel_size',
+                 'strides', 'padding'])
+
+# Costs of one convolution; latency_ms is None until estimated.
+LayerCost = collections.namedtuple(
+    'LayerCost', ['spec', 'output_shape', 'params', 'macs',
+                  'activation_bytes', 'latency_ms'])
+
+
+def _output_size(size, kernel_size, strides, padding):
+  if padding == 'same':
+    return -(-size // strides)
+  return (size - kernel_size) // strides + 1
+
+
+def mobilenet_specs(pointwise_filters=None, image_size=224, classes=1000):
+  """Returns the ConvSpecs of a MobileNetV1 without building it.
+
+  Args:
+    pointwise_filters: list of the 13 conv_pw_<i> widths, None defaults to
+      mobilenet_v1.POINTWISE_FILTERS.
+    image_size: integer input height and width.
+    classes: integer number of classes.
+
+  Returns:
+    list of ConvSpec in graph order.
+  """
+  if pointwise_filters is None:
+    pointwise_filters = mobilenet_v1.POINTWISE_FILTERS
+  # Stride 2 layers read their input zero padded by one row and column.
+  specs = [ConvSpec('conv1', 'conv', (image_size + 1, image_size + 1, 3), 32,
+                    3, 2, 'valid')]
+  size = _output_size(image_size + 1, 3, 2, 'valid')
+  channels = 32
+  for block_id, (filters, strides) in enumerate(
+      zip(pointwise_filters, mobilenet_v1.BLOCK_STRIDES), 1):
+    if strides == 1:
+      specs.append(ConvSpec('conv_dw_%d' % block_id, 'depthwise',
+                            (size, size, channels), channels, 3, 1, 'same'))
+    else:
+      specs.append(ConvSpec('conv_dw_%d' % block_id, 'depthwise',
+                            (size + 1, size + 1, channels), channels, 3, 2,
+                            'valid'))
+      size = _output_size(size + 1, 3, 2, 'valid')
+    specs.append(ConvSpec('conv_pw_%d' % block_id, 'conv',
+                          (size, size, channels), int(filters), 1, 1, 'same'))
+    channels = int(filters)
+  specs.append(ConvSpec('conv_preds', 'conv', (1, 1, channels), classes, 1,
+                        1, 'same'))
+  return specs
+
+
+def model_specs(model):
+  """Returns the ConvSpecs of the convolutions and dense layers of a model.
+
+  Args:
+    model: built tf.keras.Model with static input shapes.
+
+  Returns:
+    list of ConvSpec in layer order.
+  """
+  specs = []
+  for layer in model.layers:
+    if isinstance(layer, tf.keras.layers.DepthwiseConv2D):
+      op = 'depthwise'
+    elif isinstance(layer, tf.keras.layers.Conv2D):
+      op = 'conv'
+    elif isinstance(layer, tf.keras.layers.Dense):
+      specs.append(ConvSpec(layer.name, 'conv',
+                            (1, 1, int(layer.input_shape[-1])), layer.units,
+                            1, 1, 'valid'))
+      continue
+    else:
+      continue
+    _, height, width, channels = layer.input_shape
+    if op == 'depthwise':
+      filters = channels * layer.depth_multiplier
+    else:
+      filters = layer.filters
+    specs.append(ConvSpec(layer.name, op, (height, width, channels), filters,
+                          layer.kernel_size[0], layer.strides[0],
+                          layer.padding))
+  return specs
+
+
+def layer_cost(spec):
+  """Returns the LayerCost of a ConvSpec with no latency estimate."""
+  height, width, channels = spec.input_shape
+  out_height = _output_size(height, spec.kernel_size, spec.strides,
+                            spec.padding)
+  out_width = _output_size(width, spec.kernel_size, spec.strides,
+                           spec.padding)
+  kernel_area = spec.kernel_size * spec.kernel_size
+  if spec.op == 'depthwise':
+    weights = kernel_area * spec.filters
+  else:
+    weights = kernel_area * channels * spec.filters
+  return LayerCost(spec=spec,
+                   output_shape=(out_height, out_width, spec.filters),
+                   params=weights + spec.filters,
+                   macs=out_height * out_width * weights,
+                   activation_bytes=4 * out_height * out_width * spec.filters,
+                   latency_ms=None)
+
+
+class LatencyTable(object):
+  """Median CPU latency of convolution shapes, benchmarked once and cached.
+
+  Timings are keyed by the host, the thread count, the batch size and the
+  convolution shape, so a cache file can be shared between hosts.
+  """
+
+  def __init__(self, cache_path=None, batch_size=1, num_threads=0,
+               num_runs=20):
+    """Initialize the table.
+
+    Args:
+      cache_path: string JSON file of the cached timings, None to keep them
+        in memory only.
+      batch_size: integer batch size the convolutions are timed at.
+      num_threads: integer intra-op threads, 0 for all CPUs.
+      num_runs: integer number of timed runs per shape.
+    """
+    self._cache_path = cache_path
+    self._batch_size = batch_size
+    self._num_threads = num_threads or multiprocessing.cpu_count()
+    self._num_runs = num_runs
+    self._host = '%s-%s-%dcpu' % (platform.node(), platform.machine(),
+                                  multiprocessing.cpu_count())
+    self._timings = {}
+    if cache_path and tf.gfile.Exists(cache_path):
+      with tf.gfile.GFile(cache_path, 'r') as f:
+        self._timings = json.load(f)
+
+  def _key(self, spec):
+    return '%s/threads%d/batch%d/%s-%dx%dx%d-%d-k%d-s%d-%s' % (
+        (self._host, self._num_threads, self._batch_size, spec.op) +
+        tuple(spec.input_shape) + (spec.filters, spec.kernel_size,
+                                   spec.strides, spec.padding))
+
+  def latency_ms(self, specs):
+    """Returns the latency of every spec, benchmarking unseen shapes.
+
+    Args:
+      specs: list of ConvSpec.
+
+    Returns:
+      list of float milliseconds, one per spec.
+    """
+    missing = collections.OrderedDict()
+    for spec in specs:
+      key = self._key(spec)
+      if key not in self._timings:
+        missing[key] = spec
+    if missing:
+      self._benchmark(missing)
+      self.save()
+    return [self._timings[self._key(spec)] for spec in specs]
+
+  def _benchmark(self, specs):
+    """Times the convolutions of a dict of key to ConvSpec in one session."""
+    config = tf.ConfigProto(intra_op_parallelism_threads=self._num_threads,
+                            inter_op_parallelism_threads=1,
+                            device_count={'GPU': 0})
+    rng = np.random.RandomState(0)
+    with tf.Graph().as_default():
+      ops = {}
+      for key, spec in specs.items():
+        height, width, channels = spec.input_shape
+        inputs = tf.Variable(rng.uniform(
+            -1, 1, (self._batch_size, height, width, channels)).astype(
+                np.float32))
+        strides = [1, spec.strides, spec.strides, 1]
+        padding = spec.padding.upper()
+        if spec.op == 'depthwise':
+          kernel = tf.Variable(rng.normal(size=(
+              spec.kernel_size, spec.kernel_size, channels,
+              spec.filters // channels)).astype(np.float32))
+          output = tf.nn.depthwise_conv2d(inputs, kernel, strides, padding)
+        else:
+          kernel = tf.Variable(rng.normal(size=(
+              spec.kernel_size, spec.kernel_size, channels,
+              spec.filters)).astype(np.float32))
+          output = tf.nn.conv2d(inputs, kernel, strides, padding)
+        bias = tf.Variable(np.zeros(spec.filters, dtype=np.float32))
+        # Folded batch norm and ReLU6, as run at inference.
+        ops[key] = tf.nn.relu6(tf.nn.bias_add(output, bias)).op
+      with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        for key, op in ops.items():
+          # Running the op without fetching its output leaves out the copy.
+          for _ in range(3):
+            sess.run(op)
+          times = []
+          for _ in range(self._num_runs):
+            start_time = time.time()
+            sess.run(op)
+            times.append(1000. * (time.time() - start_time))
+          self._timings[key] = float(np.median(times))
+          tf.logging.info('%s: %.3f ms', key, self._timings[key])
+
+  def save(self):
+    if not self._cache_path:
+      return
+    tmp_path = self._cache_path + '.tmp'
+    with tf.gfile.GFile(tmp_path, 'w') as f:
+      json.dump(self._timings, f, indent=0, sort_keys=True)
+    tf.gfile.Rename(tmp_path, self._cache_path, overwrite=True)
+
+
+def estimate(specs, latency_table=None):
+  """Returns the per-layer and total costs of a list of ConvSpecs.
+
+  Args:
+    specs: list of ConvSpec, e.g. mobilenet_specs() or model_specs(model).
+    latency_table: optional LatencyTable; latencies are None without one.
+
+  Returns:
+    layers: list of LayerCost.
+    total: dict of the total params, macs, activation_bytes, the
+      peak_activation_bytes of any layer's input and output, and latency_ms.
+  """
+  layers = [layer_cost(spec) for spec in specs]
+  if latency_table is not None:
+    layers = [layer._replace(latency_ms=latency) for layer, latency in zip(
+        layers, latency_table.latency_ms(specs))]
+  total = {
+      'params': sum(layer.params for layer in layers),
+      'macs': sum(layer.macs for layer in layers),
+      'activation_bytes': sum(layer.activation_bytes for layer in layers),
+      'peak_activation_bytes': max(
+          4 * int(np.prod(layer.spec.input_shape)) + layer.activation_bytes
+          for layer in layers),
+      'latency_ms': None,
+  }
+  if latency_table is not None:
+    total['latency_ms'] = sum(layer.latency_ms for layer in layers)
+  return layers, total
+
+
+def plan_pointwise_filters(plan):
+  """Returns the conv_pw widths of a surgery or sparsity plan.
+
+  Args:
+    plan: channel_surgery.SurgeryPlan, or a dict with a 'layer_sparsity'
+      dict of layer name to the fraction of its channels removed, as
+      written by sensitivity_analysis.py.
+
+  Returns:
+    list of the 13 conv_pw_<i> widths.
+  """
+  if isinstance(plan, channel_surgery.SurgeryPlan):
+    widths = plan.widths()
+  else:
+    widths = {}
+    for name, filters in zip(mobilenet_v1.pointwise_layer_names(),
+                             mobilenet_v1.POINTWISE_FILTERS):
+      sparsity = plan['layer_sparsity'].get(name, 0.)
+      widths[name] = max(filters - int(round(sparsity * filters)), 1)
+  return mobilenet_v1.pointwise_filters_from_widths(widths)
+
+
+def load_plan(path):
+  """Reads a SurgeryPlan or sensitivity plan JSON file."""
+  with tf.gfile.GFile(path, 'r') as f:
+    text = f.read()
+  if 'kept_channels' in json.loads(text):
+    return channel_surgery.SurgeryPlan.from_json(text)
+  return json.loads(text)
+
+
+def rank_plans(plans, latency_table, image_size=224):
+  """Ranks plans by their estimated latency.
+
+  Args:
+    plans: dict of plan name to SurgeryPlan or sensitivity plan.
+    latency_table: LatencyTable.
+    image_size: integer input image size.
+
+  Returns:
+    list of (name, layers, total) of estimate(), fastest first.
+  """
+  ranked = []
+  for name, plan in plans.items():
+    specs = mobilenet_specs(plan_pointwise_filters(plan), image_size)
+    layers, total = estimate(specs, latency_table)
+    ranked.append((name, layers, total))
+  return sorted(ranked, key=lambda entry: entry[2]['latency_ms'])
+
+
+def print_costs(name, layers, total, dense_total=None, per_layer=False):
+  """Prints the total and optionally the per-layer costs of a model."""
+  line = '%-24s %9.3fM params %9.1fM MACs %7.1f MB peak act %8.2f ms' % (
+      name, total['params'] / 1e6, total['macs'] / 1e6,
+      total['peak_activation_bytes'] / 2.**20, total['latency_ms'] or 0.)
+  if dense_total and dense_total['latency_ms']:
+    line += '  %.2fx' % (dense_total['latency_ms'] / total['latency_ms'])
+  print(line)
+  if per_layer:
+    for layer in layers:
+      shapes = '%s -> %s' % ('x'.join(map(str, layer.spec.input_shape)),
+                             'x'.join(map(str, layer.output_shape)))
+      print('  %-12s %-9s %-28s %9d params %11d MACs %8.3f ms' % (
+          layer.spec.name, layer.spec.op, shapes, layer.params, layer.macs,
+          layer.latency_ms or 0.))
+
+
+def main(unused_argv=None):
+  latency_table = LatencyTable(FLAGS.latency_cache, FLAGS.cost_batch_size,
+                               FLAGS.cost_threads)
+  plans = collections.OrderedDict()
+  plans['dense'] = {'layer_sparsity': {}}
+  for path in FLAGS.cost_plans.split(','):
+    if path:
+      plans[os.path.basename(path)] = load_plan(path)
+  ranked = rank_plans(plans, latency_table, FLAGS.cost_image_size)
+  dense_total = [total for name, _, total in ranked if name == 'dense'][0]
+  for name, layers, total in ranked:
+    print_costs(name, layers, total, dense_total, FLAGS.cost_per_layer)
+
+
+if __name__ == '__main__':
+  tf.app.run()
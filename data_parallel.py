@@ -0,0 +1,454 @@
+"""Data-parallel CPU training of the channel pruning loop on one host.
+
+Launches --data_parallel_workers worker processes, each pinned to its own
+set of cores. Every worker reads its own disjoint part of the training data
+(Dataset.worker_split through image_processing.build_dataset) and trains a
+replica of the model with fit_channel_pruned. Replicas stay identical:
+
+  * the initial weights are broadcast from worker 0;
+  * AllreduceOptimizer averages the gradients of all workers before every
+    optimizer step, over shared memory. Each worker sums one chunk of the
+    gradients over all workers in worker order, so every worker applies
+    bitwise the same update;
+  * the batch norm moving statistics, which each worker accumulates from its
+    own batches, are averaged at the end of every epoch;
+  * ChannelPruningCallback ranks channels by the kernel norms on the same
+    PolynomialDecay schedule, so with identical weights every replica masks
+    and removes the same channels. A checksum of the trainable weights is
+    compared across workers after every epoch, and training stops if the
+    replicas have diverged.
+
+Each worker runs num_examples_per_worker // batch_size steps per epoch, so
+an epoch covers the data once whatever the number of workers.
+
+Usage:
+  python data_parallel.py --data_parallel_workers=4 --data_parallel_epochs=20 \\
+      --data_parallel_shrink_epochs=5,10,15 \\
+      --data_parallel_output=checkpoints/data_parallel_model.h5
+
+  # End to end test with a tiny MobileNet on synthetic shards.
+  python data_parallel.py --data_parallel_selftest --data_parallel_workers=2
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+import numpy as np
+import tensorflow as tf
+
+import benchmark_inputs
+import channel_pruning
+import image_processing
+import inference_server
+import mobilenet_v1
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_integer('data_parallel_workers', 2,
+                            """Worker processes.""")
+tf.app.flags.DEFINE_integer('data_parallel_epochs', 20,
+                            """Training epochs.""")
+tf.app.flags.DEFINE_string('data_parallel_shrink_epochs', '5,10,15',
+                           """Comma separated epochs after which the masked """
+                           """channels are removed.""")
+tf.app.flags.DEFINE_float('data_parallel_final_sparsity', 0.5,
+                          """Final fraction of pruned conv_pw channels.""")
+tf.app.flags.DEFINE_integer('data_parallel_pruning_frequency', 100,
+                            """Steps between two mask updates.""")
+tf.app.flags.DEFINE_float('data_parallel_learning_rate', 1e-3,
+                          """Adam learning rate.""")
+tf.app.flags.DEFINE_string('data_parallel_output', '',
+                           """Optional .h5 path of the trained model.""")
+tf.app.flags.DEFINE_float('data_parallel_timeout', 600.,
+                          """Seconds a worker waits for the others before """
+                          """giving up.""")
+tf.app.flags.DEFINE_boolean('data_parallel_selftest', False,
+                            """Train a tiny model on synthetic shards with """
+                            """1 and --data_parallel_workers workers.""")
+
+K = tf.keras.backend
+
+
+class Communicator(object):
+  """Collective operations of data-parallel workers over shared memory."""
+
+  def __init__(self, rank, num_workers, shared, timeout=None):
+    """Creates the communicator of one worker.
+
+    Args:
+      rank: integer index of this worker.
+      num_workers: integer number of workers.
+      shared: the tuple of shared_buffers().
+      timeout: float seconds to wait for the other workers, None for ever.
+    """
+    inputs, result, scalars, barrier = shared
+    self.rank = rank
+    self.num_workers = num_workers
+    self._inputs = np.frombuffer(inputs, dtype=np.float32).reshape(
+        num_workers, -1)
+    self._result = np.frombuffer(result, dtype=np.float32)
+    self._scalars = np.frombuffer(scalars, dtype=np.float64)
+    self._barrier = barrier
+    self._timeout = timeout
+
+  def _wait(self):
+    try:
+      self._barrier.wait(self._timeout)
+    except threading.BrokenBarrierError:
+      raise RuntimeError('Worker %d: another data-parallel worker stopped' %
+                         self.rank)
+
+  def _check_size(self, size):
+    if size > self._result.size:
+      raise ValueError('%d values do not fit the %d shared values' %
+                       (size, self._result.size))
+
+  def allreduce_mean(self, value):
+    """Returns the mean of a float32 vector over all workers.
+
+    Worker i sums the i-th chunk over the workers in worker order, so the
+    result is bitwise identical on every worker.
+    """
+    size = value.size
+    self._check_size(size)
+    self._inputs[self.rank, :size] = value
+    self._wait()
+    bounds = np.linspace(0, size, self.num_workers + 1).astype(np.int64)
+    chunk = slice(bounds[self.rank], bounds[self.rank + 1])
+    total = self._result[chunk]
+    np.copyto(total, self._inputs[0, chunk])
+    for rank in range(1, self.num_workers):
+      total += self._inputs[rank, chunk]
+    total *= np.float32(1. / self.num_workers)
+    self._wait()
+    return self._result[:size].copy()
+
+  def broadcast(self, value, root=0):
+    """Returns the float32 vector value of worker root on every worker."""
+    size = value.size
+    self._check_size(size)
+    if self.rank == root:
+      self._result[:size] = value
+    self._wait()
+    value = self._result[:size].copy()
+    self._wait()
+    return value
+
+  def allgather_scalar(self, value):
+    """Returns the list of a float scalar of every worker."""
+    self._scalars[self.rank] = value
+    self._wait()
+    values = self._scalars.tolist()
+    self._wait()
+    return values
+
+
+def shared_buffers(num_workers, size, context):
+  """Allocates the shared memory of workers exchanging up to size values."""
+  return (context.RawArray('f', num_workers * size),
+          context.RawArray('f', size),
+          context.RawArray('d', num_workers),
+          context.Barrier(num_workers))
+
+
+class AllreduceOptimizer(tf.train.Optimizer):
+  """Averages the gradients of all workers before applying them."""
+
+  def __init__(self, optimizer, communicator, name='Allreduce'):
+    super(AllreduceOptimizer, self).__init__(use_locking=False, name=name)
+    self._optimizer = optimizer
+    self._communicator = communicator
+
+  def compute_gradients(self, loss, var_list=None, **kwargs):
+    grads_and_vars = self._optimizer.compute_gradients(loss, var_list,
+                                                       **kwargs)
+    grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+    grads = [tf.convert_to_tensor(g) for g, _ in grads_and_vars]
+    sizes = [g.shape.num_elements() for g in grads]
+    flat = tf.concat([tf.reshape(g, [-1]) for g in grads], axis=0)
+    averaged = tf.py_func(self._communicator.allreduce_mean, [flat],
+                          tf.float32, stateful=True, name='allreduce')
+    averaged.set_shape(flat.shape)
+    return [(tf.reshape(g, grad.shape), v) for g, grad, (_, v) in
+            zip(tf.split(averaged, sizes), grads, grads_and_vars)]
+
+  def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+    return self._optimizer.apply_gradients(grads_and_vars, global_step, name)
+
+  def get_slot(self, *args, **kwargs):
+    return self._optimizer.get_slot(*args, **kwargs)
+
+  def get_slot_names(self, *args, **kwargs):
+    return self._optimizer.get_slot_names(*args, **kwargs)
+
+  def variables(self):
+    return self._optimizer.variables()
+
+
+def _flat(values):
+  return np.concatenate([np.ravel(v) for v in values]).astype(np.float32)
+
+
+def _unflat(flat, like):
+  values = []
+  offset = 0
+  for value in like:
+    values.append(flat[offset:offset + value.size].reshape(value.shape))
+    offset += value.size
+  return values
+
+
+def weights_checksum(model):
+  """Returns the CRC32 of the trainable weights of a model."""
+  checksum = 0
+  for value in K.batch_get_value(model.trainable_weights):
+    checksum = zlib.crc32(np.ascontiguousarray(value).tobytes(), checksum)
+  return checksum & 0xffffffff
+
+
+class SyncCallback(tf.keras.callbacks.Callback):
+  """Keeps the replicas of all workers identical.
+
+  Broadcasts the weights of worker 0 when training starts, averages the
+  non-trainable weights (the batch norm moving statistics) after every
+  epoch and checks that the trainable weights are identical.
+  """
+
+  def __init__(self, communicator):
+    super(SyncCallback, self).__init__()
+    self._communicator = communicator
+    self.epoch_seconds = []
+
+  def on_train_begin(self, logs=None):
+    values = K.batch_get_value(self.model.weights)
+    values = _unflat(self._communicator.broadcast(_flat(values)), values)
+    K.batch_set_value(list(zip(self.model.weights, values)))
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self._epoch_start = time.time()
+
+  def on_epoch_end(self, epoch, logs=None):
+    self.epoch_seconds.append(time.time() - self._epoch_start)
+    weights = self.model.non_trainable_weights
+    if weights:
+      values = K.batch_get_value(weights)
+      values = _unflat(self._communicator.allreduce_mean(_flat(values)),
+                       values)
+      K.batch_set_value(list(zip(weights, values)))
+    checksums = self._communicator.allgather_scalar(
+        weights_checksum(self.model))
+    if len(set(checksums)) > 1:
+      raise RuntimeError('Replicas diverged after epoch %d: checksums %s' %
+                         (epoch, checksums))
+
+
+def build_model(config):
+  """Returns the MobileNetV1 of a training configuration."""
+  return mobilenet_v1.MobileNetV1(
+      config['pointwise_filters'],
+      input_shape=(config['image_size'], config['image_size'], 3),
+      classes=config['classes'])
+
+
+def _worker(rank, cores, config, shared, results):
+  """Trains one replica and puts its result on results."""
+  try:
+    results.put(('done', rank, _train(rank, cores, config, shared)))
+  except Exception:
+    # Unblocks the workers waiting for this one.
+    shared[-1].abort()
+    results.put(('error', rank, traceback.format_exc()))
+
+
+def _train(rank, cores, config, shared):
+  from tensorflow_model_optimization.sparsity import keras as sparsity
+  os.sched_setaffinity(0, cores)
+  # Flags are not inherited by spawned processes.
+  FLAGS([__file__])
+  for name, value in config['flags'].items():
+    if name in FLAGS:
+      setattr(FLAGS, name, value)
+
+  num_workers = config['num_workers']
+  batch_size = FLAGS.batch_size
+  dataset = config['dataset']
+  steps = dataset.num_examples_per_worker(num_workers) // batch_size
+  communicator = Communicator(rank, num_workers, shared,
+                              FLAGS.data_parallel_timeout)
+  K.set_session(tf.Session(config=tf.ConfigProto(
+      intra_op_parallelism_threads=len(cores),
+      inter_op_parallelism_threads=2)))
+
+  def _labels(images, labels):
+    return images, labels - FLAGS.label_offset
+
+  iterator = image_processing.build_dataset(
+      dataset, batch_size, train=True, worker_index=rank,
+      num_workers=num_workers).map(_labels).make_one_shot_iterator()
+
+  def _compile(model):
+    model.compile(
+        optimizer=AllreduceOptimizer(
+            tf.train.AdamOptimizer(config['learning_rate']), communicator),
+        loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+
+  schedule = sparsity.PolynomialDecay(
+      initial_sparsity=0., final_sparsity=config['final_sparsity'],
+      begin_step=0, end_step=steps * config['epochs'],
+      frequency=config['pruning_frequency'])
+  pruning = channel_pruning.ChannelPruningCallback(schedule)
+  sync = SyncCallback(communicator)
+  model = channel_pruning.fit_channel_pruned(
+      build_model(config), _compile, pruning, config['epochs'],
+      shrink_epochs=config['shrink_epochs'], callbacks=[sync], x=iterator,
+      steps_per_epoch=steps, verbose=int(rank == 0))
+  if rank == 0 and config['output']:
+    model.save(config['output'], include_optimizer=False)
+  return {'epoch_seconds': sync.epoch_seconds,
+          'checksum': weights_checksum(model),
+          'pointwise_filters': [
+              model.get_layer(name=name).filters
+              for name in mobilenet_v1.pointwise_layer_names()],
+          'examples_per_epoch': steps * batch_size * num_workers}
+
+
+def train(dataset, num_workers, epochs, shrink_epochs=(),
+          pointwise_filters=None, classes=1000, output=''):
+  """Trains a channel pruned MobileNetV1 with num_workers local workers.
+
+  Args:
+    dataset: Dataset of the training data.
+    num_workers: integer number of worker processes.
+    epochs: integer number of epochs.
+    shrink_epochs: epochs after which the masked channels are removed.
+    pointwise_filters: initial conv_pw widths, None for MobileNet V1.
+    classes: integer number of classes.
+    output: optional .h5 path the model of worker 0 is saved to.
+
+  Returns:
+    list of the results of every worker, dicts with its epoch_seconds, the
+    checksum of its final weights, its final pointwise_filters and the
+    examples_per_epoch of all workers together.
+
+  Raises:
+    RuntimeError: if a worker fails.
+  """
+  config = {
+      'num_workers': num_workers, 'dataset': dataset, 'epochs': epochs,
+      'shrink_epochs': list(shrink_epochs),
+      'pointwise_filters': pointwise_filters or mobilenet_v1.POINTWISE_FILTERS,
+      'classes': classes, 'image_size': FLAGS.image_size, 'output': output,
+      'learning_rate': FLAGS.data_parallel_learning_rate,
+      'final_sparsity': FLAGS.data_parallel_final_sparsity,
+      'pruning_frequency': FLAGS.data_parallel_pruning_frequency,
+      'flags': FLAGS.flag_values_dict(),
+  }
+  with tf.Graph().as_default():
+    size = build_model(config).count_params()
+  # Built once here rather than concurrently by every worker.
+  dataset.shard_index()
+
+  # TensorFlow is not fork safe, so workers are spawned.
+  context = multiprocessing.get_context('spawn')
+  shared = shared_buffers(num_workers, size, context)
+  results = context.Queue()
+  workers = [context.Process(target=_worker,
+                             args=(rank, cores, config, shared, results))
+             for rank, cores in enumerate(
+                 inference_server.split_cores(num_workers))]
+  if len(workers) != num_workers:
+    raise ValueError('%d workers need at least as many cores' % num_workers)
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  worker_results = [None] * num_workers
+  try:
+    for _ in workers:
+      kind, rank, result = results.get()
+      if kind != 'done':
+        raise RuntimeError('Worker %d failed:\n%s' % (rank, result))
+      worker_results[rank] = result
+  finally:
+    for worker in workers:
+      worker.join(timeout=10)
+      if worker.is_alive():
+        worker.terminate()
+  return worker_results
+
+
+def _check_replicas(worker_results):
+  """Raises RuntimeError unless all workers ended with the same model."""
+  for key in ['checksum', 'pointwise_filters']:
+    values = [result[key] for result in worker_results]
+    if any(value != values[0] for value in values):
+      raise RuntimeError('Workers ended with different %s: %s' % (key,
+                                                                  values))
+
+
+def selftest(num_workers):
+  """Trains a tiny MobileNet on synthetic shards with 1 and N workers.
+
+  Checks that the replicas of every run end identical and pruned, and
+  prints the epoch time of both runs.
+  """
+  data_dir = tempfile.mkdtemp(prefix='data_parallel')
+  classes = 10
+  try:
+    benchmark_inputs.write_synthetic_shards(
+        data_dir, 'train', num_shards=2 * num_workers, examples_per_shard=64,
+        num_classes=classes)
+    FLAGS.data_dir = data_dir
+    FLAGS.image_size = 32
+    FLAGS.batch_size = 8
+    FLAGS.data_parallel_pruning_frequency = 2
+    dataset = benchmark_inputs.SyntheticData('train', num_classes=classes)
+    filters = [8, 16, 16, 32, 32, 32, 32, 32, 32, 32, 32, 64, 64]
+    epoch_seconds = {}
+    for workers in sorted(set([1, num_workers])):
+      worker_results = train(dataset, workers, epochs=2, shrink_epochs=[1],
+                             pointwise_filters=filters, classes=classes)
+      _check_replicas(worker_results)
+      widths = worker_results[0]['pointwise_filters']
+      if sum(widths) >= sum(filters):
+        raise RuntimeError('No channels were pruned: %s' % widths)
+      # The first epoch includes building the graph.
+      epoch_seconds[workers] = worker_results[0]['epoch_seconds'][-1]
+      print('%d workers: %d identical replicas, conv_pw widths %s, '
+            '%.2f s per epoch of %d examples' % (
+                workers, len(worker_results), widths, epoch_seconds[workers],
+                worker_results[0]['examples_per_epoch']))
+    print('Speedup with %d workers: %.2fx' % (
+        num_workers, epoch_seconds[1] / epoch_seconds[num_workers]))
+  finally:
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main(unused_argv=None):
+  if FLAGS.data_parallel_selftest:
+    selftest(FLAGS.data_parallel_workers)
+    return
+  from imagenet_data import ImagenetData
+  dataset = ImagenetData(subset='train')
+  shrink_epochs = [int(e) for e in
+                   FLAGS.data_parallel_shrink_epochs.split(',') if e]
+  worker_results = train(dataset, FLAGS.data_parallel_workers,
+                         FLAGS.data_parallel_epochs, shrink_epochs,
+                         output=FLAGS.data_parallel_output)
+  _check_replicas(worker_results)
+  for epoch, seconds in enumerate(worker_results[0]['epoch_seconds']):
+    print('epoch %d: %.1f s, %.1f examples/sec' % (
+        epoch, seconds, worker_results[0]['examples_per_epoch'] / seconds))
+  print('conv_pw widths: %s' % worker_results[0]['pointwise_filters'])
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -16,7 +16,10 @@
 
 Methods of Data class:
   data_files: Returns a python list of all (sharded) data set files.
+  shard_index: Returns the persisted index of the records in the shards.
   num_examples_per_epoch: Returns the number of examples in the data set.
+  worker_split: Returns the shards and records read by one of N workers.
+  indexed_reader: Return a reader of any entry by its position in the set.
   num_classes: Returns the number of classes in the data set.
   reader: Return a reader for a single entry from the data set.
 """
@@ -26,16 +29,32 @@ from __future__ import print_function
 
 from abc import ABCMeta
 from abc import abstractmethod
+import collections
 import os
 
 
 import tensorflow as tf
 
+import tfrecord_index
+
 flags = tf.app.flags
 FLAGS = flags.FLAGS
 
 # Basic model parameters.
 flags.DEFINE_string('data_dir', '/tf/workspace/imagenet', 'Directory to the imagenet tfrecords')
+flags.DEFINE_string('index_dir', '',
+                    """Directory of the shard indexes, defaults to """
+                    """--data_dir.""")
+flags.DEFINE_integer('label_offset', 1,
+                     """Subtracted from the TFRecord labels (1-based, 0 is """
+                     """background) to get 0-based Keras class indices.""")
+
+
+# Data read by one of several workers: the shard files it reads and, when
+# there are fewer shards than workers, the (num_shards, index) argument of
+# tf.data.Dataset.shard to apply to the records of those files.
+WorkerSplit = collections.namedtuple(
+    'WorkerSplit', ['files', 'num_examples', 'record_shard'])
 
 
 class Dataset(object):
@@ -47,6 +66,8 @@ class Dataset(object):
     assert subset in self.available_subsets(), self.available_subsets()
     self.name = name
     self.subset = subset
+    self._data_files = None
+    self._shard_index = None
 
   @abstractmethod
   def num_classes(self):
@@ -54,14 +75,12 @@ class Dataset(object):
     pass
     # return 10
 
-  @abstractmethod
   def num_examples_per_epoch(self):
-    """Returns the number of examples in the data subset."""
-    pass
-    # if self.subset == 'train':
-    #   return 10000
-    # if self.subset == 'validation':
-    #   return 1000
+    """Returns the number of examples in the data subset.
+
+    Counted exactly from the shard index unless a subclass hard-codes it.
+    """
+    return self.shard_index().num_records
 
   @abstractmethod
   def download_message(self):
@@ -75,21 +94,93 @@ class Dataset(object):
   def data_files(self):
     """Returns a python list of all (sharded) data subset files.
 
+    The data directory is globbed once per Dataset, in sorted order.
+
     Returns:
       python list of all (sharded) data set files.
     Raises:
       ValueError: if there are not data_files matching the subset.
     """
-    tf_record_pattern = os.path.join(FLAGS.data_dir, '%s-*' % self.subset)
-    data_files = tf.gfile.Glob(tf_record_pattern)
-    if not data_files:
-      print('No files found for dataset %s/%s at %s' % (self.name,
-                                                        self.subset,
-                                                        FLAGS.data_dir))
+    if self._data_files is None:
+      tf_record_pattern = os.path.join(FLAGS.data_dir, '%s-*' % self.subset)
+      data_files = sorted(tf.gfile.Glob(tf_record_pattern))
+      if not data_files:
+        print('No files found for dataset %s/%s at %s' % (self.name,
+                                                          self.subset,
+                                                          FLAGS.data_dir))
+
+        self.download_message()
+        raise ValueError('No data files found for dataset %s/%s' %
+                         (self.name, self.subset))
+      self._data_files = data_files
+    return list(self._data_files)
+
+  def shard_index(self):
+    """Returns the index of the records in the data subset files.
+
+    The index holds the record count, record byte offsets and class histogram
+    of every shard. It is built by scanning the shards once and persisted in
+    --index_dir (or --data_dir); it is rebuilt when the shards change.
 
-      self.download_message()
-      exit(-1)
-    return data_files
+    Returns:
+      tfrecord_index.ShardIndex of data_files().
+    """
+    if self._shard_index is None:
+      data_files = self.data_files()
+      index_path = tfrecord_index.index_path_for(
+          FLAGS.index_dir or FLAGS.data_dir, self.name, self.subset)
+      index = tfrecord_index.load_index(index_path, data_files)
+      if index is None:
+        tf.logging.info('Building shard index of %d files at %s',
+                        len(data_files), index_path)
+        index = tfrecord_index.build_index(data_files)
+        index.save(index_path)
+      self._shard_index = index
+    return self._shard_index
+
+  def worker_split(self, worker_index=0, num_workers=1):
+    """Returns the data read by one of num_workers data-parallel workers.
+
+    Shards are dealt round-robin when there are at least as many shards as
+    workers; otherwise every worker reads all shards and keeps every
+    num_workers-th record of each. Either way the split is deterministic and the
+    workers read disjoint data.
+
+    Args:
+      worker_index: integer in [0, num_workers).
+      num_workers: integer, number of workers.
+
+    Returns:
+      WorkerSplit of the worker.
+    Raises:
+      ValueError: if worker_index is out of range.
+    """
+    if not 0 <= worker_index < num_workers:
+      raise ValueError('worker_index %d is not in [0, %d)' %
+                       (worker_index, num_workers))
+    index = self.shard_index()
+    num_records = [s['num_records'] for s in index.shards]
+    if len(index.shards) >= num_workers:
+      shards = range(worker_index, len(index.shards), num_workers)
+      return WorkerSplit(files=[index.shards[i]['path'] for i in shards],
+                         num_examples=sum(num_records[i] for i in shards),
+                         record_shard=None)
+    # Dataset.shard keeps records worker_index, worker_index + num_workers...
+    # of every file.
+    return WorkerSplit(
+        files=index.files,
+        num_examples=sum((n - worker_index + num_workers - 1) // num_workers
+                         for n in num_records),
+        record_shard=(num_workers, worker_index))
+
+  def num_examples_per_worker(self, num_workers):
+    """Returns the examples every one of num_workers workers can read.
+
+    Workers stepping in lockstep must all stop after this many examples, the
+    size of the smallest split.
+    """
+    return min(self.worker_split(i, num_workers).num_examples
+               for i in range(num_workers))
 
   def reader(self):
     """Return a reader for a single entry from the data set.
@@ -100,3 +191,11 @@ class Dataset(object):
       Reader object that reads the data set.
     """
     return tf.TFRecordReader()
+
+  def indexed_reader(self):
+    """Return a reader of any entry of the data set by its global position.
+
+    Returns:
+      tfrecord_index.IndexedRecordReader over data_files().
+    """
+    return tfrecord_index.IndexedRecordReader(self.shard_index())
@@ -0,0 +1,227 @@
+"""Full validation evaluation of several models in one pass over the data.
+
+Streams the validation subset once through image_processing.inputs() and
+feeds every batch to all candidate models, each in its own thread and
+session, so the JPEG decoding and preprocessing are paid once for N models.
+Per model, top-1/top-5 accuracy, per-class accuracy and the confusion
+counts are accumulated batch by batch.
+
+Models are given as [name=]path and may be:
+  .h5/.hdf5     Keras model or weights (see export_graph.read_weights),
+  checkpoint    TensorFlow checkpoint prefix,
+  .sparse       sparse_checkpoint.py checkpoint,
+  .pb           frozen GraphDef,
+  .tflite       TFLite model, e.g. the int8 model of quantize.py.
+
+Results are cached in --eval_results_dir under the SHA-1 of the model file
+and the evaluation settings; models with cached results are not run again.
+
+Usage:
+  python evaluate.py --eval_models=dense=checkpoints/model.h5,\\
+int8=checkpoints/model_int8.tflite --eval_results_dir=eval_results
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+from concurrent import futures
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import export_graph
+import image_processing
+import inference_server
+import quantize
+import sensitivity_analysis
+import sparse_checkpoint
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('eval_models', '',
+                           """Comma separated [name=]path of the models to """
+                           """evaluate.""")
+tf.app.flags.DEFINE_string('eval_results_dir', 'eval_results',
+                           """Directory of the cached evaluation results.""")
+tf.app.flags.DEFINE_integer('eval_batches', 0,
+                            """Batches to evaluate, 0 for the whole subset.""")
+tf.app.flags.DEFINE_string('eval_report', '',
+                           """Optional JSON path of all results.""")
+
+
+class SessionModel(object):
+  """A classifier graph with its own session, safe to run from a thread."""
+
+  def __init__(self, sess, input_tensor, output_tensor):
+    self._sess = sess
+    self._input = input_tensor
+    self._output = output_tensor
+
+  def predict(self, images):
+    return self._sess.run(self._output, {self._input: images})
+
+  @classmethod
+  def from_weights(cls, weights):
+    """Builds the MobileNetV1 of a weights dict in a new graph."""
+    with tf.Graph().as_default() as graph:
+      sess = tf.Session(graph=graph,
+                        config=tf.ConfigProto(device_count={'GPU': 0}))
+      tf.keras.backend.set_session(sess)
+      tf.keras.backend.set_learning_phase(0)
+      model = quantize.build_float_model(weights)
+    return cls(sess, model.inputs[0], model.outputs[0])
+
+  @classmethod
+  def from_frozen_graph(cls, path):
+    """Imports a frozen GraphDef in a new graph."""
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as f:
+      graph_def.ParseFromString(f.read())
+    input_name, output_name = inference_server.io_tensor_names(graph_def)
+    with tf.Graph().as_default() as graph:
+      tf.import_graph_def(graph_def, name='')
+    sess = tf.Session(graph=graph,
+                      config=tf.ConfigProto(device_count={'GPU': 0}))
+    return cls(sess, graph.get_tensor_by_name(input_name),
+               graph.get_tensor_by_name(output_name))
+
+
+def load_model(path):
+  """Returns an object with a predict(images) method for a model file."""
+  if path.endswith('.tflite'):
+    return quantize.TFLiteModel(path)
+  if path.endswith('.pb'):
+    return SessionModel.from_frozen_graph(path)
+  if path.endswith('.sparse'):
+    reader = sparse_checkpoint.SparseCheckpointReader(path)
+    try:
+      return SessionModel.from_weights(reader.weights())
+    finally:
+      reader.close()
+  return SessionModel.from_weights(export_graph.read_weights(path))
+
+
+class Accumulator(object):
+  """Accumulates the accuracy and confusion counts of one model."""
+
+  def __init__(self, num_classes):
+    self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+    self.top5_hits = 0
+    self.seconds = 0.
+
+  def update(self, scores, labels):
+    top = np.argsort(-scores, axis=1)[:, :5]
+    np.add.at(self.confusion, (labels, top[:, 0]), 1)
+    self.top5_hits += int(np.sum(np.any(top == labels[:, None], axis=1)))
+
+  def results(self):
+    examples = int(self.confusion.sum())
+    class_examples = self.confusion.sum(axis=1)
+    correct = np.diag(self.confusion)
+    labels, predictions = np.nonzero(self.confusion)
+    return {
+        'examples': examples,
+        'top1': float(correct.sum()) / max(examples, 1),
+        'top5': float(self.top5_hits) / max(examples, 1),
+        'ms_per_image': 1000. * self.seconds / max(examples, 1),
+        'class_accuracy': (correct / np.maximum(class_examples, 1)).tolist(),
+        'class_examples': class_examples.tolist(),
+        # Sparse confusion counts as [label, prediction, count].
+        'confusion': [[int(l), int(p), int(self.confusion[l, p])]
+                      for l, p in zip(labels, predictions)],
+    }
+
+
+def _result_path(results_dir, model_hash, dataset, num_batches):
+  return os.path.join(results_dir, '%s-%s-%s-%dpx%s-offset%d-%s.json' % (
+      model_hash, dataset.name, dataset.subset, FLAGS.image_size,
+      '-fused' if FLAGS.fused_decode_crop else '', FLAGS.label_offset,
+      '%dbatches' % num_batches if num_batches else 'all'))
+
+
+def evaluate(models, dataset, num_batches=None, num_classes=1000):
+  """Evaluates several models on one stream of evaluation batches.
+
+  Args:
+    models: dict of name to an object with a predict(images) method.
+    dataset: Dataset to evaluate on, usually the validation subset.
+    num_batches: integer number of batches, None for the whole subset.
+    num_classes: integer number of model classes.
+
+  Returns:
+    dict of name to Accumulator.results().
+  """
+  accumulators = {name: Accumulator(num_classes) for name in models}
+
+  def _run(name, images, labels):
+    start_time = time.time()
+    scores = models[name].predict(images)
+    accumulators[name].seconds += time.time() - start_time
+    accumulators[name].update(scores, labels)
+
+  start_time = time.time()
+  examples = 0
+  with futures.ThreadPoolExecutor(max_workers=len(models)) as executor:
+    for images, labels in image_processing.numpy_inputs(dataset,
+                                                        num_batches):
+      labels = labels - FLAGS.label_offset
+      for future in [executor.submit(_run, name, images, labels)
+                     for name in models]:
+        future.result()
+      examples += len(labels)
+      if examples % (100 * len(labels)) == 0:
+        tf.logging.info('%d examples, %.1f examples/sec', examples,
+                        examples / (time.time() - start_time))
+  return {name: accumulator.results()
+          for name, accumulator in accumulators.items()}
+
+
+def main(unused_argv=None):
+  from imagenet_data import ImagenetData
+  dataset = ImagenetData(subset='validation')
+  num_batches = FLAGS.eval_batches or None
+  tf.gfile.MakeDirs(FLAGS.eval_results_dir)
+
+  results = collections.OrderedDict()
+  pending = collections.OrderedDict()
+  paths = {}
+  for entry in FLAGS.eval_models.split(','):
+    if not entry:
+      continue
+    name, _, path = entry.rpartition('=')
+    name = name or os.path.basename(path)
+    paths[name] = _result_path(FLAGS.eval_results_dir,
+                               sensitivity_analysis.checkpoint_hash(path),
+                               dataset, FLAGS.eval_batches)
+    if tf.gfile.Exists(paths[name]):
+      with tf.gfile.GFile(paths[name], 'r') as f:
+        results[name] = json.load(f)
+      tf.logging.info('Using cached results of %s', name)
+    else:
+      pending[name] = load_model(path)
+
+  if pending:
+    for name, result in evaluate(pending, dataset, num_batches).items():
+      with tf.gfile.GFile(paths[name], 'w') as f:
+        json.dump(result, f)
+      results[name] = result
+
+  for name, result in results.items():
+    class_accuracy = np.array(result['class_accuracy'])
+    worst = np.argsort(class_accuracy)[:5]
+    print('%-20s top-1 %.4f top-5 %.4f over %d examples, %.2f ms/image, '
+          'worst classes %s' % (
+              name, result['top1'], result['top5'], result['examples'],
+              result['ms_per_image'],
+              ' '.join('%d:%.2f' % (c, class_accuracy[c]) for c in worst)))
+  if FLAGS.eval_report:
+    with tf.gfile.GFile(FLAGS.eval_report, 'w') as f:
+      json.dump(results, f)
+
+
+if __name__ == '__main__':
+  tf.app.run()
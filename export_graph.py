@@ -0,0 +1,257 @@
+"""Exports a trained or surgered MobileNet V1 as a lean frozen inference graph.
+
+The notebook's freeze_session passes every global variable as an output
+node, so the frozen graph keeps all variables, their initializers, the
+optimizer slots and every training-only op they feed. Here instead:
+
+  1. the weights are read from a .h5 file or checkpoint, and batch norm is
+     folded into the kernels and biases of the preceding convolutions in
+     NumPy;
+  2. a MobileNetV1 without batch norm layers is built with the pruned widths
+     in inference mode and given the folded weights, so no pruning masks,
+     summaries, optimizer or training ops are ever created;
+  3. only the ops the model outputs depend on are frozen;
+  4. identity and training nodes are removed, and the graph transform tool
+     strips unused nodes, folds constants and sorts the graph.
+
+Node count and file size are reported against the notebook's freeze.
+
+Usage:
+  python export_graph.py --export_weights=checkpoints/new_surgery_model.hdf5 \\
+      --export_path=checkpoints/frozen_surgery_model_50.pb
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+import channel_surgery
+import mobilenet_v1
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('export_weights',
+                           'checkpoints/final_model_weights.h5',
+                           """Keras .h5 model or weights, or TensorFlow """
+                           """checkpoint prefix, to export.""")
+tf.app.flags.DEFINE_string('export_plan', '',
+                           """SurgeryPlan JSON giving the conv_pw widths of """
+                           """an .h5 file holding weights only.""")
+tf.app.flags.DEFINE_string('export_path', 'checkpoints/frozen_model.pb',
+                           """Path of the frozen GraphDef.""")
+tf.app.flags.DEFINE_integer('export_image_size', 224,
+                            """Input image size of the exported graph.""")
+tf.app.flags.DEFINE_integer('export_batch_size', 0,
+                            """Static batch size of the input, 0 for any.""")
+tf.app.flags.DEFINE_boolean('export_compare', True,
+                            """Also freeze the way the notebook does and """
+                            """report the difference.""")
+
+# Batch norm epsilon of the Keras MobileNet layers.
+BATCH_NORM_EPSILON = 1e-3
+
+GRAPH_TRANSFORMS = [
+    'strip_unused_nodes',
+    'remove_nodes(op=Identity, op=CheckNumerics, op=StopGradient)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'merge_duplicate_nodes',
+    'sort_by_execution_order',
+]
+
+
+def fold_batch_norms(weights, epsilon=BATCH_NORM_EPSILON):
+  """Folds every <layer>_bn into the kernel and bias of <layer>.
+
+  With scale = gamma / sqrt(moving_variance + epsilon), the kernel is scaled
+  per output channel and the bias becomes
+  beta + (bias - moving_mean) * scale.
+
+  Args:
+    weights: dict of layer/parameter name, as model_weights(), to NumPy value.
+    epsilon: float batch norm epsilon.
+
+  Returns:
+    dict of the conv kernels and biases, with the batch norm weights removed
+    and all other weights unchanged.
+  """
+  folded = dict(weights)
+  for name in list(weights):
+    layer, _, parameter = name.partition('/')
+    bn = '%s_bn' % layer
+    if (parameter not in ('kernel', 'depthwise_kernel') or
+        '%s/gamma' % bn not in weights):
+      continue
+    scale = weights['%s/gamma' % bn] / np.sqrt(
+        weights['%s/moving_variance' % bn] + epsilon)
+    kernel = weights[name]
+    if parameter == 'depthwise_kernel':
+      # [height, width, channels, multiplier] with multiplier 1.
+      folded[name] = kernel * scale.reshape(1, 1, -1, 1)
+    else:
+      folded[name] = kernel * scale
+    bias = weights.get('%s/bias' % layer, 0.)
+    folded['%s/bias' % layer] = (weights['%s/beta' % bn] +
+                                 (bias - weights['%s/moving_mean' % bn]) *
+                                 scale).astype(kernel.dtype)
+    for parameter in ('gamma', 'beta', 'moving_mean', 'moving_variance'):
+      del folded['%s/%s' % (bn, parameter)]
+  return folded
+
+
+def read_weights(path, plan_path=''):
+  """Returns the layer/parameter weights of a .h5 file or checkpoint.
+
+  Args:
+    path: string Keras .h5 model or weights, or checkpoint prefix.
+    plan_path: string SurgeryPlan JSON with the conv_pw widths, needed for
+      .h5 files of a surgered model that hold weights only.
+
+  Returns:
+    dict of layer/parameter name to NumPy value.
+  """
+  with tf.Graph().as_default(), tf.Session().as_default():
+    if path.endswith('.h5') or path.endswith('.hdf5'):
+      try:
+        model = tf.keras.models.load_model(path, compile=False)
+      except ValueError:
+        # Weights only; the architecture is a MobileNetV1 of the plan widths.
+        widths = {}
+        if plan_path:
+          with tf.gfile.GFile(plan_path, 'r') as f:
+            widths = channel_surgery.SurgeryPlan.from_json(f.read()).widths()
+        model = mobilenet_v1.MobileNetV1(
+            mobilenet_v1.pointwise_filters_from_widths(widths))
+        model.load_weights(path, by_name=True)
+      return channel_surgery.model_weights(model)
+  if tf.gfile.IsDirectory(path):
+    path = tf.train.latest_checkpoint(path)
+  weights = {}
+  for name, value in channel_surgery.checkpoint_weights(path).items():
+    key = channel_surgery._weight_key(name)
+    if '/' in key and not key.split('/')[0].startswith('training'):
+      weights[key] = value
+  return weights
+
+
+@contextlib.contextmanager
+def _inference_session():
+  """Yields a Keras session on a new graph in inference mode.
+
+  The previous Keras session is restored afterwards, so exporting from a
+  notebook does not disturb its model.
+  """
+  previous = tf.keras.backend.get_session()
+  with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+    tf.keras.backend.set_session(sess)
+    # Set before building, so Dropout is built as the identity.
+    tf.keras.backend.set_learning_phase(0)
+    try:
+      yield sess
+    finally:
+      tf.keras.backend.set_session(previous)
+
+
+def _graph_stats(graph_def):
+  """Returns the node count, serialized size and op histogram of a graph."""
+  ops = collections.Counter(node.op for node in graph_def.node)
+  return {'nodes': len(graph_def.node), 'bytes': graph_def.ByteSize(),
+          'ops': dict(ops)}
+
+
+def naive_freeze(weights, image_size=224):
+  """Freezes a model the way the notebook's freeze_session does.
+
+  Only used to report the size of the graph export() improves upon.
+  """
+  filters = mobilenet_v1.pointwise_filters_from_widths(
+      channel_surgery.plan_surgery(weights).num_channels)
+  with _inference_session() as sess:
+    model = mobilenet_v1.MobileNetV1(filters,
+                                     input_shape=(image_size, image_size, 3))
+    sess.run(tf.global_variables_initializer())
+    channel_surgery.set_model_weights(model, weights)
+    output_names = [output.op.name for output in model.outputs]
+    output_names += [v.op.name for v in tf.global_variables()]
+    graph_def = sess.graph.as_graph_def()
+    for node in graph_def.node:
+      node.device = ''
+    return tf.graph_util.convert_variables_to_constants(sess, graph_def,
+                                                        output_names)
+
+
+def export(weights, image_size=224, batch_size=None):
+  """Builds and freezes the lean inference graph of a MobileNetV1.
+
+  Args:
+    weights: dict of layer/parameter name to NumPy value, with or without
+      batch norm; the conv_pw widths are taken from the kernels.
+    image_size: integer input image size.
+    batch_size: integer static batch size, None for any.
+
+  Returns:
+    graph_def: frozen and transformed GraphDef.
+    input_name: string name of the input tensor.
+    output_names: list of the names of the output tensors.
+  """
+  folded = fold_batch_norms(weights)
+  filters = mobilenet_v1.pointwise_filters_from_widths(
+      channel_surgery.plan_surgery(folded).num_channels)
+  with _inference_session() as sess:
+    model = mobilenet_v1.MobileNetV1(
+        filters, input_shape=(image_size, image_size, 3), batch_norm=False)
+    sess.run(tf.global_variables_initializer())
+    channel_surgery.set_model_weights(model, folded)
+    input_name = model.inputs[0].op.name
+    output_names = [output.op.name for output in model.outputs]
+    graph_def = sess.graph.as_graph_def()
+    for node in graph_def.node:
+      node.device = ''
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, graph_def, output_names)
+
+  graph_def = tf.graph_util.remove_training_nodes(
+      graph_def, protected_nodes=[input_name] + output_names)
+  shape = '%s,%d,%d,3' % (batch_size or -1, image_size, image_size)
+  transforms = [
+      'strip_unused_nodes(type=float, shape="%s")' % shape
+      if t == 'strip_unused_nodes' else t for t in GRAPH_TRANSFORMS]
+  graph_def = TransformGraph(graph_def, [input_name], output_names,
+                             transforms)
+  return graph_def, input_name + ':0', [name + ':0' for name in output_names]
+
+
+def main(unused_argv=None):
+  weights = read_weights(FLAGS.export_weights, FLAGS.export_plan)
+  graph_def, input_name, output_names = export(
+      weights, FLAGS.export_image_size, FLAGS.export_batch_size or None)
+  directory, name = os.path.split(FLAGS.export_path)
+  tf.io.write_graph(graph_def, directory or '.', name, as_text=False)
+  print('Wrote %s, input %s, outputs %s' % (FLAGS.export_path, input_name,
+                                            ', '.join(output_names)))
+
+  stats = _graph_stats(graph_def)
+  if FLAGS.export_compare:
+    # The notebook's freeze keeps the batch norm layers; compare on the
+    # same weights.
+    before = _graph_stats(naive_freeze(weights, FLAGS.export_image_size))
+    print('nodes: %d -> %d, size: %.2f MB -> %.2f MB' % (
+        before['nodes'], stats['nodes'], before['bytes'] / 2.**20,
+        stats['bytes'] / 2.**20))
+  else:
+    print('nodes: %d, size: %.2f MB' % (stats['nodes'],
+                                        stats['bytes'] / 2.**20))
+  print('ops: %s' % ', '.join('%s %d' % item
+                              for item in sorted(stats['ops'].items())))
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -20,28 +20,42 @@
 
  -- Provide processed image data for a network:
  inputs: Construct batches of evaluation examples of images.
+ numpy_inputs: Yield batches of evaluation examples as NumPy arrays.
  distorted_inputs: Construct batches of training examples of images.
  batch_inputs: Construct batches of training or evaluation examples of images.
+ build_dataset: Construct a tf.data pipeline of training or evaluation batches.
+ cached_eval_dataset: Construct evaluation batches from a pre-processed cache.
 
  -- Data processing:
  parse_example_proto: Parses an Example proto containing a training example
    of an image.
+ parse_example_batch: Parses a batch of Example protos in one call.
 
  -- Image decoding:
  decode_jpeg: Decode a JPEG encoded string into a 3-D float32 Tensor.
+ decode_and_distort_image: Decode only a random training crop of one image.
+ decode_and_eval_image: Decode only the central evaluation crop of one image.
 
  -- Image preprocessing:
  image_preprocessing: Decode and preprocess one image for evaluation or training
  distort_image: Distort one image for training a network.
  eval_image: Prepare one image for evaluation.
  distort_color: Distort the color in one image for training.
+ distort_batch: Flip and distort the color of a batch of images for training.
 """
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
+import os
+
+import numpy as np
 import tensorflow as tf
 
+import input_state
+import tracing
+
 FLAGS = tf.app.flags.FLAGS
 
 tf.app.flags.DEFINE_integer('batch_size', 32,
@@ -53,22 +67,60 @@ tf.app.flags.DEFINE_integer('num_preprocess_threads', 4,
                             """Please make this a multiple of 4.""")
 tf.app.flags.DEFINE_integer('num_readers', 4,
                             """Number of parallel readers during train.""")
-
-# Images are preprocessed asynchronously using multiple threads specified by
-# --num_preprocss_threads and the resulting processed images are stored in a
-# random shuffling queue. The shuffling queue dequeues --batch_size images
-# for processing on a given Inception tower. A larger shuffling queue guarantees
-# better mixing across examples within a batch and results in slightly higher
-# predictive performance in a trained model. Empirically,
-# --input_queue_memory_factor=16 works well. A value of 16 implies a queue size
-# of 1024*16 images. Assuming RGB 299x299 images, this implies a queue size of
-# 16GB. If the machine is memory limited, then decrease this factor to
-# decrease the CPU memory footprint, accordingly.
+tf.app.flags.DEFINE_boolean('use_tf_data', False,
+                            """Build the input pipeline with tf.data and """
+                            """autotuned parallelism instead of queue """
+                            """runners.""")
+tf.app.flags.DEFINE_boolean('batched_augmentation', False,
+                            """With --use_tf_data, flip and color distort """
+                            """whole training batches with per-example """
+                            """random choices instead of per image.""")
+tf.app.flags.DEFINE_boolean('fused_decode_crop', False,
+                            """Sample the crop window first and decode only """
+                            """that region of each JPEG.""")
+tf.app.flags.DEFINE_string('eval_cache_dir', '',
+                           """Directory of pre-processed evaluation caches """
+                           """written by build_eval_cache.py. inputs() """
+                           """streams from a matching cache when present.""")
+tf.app.flags.DEFINE_integer('parse_batch_size', 128,
+                            """Number of Example protos parsed per """
+                            """parse_example call with --use_tf_data. """
+                            """0 parses one record at a time.""")
+
+# Serialized records are read from several shards at once and shuffled in a
+# buffer ahead of preprocessing. A larger buffer guarantees better mixing
+# across examples within a batch and results in slightly higher predictive
+# performance in a trained model. The buffer holds the compressed records
+# (~110KB per ImageNet example), not decoded images, so it is sized by a byte
+# budget: --shuffle_buffer_mb=1024 holds roughly 9.5k ImageNet examples
+# interleaved from --shuffle_shards shards. If the machine is memory limited,
+# decrease the budget and raise --shuffle_shards to keep the mixing.
+tf.app.flags.DEFINE_integer('shuffle_buffer_mb', 1024,
+                            """Memory budget in MB of the training shuffle """
+                            """buffer of serialized records. 0 sizes the """
+                            """buffer by --input_queue_memory_factor.""")
+tf.app.flags.DEFINE_integer('shuffle_shards', 16,
+                            """Number of shards interleaved ahead of the """
+                            """record shuffle during training with """
+                            """--use_tf_data.""")
+tf.app.flags.DEFINE_boolean('global_shuffle', False,
+                            """Read training records in a uniformly """
+                            """shuffled order of the whole epoch through """
+                            """the shard index with --use_tf_data, instead """
+                            """of a shuffle buffer.""")
 tf.app.flags.DEFINE_integer('input_queue_memory_factor', 16,
-                            """Size of the queue of preprocessed images. """
-                            """Default is ideal but try smaller values, e.g. """
-                            """4, 2 or 1, if host memory is constrained. See """
-                            """comments in code for more details.""")
+                            """Size of the shuffle buffer in units of 1024 """
+                            """records when --shuffle_buffer_mb is 0.""")
+
+# Version of the evaluation preprocessing stored in an evaluation cache. Bump
+# it whenever eval_image or its rescaling changes so stale caches are ignored.
+EVAL_CACHE_VERSION = 1
+
+# An evaluation cache is a fixed size JSON header followed by fixed length
+# records of a little-endian int32 label and the uint8 [height, width, 3]
+# image, which maps the [-1, 1] image range onto [0, 255].
+EVAL_CACHE_HEADER_BYTES = 4096
+EVAL_CACHE_MAGIC = 'eval_cache'
 
 
 def inputs(dataset, batch_size=None, num_preprocess_threads=None):
@@ -78,6 +130,8 @@ def inputs(dataset, batch_size=None, num_preprocess_threads=None):
 
   Note that some (minimal) image preprocessing occurs during evaluation
   including central cropping and resizing of the image to fit the network.
+  When --eval_cache_dir holds a cache of the dataset for --image_size, the
+  preprocessed images are streamed from it instead.
 
   Args:
     dataset: instance of Dataset class specifying the dataset.
@@ -95,6 +149,13 @@ def inputs(dataset, batch_size=None, num_preprocess_threads=None):
 
   # Force all input processing onto CPU in order to reserve the GPU for
   # the forward inference and back-propagation.
+  cache_path = eval_cache_path(dataset)
+  if cache_path and tf.gfile.Exists(cache_path):
+    with tf.device('/cpu:0'):
+      iterator = cached_eval_dataset(
+          cache_path, batch_size).make_one_shot_iterator()
+      return iterator.get_next()
+
   with tf.device('/cpu:0'):
     images, labels = batch_inputs(
         dataset, batch_size, train=False,
@@ -104,6 +165,44 @@ def inputs(dataset, batch_size=None, num_preprocess_threads=None):
   return images, labels
 
 
+def numpy_inputs(dataset, num_batches=None, batch_size=None):
+  """Yields evaluation batches of inputs() as NumPy arrays.
+
+  The pipeline runs in its own graph and session, with queue runners started
+  if needed, so it can feed models living in other graphs, e.g. Keras or
+  TFLite models.
+
+  Args:
+    dataset: instance of Dataset class specifying the dataset.
+    num_batches: integer number of batches to yield, None for one epoch.
+    batch_size: integer, None defaults to FLAGS.batch_size.
+
+  Yields:
+    images: float32 array of [batch_size, image_size, image_size, 3].
+    labels: int32 array of [batch_size], as stored in the dataset.
+  """
+  if not batch_size:
+    batch_size = FLAGS.batch_size
+  if num_batches is None:
+    num_batches = dataset.num_examples_per_epoch() // batch_size
+  # The graph and session are never left as the defaults between yields,
+  # where the caller may run models in its own default session.
+  graph = tf.Graph()
+  with graph.as_default():
+    images, labels = inputs(dataset, batch_size)
+    sess = tf.Session(graph=graph,
+                      config=tf.ConfigProto(device_count={'GPU': 0}))
+    coord = tf.train.Coordinator()
+    threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+  try:
+    for _ in range(num_batches):
+      yield sess.run([images, labels])
+  finally:
+    coord.request_stop()
+    coord.join(threads, stop_grace_period_secs=5)
+    sess.close()
+
+
 def distorted_inputs(dataset, batch_size=None, num_preprocess_threads=None):
   """Generate batches of distorted versions of ImageNet images.
 
@@ -195,7 +294,8 @@ def distort_color(image, thread_id=0, scope=None):
     return image
 
 
-def distort_image(image, height, width, bbox, thread_id=0, scope=None):
+def distort_image(image, height, width, bbox, thread_id=0, add_summaries=True,
+                  crop_only=False, scope=None):
   """Distort one image for training a network.
 
   Distorting images provides a useful technique for augmenting the data
@@ -210,6 +310,10 @@ def distort_image(image, height, width, bbox, thread_id=0, scope=None):
       where each coordinate is [0, 1) and the coordinates are arranged
       as [ymin, xmin, ymax, xmax].
     thread_id: integer indicating the preprocessing thread.
+    add_summaries: boolean, whether the first thread emits image summaries.
+      Summaries cannot be created inside tf.data functions.
+    crop_only: boolean, only crop and resize, with a resize method drawn per
+      image, and leave flips and color distortions to distort_batch().
     scope: Optional scope for name_scope.
   Returns:
     3-D float Tensor of distorted image used for training.
@@ -220,7 +324,8 @@ def distort_image(image, height, width, bbox, thread_id=0, scope=None):
     # the coordinates are ordered [ymin, xmin, ymax, xmax].
 
     # Display the bounding box in the first thread only.
-    if not thread_id:
+    add_summaries = add_summaries and not thread_id
+    if add_summaries:
       image_with_box = tf.image.draw_bounding_boxes(tf.expand_dims(image, 0),
                                                     bbox)
       tf.summary.image('image_with_bounding_boxes', image_with_box)
@@ -232,16 +337,9 @@ def distort_image(image, height, width, bbox, thread_id=0, scope=None):
   # range of aspect ratios, sizes and overlap with the human-annotated
   # bounding box. If no box is supplied, then we assume the bounding box is
   # the entire image.
-    sample_distorted_bounding_box = tf.image.sample_distorted_bounding_box(
-        tf.shape(image),
-        bounding_boxes=bbox,
-        min_object_covered=0.1,
-        aspect_ratio_range=[0.75, 1.33],
-        area_range=[0.05, 1.0],
-        max_attempts=100,
-        use_image_if_no_bounding_boxes=True)
-    bbox_begin, bbox_size, distort_bbox = sample_distorted_bounding_box
-    if not thread_id:
+    bbox_begin, bbox_size, distort_bbox = _sample_distorted_bounding_box(
+        tf.shape(image), bbox)
+    if add_summaries:
       image_with_distorted_box = tf.image.draw_bounding_boxes(
           tf.expand_dims(image, 0), distort_bbox)
       tf.summary.image('images_with_distorted_bounding_box',
@@ -253,27 +351,117 @@ def distort_image(image, height, width, bbox, thread_id=0, scope=None):
     # This resizing operation may distort the images because the aspect
     # ratio is not respected. We select a resize method in a round robin
     # fashion based on the thread number.
-    # Note that ResizeMethod contains 4 enumerated resizing methods.
-    resize_method = thread_id % 4
-    distorted_image = tf.image.resize_images(distorted_image, [height, width],
-                                             method=resize_method)
+    distorted_image = _resize_distorted_image(distorted_image, height, width,
+                                              thread_id, crop_only)
     # Restore the shape since the dynamic slice based upon the bbox_size loses
     # the third dimension.
     distorted_image.set_shape([height, width, 3])
-    if not thread_id:
-      tf.summary.image('cropped_resized_image',
-                       tf.expand_dims(distorted_image, 0))
+    if crop_only:
+      return distorted_image
+    return _flip_and_distort_color(distorted_image, thread_id, add_summaries)
+
+
+def _resize_distorted_image(image, height, width, thread_id, random_method):
+  """Resizes a training crop with the thread's or a random resize method."""
+  # Note that ResizeMethod contains 4 enumerated resizing methods.
+  if not random_method:
+    return tf.image.resize_images(image, [height, width],
+                                  method=thread_id % 4)
+  # Nearest neighbor keeps the input dtype, the other methods return float.
+  resize_method = tf.random_uniform([], maxval=4, dtype=tf.int32)
+  return tf.case(
+      [(tf.equal(resize_method, method),
+        lambda method=method: tf.cast(tf.image.resize_images(
+            image, [height, width], method=method), tf.float32))
+       for method in range(4)],
+      exclusive=True)
+
+
+def _sample_distorted_bounding_box(image_size, bbox):
+  """Samples the training crop window of an image of shape image_size."""
+  return tf.image.sample_distorted_bounding_box(
+      image_size,
+      bounding_boxes=bbox,
+      min_object_covered=0.1,
+      aspect_ratio_range=[0.75, 1.33],
+      area_range=[0.05, 1.0],
+      max_attempts=100,
+      use_image_if_no_bounding_boxes=True)
+
+
+def _flip_and_distort_color(distorted_image, thread_id, add_summaries):
+  """Randomly flips and color distorts a cropped and resized image."""
+  if add_summaries:
+    tf.summary.image('cropped_resized_image',
+                     tf.expand_dims(distorted_image, 0))
+
+  # Randomly flip the image horizontally.
+  distorted_image = tf.image.random_flip_left_right(distorted_image)
+
+  # Randomly distort the colors.
+  distorted_image = distort_color(distorted_image, thread_id)
+
+  if add_summaries:
+    tf.summary.image('final_distorted_image',
+                     tf.expand_dims(distorted_image, 0))
+  return distorted_image
+
+
+def distort_batch(images, scope=None):
+  """Randomly flip and distort the color of a batch of images.
+
+  Applies the flips and color distortions of distort_image to a whole batch
+  with vectorized ops. Every image draws its own flip, brightness, contrast,
+  saturation and hue, and one of the two color orderings of distort_color,
+  instead of taking the ordering from a preprocessing thread.
 
-    # Randomly flip the image horizontally.
-    distorted_image = tf.image.random_flip_left_right(distorted_image)
+  Args:
+    images: 4-D float Tensor of [batch_size, height, width, 3] cropped and
+      resized images with values in [0, 1].
+    scope: Optional scope for name_scope.
+  Returns:
+    4-D float Tensor of distorted images used for training.
+  """
+  with tf.name_scope(values=[images], name=scope,
+                     default_name='distort_batch'):
+    batch_size = tf.shape(images)[0]
+
+    def _uniform(minval, maxval):
+      return tf.random_uniform([batch_size, 1, 1, 1], minval, maxval)
+
+    # Randomly flip the images horizontally.
+    flip = tf.random_uniform([batch_size]) < 0.5
+    images = tf.where(flip, tf.reverse(images, [2]), images)
+
+    # distort_color applies contrast either after (ordering 0) or before
+    # (ordering 1) saturation and hue; the other position gets a factor of 1.
+    contrast = _uniform(0.5, 1.5)
+    contrast_first = tf.cast(_uniform(0., 1.) < 0.5, tf.float32)
+    contrast_before = 1. + (contrast - 1.) * contrast_first
+    contrast_after = 1. + (contrast - 1.) * (1. - contrast_first)
+
+    images += _uniform(-32. / 255., 32. / 255.)
+    images = _adjust_contrast_batch(images, contrast_before)
+
+    # The HSV conversion is only defined for the [0, 1] range.
+    images = tf.clip_by_value(images, 0.0, 1.0)
+    hue, saturation, value = tf.unstack(tf.image.rgb_to_hsv(images), axis=3)
+    hue += _uniform(-0.2, 0.2)[..., 0]
+    hue -= tf.floor(hue)
+    saturation = tf.clip_by_value(saturation * _uniform(0.5, 1.5)[..., 0],
+                                  0.0, 1.0)
+    images = tf.image.hsv_to_rgb(tf.stack([hue, saturation, value], axis=3))
+
+    images = _adjust_contrast_batch(images, contrast_after)
 
-    # Randomly distort the colors.
-    distorted_image = distort_color(distorted_image, thread_id)
+    # The random_* ops do not necessarily clamp.
+    return tf.clip_by_value(images, 0.0, 1.0)
 
-    if not thread_id:
-      tf.summary.image('final_distorted_image',
-                       tf.expand_dims(distorted_image, 0))
-    return distorted_image
+
+def _adjust_contrast_batch(images, contrast_factor):
+  """tf.image.adjust_contrast with a [batch_size, 1, 1, 1] contrast_factor."""
+  means = tf.reduce_mean(images, axis=[1, 2], keepdims=True)
+  return (images - means) * contrast_factor + means
 
 
 def eval_image(image, height, width, scope=None):
@@ -301,7 +489,94 @@ def eval_image(image, height, width, scope=None):
     return image
 
 
-def image_preprocessing(image_buffer, bbox, train, thread_id=0):
+def decode_and_distort_image(image_buffer, height, width, bbox, thread_id=0,
+                             add_summaries=True, crop_only=False, scope=None):
+  """Decode only a randomly sampled crop of a JPEG for training a network.
+
+  Same distortions as distort_image, but the crop window is sampled from the
+  JPEG header and only that window is decoded. The crop stays uint8 through
+  the resize and is converted to float afterwards.
+
+  Args:
+    image_buffer: scalar string Tensor of a JPEG file.
+    height: integer
+    width: integer
+    bbox: 3-D float Tensor of bounding boxes arranged [1, num_boxes, coords]
+      where each coordinate is [0, 1) and the coordinates are arranged
+      as [ymin, xmin, ymax, xmax].
+    thread_id: integer indicating the preprocessing thread.
+    add_summaries: boolean, whether the first thread emits image summaries.
+    crop_only: boolean, only crop and resize, with a resize method drawn per
+      image, and leave flips and color distortions to distort_batch().
+    scope: Optional scope for name_scope.
+  Returns:
+    3-D float Tensor of distorted image used for training.
+  """
+  with tf.name_scope(values=[image_buffer, height, width, bbox], name=scope,
+                     default_name='decode_and_distort_image'):
+    image_size = tf.image.extract_jpeg_shape(image_buffer)
+    bbox_begin, bbox_size, _ = _sample_distorted_bounding_box(image_size, bbox)
+    offset_y, offset_x, _ = tf.unstack(bbox_begin)
+    crop_height, crop_width, _ = tf.unstack(bbox_size)
+    crop_window = tf.stack([offset_y, offset_x, crop_height, crop_width])
+    distorted_image = tf.image.decode_and_crop_jpeg(image_buffer, crop_window,
+                                                    channels=3)
+
+    # Resize method selection matches distort_image.
+    distorted_image = _resize_distorted_image(distorted_image, height, width,
+                                              thread_id, crop_only)
+    distorted_image.set_shape([height, width, 3])
+    distorted_image = _resized_uint8_to_float(distorted_image)
+    if crop_only:
+      return distorted_image
+    return _flip_and_distort_color(distorted_image, thread_id,
+                                   add_summaries and not thread_id)
+
+
+def decode_and_eval_image(image_buffer, height, width, scope=None):
+  """Decode only the central crop of a JPEG and prepare it for evaluation.
+
+  Produces the same image as eval_image(decode_jpeg(image_buffer), ...) up to
+  float rounding, without decoding the pixels outside the central crop.
+
+  Args:
+    image_buffer: scalar string Tensor of a JPEG file.
+    height: integer
+    width: integer
+    scope: Optional scope for name_scope.
+  Returns:
+    3-D float Tensor of prepared image.
+  """
+  with tf.name_scope(values=[image_buffer, height, width], name=scope,
+                     default_name='decode_and_eval_image'):
+    # The same window as tf.image.central_crop with central_fraction=0.875.
+    image_size = tf.image.extract_jpeg_shape(image_buffer)
+    image_height = tf.cast(image_size[0], tf.float64)
+    image_width = tf.cast(image_size[1], tf.float64)
+    offset_y = tf.cast((image_height - image_height * 0.875) / 2, tf.int32)
+    offset_x = tf.cast((image_width - image_width * 0.875) / 2, tf.int32)
+    crop_window = tf.stack([offset_y, offset_x,
+                            image_size[0] - offset_y * 2,
+                            image_size[1] - offset_x * 2])
+    image = tf.image.decode_and_crop_jpeg(image_buffer, crop_window,
+                                          channels=3)
+
+    image = tf.expand_dims(image, 0)
+    image = tf.image.resize_bilinear(image, [height, width],
+                                     align_corners=False)
+    image = tf.squeeze(image, [0])
+    return _resized_uint8_to_float(image)
+
+
+def _resized_uint8_to_float(image):
+  """Maps a resized uint8 image onto the [0, 1] range of decode_jpeg."""
+  # Resizing uint8 yields float32 in [0, 255] for every method but nearest
+  # neighbor, which keeps uint8. Either way scale as convert_image_dtype does.
+  return tf.cast(image, tf.float32) * (1. / 255.)
+
+
+def image_preprocessing(image_buffer, bbox, train, thread_id=0,
+                        add_summaries=True, crop_only=False, image_size=None):
   """Decode and preprocess one image for evaluation or training.
 
   Args:
@@ -311,6 +586,11 @@ def image_preprocessing(image_buffer, bbox, train, thread_id=0):
       [ymin, xmin, ymax, xmax].
     train: boolean
     thread_id: integer indicating preprocessing thread
+    add_summaries: boolean, whether to emit image summaries during training.
+    crop_only: boolean, during training only crop and resize, and leave flips
+      and color distortions to distort_batch().
+    image_size: integer height and width of the output, None defaults to
+      FLAGS.image_size.
 
   Returns:
     3-D float Tensor containing an appropriately scaled image
@@ -321,14 +601,36 @@ def image_preprocessing(image_buffer, bbox, train, thread_id=0):
   if bbox is None:
     raise ValueError('Please supply a bounding box.')
 
-  image = decode_jpeg(image_buffer)
-  height = FLAGS.image_size
-  width = FLAGS.image_size
+  height = image_size or FLAGS.image_size
+  width = image_size or FLAGS.image_size
 
-  if train:
-    image = distort_image(image, height, width, bbox, thread_id)
+  if FLAGS.fused_decode_crop:
+    if train:
+      image = tracing.timed(
+          'decode_and_distort',
+          lambda: decode_and_distort_image(image_buffer, height, width, bbox,
+                                           thread_id,
+                                           add_summaries=add_summaries,
+                                           crop_only=crop_only),
+          [image_buffer, bbox])
+    else:
+      image = tracing.timed(
+          'decode_and_eval',
+          lambda: decode_and_eval_image(image_buffer, height, width),
+          [image_buffer])
   else:
-    image = eval_image(image, height, width)
+    image = tracing.timed('decode', lambda: decode_jpeg(image_buffer),
+                          [image_buffer])
+    if train:
+      image = tracing.timed(
+          'distort',
+          lambda: distort_image(image, height, width, bbox, thread_id,
+                                add_summaries=add_summaries,
+                                crop_only=crop_only),
+          [image, bbox])
+    else:
+      image = tracing.timed('eval_image',
+                            lambda: eval_image(image, height, width), [image])
 
   # Finally, rescale to [-1,1] instead of [0, 1)
   image = tf.subtract(image, 0.5)
@@ -336,6 +638,27 @@ def image_preprocessing(image_buffer, bbox, train, thread_id=0):
   return image
 
 
+def _example_feature_map():
+  """Returns the feature map of the Example protos described below."""
+  # Dense features in Example proto.
+  feature_map = {
+      'image/encoded': tf.FixedLenFeature([], dtype=tf.string,
+                                          default_value=''),
+      'image/class/label': tf.FixedLenFeature([1], dtype=tf.int64,
+                                              default_value=-1),
+      'image/class/text': tf.FixedLenFeature([], dtype=tf.string,
+                                             default_value=''),
+  }
+  sparse_float32 = tf.VarLenFeature(dtype=tf.float32)
+  # Sparse features in Example proto.
+  feature_map.update(
+      {k: sparse_float32 for k in ['image/object/bbox/xmin',
+                                   'image/object/bbox/ymin',
+                                   'image/object/bbox/xmax',
+                                   'image/object/bbox/ymax']})
+  return feature_map
+
+
 def parse_example_proto(example_serialized):
   """Parses an Example proto containing a training example of an image.
 
@@ -371,24 +694,8 @@ def parse_example_proto(example_serialized):
       [ymin, xmin, ymax, xmax].
     text: Tensor tf.string containing the human-readable label.
   """
-  # Dense features in Example proto.
-  feature_map = {
-      'image/encoded': tf.FixedLenFeature([], dtype=tf.string,
-                                          default_value=''),
-      'image/class/label': tf.FixedLenFeature([1], dtype=tf.int64,
-                                              default_value=-1),
-      'image/class/text': tf.FixedLenFeature([], dtype=tf.string,
-                                             default_value=''),
-  }
-  sparse_float32 = tf.VarLenFeature(dtype=tf.float32)
-  # Sparse features in Example proto.
-  feature_map.update(
-      {k: sparse_float32 for k in ['image/object/bbox/xmin',
-                                   'image/object/bbox/ymin',
-                                   'image/object/bbox/xmax',
-                                   'image/object/bbox/ymax']})
-
-  features = tf.parse_single_example(example_serialized, feature_map)
+  features = tf.parse_single_example(example_serialized,
+                                     _example_feature_map())
   label = tf.cast(features['image/class/label'], dtype=tf.int32)
 
   xmin = tf.expand_dims(features['image/object/bbox/xmin'].values, 0)
@@ -404,14 +711,174 @@ def parse_example_proto(example_serialized):
   bbox = tf.expand_dims(bbox, 0)
   bbox = tf.transpose(bbox, [0, 2, 1])
 
-  image_buffer, label, bbox, _ = features['image/encoded'], label, bbox, features['image/class/text']
-  return image_preprocessing(image_buffer, bbox, True), label
+  return (features['image/encoded'], label, bbox,
+          features['image/class/text'])
+
+
+def parse_example_batch(examples_serialized):
+  """Parses a batch of Example protos in a single parse_example call.
+
+  The variable length bounding boxes of the batch are padded into one dense
+  Tensor, so no per-example reshaping of the sparse features is needed. See
+  parse_example_proto for the Example proto fields.
+
+  Args:
+    examples_serialized: 1-D Tensor tf.string of N serialized Example
+      protocol buffers.
+
+  Returns:
+    image_buffers: 1-D Tensor tf.string of [N] JPEG file contents.
+    labels: 2-D Tensor tf.int32 of [N, 1] labels.
+    bboxes: 3-D float Tensor of bounding boxes arranged [N, max_boxes, coords]
+      where each coordinate is [0, 1) and the coordinates are arranged as
+      [ymin, xmin, ymax, xmax]. Boxes past num_boxes are zero padding.
+    num_boxes: 1-D Tensor tf.int32 of [N] valid boxes per example.
+    texts: 1-D Tensor tf.string of [N] human-readable labels.
+  """
+  features = tf.parse_example(examples_serialized, _example_feature_map())
+  labels = tf.cast(features['image/class/label'], dtype=tf.int32)
+
+  # Every coordinate feature holds one value per box, so the sparse indices
+  # of any of them give the box count of each example.
+  coords = [features['image/object/bbox/%s' % k]
+            for k in ['ymin', 'xmin', 'ymax', 'xmax']]
+  num_boxes = tf.bincount(tf.cast(coords[0].indices[:, 0], tf.int32),
+                          minlength=tf.shape(examples_serialized)[0])
+  bboxes = tf.stack([tf.sparse_tensor_to_dense(c) for c in coords], axis=2)
+
+  return (features['image/encoded'], labels, bboxes, num_boxes,
+          features['image/class/text'])
+
+
+def build_dataset(dataset, batch_size, train, num_readers=None,
+                  worker_index=0, num_workers=1):
+  """Construct a tf.data pipeline of training or evaluation batches.
+
+  Shard files are read by a parallel interleave, parsed in blocks of
+  --parse_batch_size records, preprocessed by a parallel map and batched ahead
+  of the consumer. All parallelism is autotuned
+  by tf.data rather than fixed by --num_preprocess_threads.
+
+  Args:
+    dataset: instance of Dataset class specifying the dataset.
+      See dataset.py for details.
+    batch_size: integer
+    train: boolean
+    num_readers: integer, number of shard files read concurrently. None
+      defaults to FLAGS.num_readers.
+    worker_index: integer, index of this worker when the data is split among
+      data-parallel workers with Dataset.worker_split.
+    num_workers: integer, number of data-parallel workers.
+
+  Returns:
+    tf.data.Dataset of (images, labels) where images is a 4-D float Tensor of
+    [batch_size, FLAGS.image_size, FLAGS.image_size, 3] and labels is a 1-D
+    integer Tensor of [batch_size].
+
+  Raises:
+    ValueError: if data is not found
+  """
+  record_shard = None
+  split_examples = None
+  if num_workers > 1:
+    data_files, split_examples, record_shard = dataset.worker_split(
+        worker_index, num_workers)
+  else:
+    data_files = dataset.data_files()
+  if not data_files:
+    raise ValueError('No data files found for this dataset')
+
+  if num_readers is None:
+    num_readers = FLAGS.num_readers
+
+  if num_readers < 1:
+    raise ValueError('Please make num_readers at least 1')
+
+  def _read_shard(filename):
+    records = tf.data.TFRecordDataset(filename)
+    if record_shard:
+      records = records.shard(*record_shard)
+    return records
+
+  autotune = tf.data.experimental.AUTOTUNE
+
+  if train and FLAGS.global_shuffle:
+    records = _globally_shuffled_records(dataset, worker_index, num_workers)
+  else:
+    # Shuffle at the shard level first, then mix the records of
+    # --shuffle_shards concurrently read shards in a byte-bounded buffer.
+    files = tf.data.Dataset.from_tensor_slices(data_files)
+    if train:
+      files = files.shuffle(buffer_size=len(data_files),
+                            seed=FLAGS.shuffle_seed)
+      cycle_length = min(max(num_readers, FLAGS.shuffle_shards),
+                         len(data_files))
+    else:
+      cycle_length = num_readers
+    files = files.repeat()
+
+    records = files.interleave(_read_shard,
+                               cycle_length=cycle_length,
+                               num_parallel_calls=autotune)
+    if train:
+      records = records.shuffle(
+          buffer_size=_shuffle_buffer_examples(
+              dataset, data_files, cycle_length, split_examples,
+              record_shard),
+          seed=FLAGS.shuffle_seed)
+  records = tracing.latency_stats(records, 'read')
+
+  batched_augmentation = train and FLAGS.batched_augmentation
+
+  def _preprocess(image_buffer, label_index, bbox, _):
+    image = image_preprocessing(image_buffer, bbox, train,
+                                add_summaries=False,
+                                crop_only=batched_augmentation)
+    return image, label_index
+
+  if FLAGS.parse_batch_size > 0:
+    # Parse whole blocks of records at once and hand the per-image buffers
+    # to decoding only afterwards.
+    examples = records.batch(FLAGS.parse_batch_size)
+    examples = examples.map(parse_example_batch, num_parallel_calls=autotune)
+    examples = examples.apply(tf.data.experimental.unbatch())
+    examples = tracing.latency_stats(examples, 'parse')
+
+    def _preprocess_padded(image_buffer, label_index, bbox, num_boxes, text):
+      # Drop the padding boxes and restore the [1, num_boxes, coords] shape.
+      bbox = tf.expand_dims(bbox[:num_boxes], 0)
+      return _preprocess(image_buffer, label_index, bbox, text)
+
+    batches = examples.map(_preprocess_padded, num_parallel_calls=autotune)
+  else:
+    examples = records.map(parse_example_proto, num_parallel_calls=autotune)
+    examples = tracing.latency_stats(examples, 'parse')
+    batches = examples.map(_preprocess, num_parallel_calls=autotune)
+
+  batches = tracing.latency_stats(batches, 'preprocess')
+  batches = batches.batch(batch_size, drop_remainder=True)
+
+  if batched_augmentation:
+    def _distort(images, labels):
+      # distort_batch works on [0, 1]; the crops are already in [-1, 1].
+      images = distort_batch(images * 0.5 + 0.5)
+      return (images - 0.5) * 2.0, labels
+
+    batches = batches.map(_distort, num_parallel_calls=autotune)
+  batches = tracing.latency_stats(batches, 'batch')
+  batches = tracing.latency_stats(batches.prefetch(autotune), 'prefetch')
+  return tracing.with_stats_aggregator(batches)
 
 
 def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
                  num_readers=1):
   """Contruct batches of training or evaluation examples from the image dataset.
 
+  With --use_tf_data the batches come from build_dataset() and
+  num_preprocess_threads is ignored in favour of autotuned parallelism. With
+  --input_state_dir as well, the training iterator state can be checkpointed
+  and restored by input_state.InputStateSaver.
+
   Args:
     dataset: instance of Dataset class specifying the dataset.
       See dataset.py for details.
@@ -428,77 +895,18 @@ def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
     ValueError: if data is not found
   """
   with tf.name_scope('batch_processing'):
-    data_files = dataset.data_files()
-    if data_files is None:
-      raise ValueError('No data files found for this dataset')
-
-    # Create filename_queue
-    if train:
-      filename_queue = tf.train.string_input_producer(data_files,
-                                                      shuffle=True,
-                                                      capacity=16)
-    else:
-      filename_queue = tf.train.string_input_producer(data_files,
-                                                      shuffle=False,
-                                                      capacity=1)
-    if num_preprocess_threads is None:
-      num_preprocess_threads = FLAGS.num_preprocess_threads
-
-    if num_preprocess_threads % 4:
-      raise ValueError('Please make num_preprocess_threads a multiple '
-                       'of 4 (%d % 4 != 0).', num_preprocess_threads)
-
-    if num_readers is None:
-      num_readers = FLAGS.num_readers
-
-    if num_readers < 1:
-      raise ValueError('Please make num_readers at least 1')
-
-    # Approximate number of examples per shard.
-    examples_per_shard = 1024
-    # Size the random shuffle queue to balance between good global
-    # mixing (more examples) and memory use (fewer examples).
-    # 1 image uses 299*299*3*4 bytes = 1MB
-    # The default input_queue_memory_factor is 16 implying a shuffling queue
-    # size: examples_per_shard * 16 * 1MB = 17.6GB
-    min_queue_examples = examples_per_shard * FLAGS.input_queue_memory_factor
-    if train:
-      examples_queue = tf.RandomShuffleQueue(
-          capacity=min_queue_examples + 3 * batch_size,
-          min_after_dequeue=min_queue_examples,
-          dtypes=[tf.string])
-    else:
-      examples_queue = tf.FIFOQueue(
-          capacity=examples_per_shard + 3 * batch_size,
-          dtypes=[tf.string])
-
-    # Create multiple readers to populate the queue of examples.
-    if num_readers > 1:
-      enqueue_ops = []
-      for _ in range(num_readers):
-        reader = dataset.reader()
-        _, value = reader.read(filename_queue)
-        enqueue_ops.append(examples_queue.enqueue([value]))
-
-      tf.train.queue_runner.add_queue_runner(
-          tf.train.queue_runner.QueueRunner(examples_queue, enqueue_ops))
-      example_serialized = examples_queue.dequeue()
+    if FLAGS.use_tf_data:
+      iterator = build_dataset(
+          dataset, batch_size, train,
+          num_readers=num_readers).make_one_shot_iterator()
+      # Only the training position is saved; the --global_shuffle one is
+      # restored from the records consumed.
+      if FLAGS.input_state_dir and train and not FLAGS.global_shuffle:
+        input_state.register_iterator(iterator)
+      images, label_index_batch = iterator.get_next()
     else:
-      reader = dataset.reader()
-      _, example_serialized = reader.read(filename_queue)
-
-    images_and_labels = []
-    for thread_id in range(num_preprocess_threads):
-      # Parse a serialized Example proto to extract the image and metadata.
-      image_buffer, label_index, bbox, _ = parse_example_proto(
-          example_serialized)
-      image = image_preprocessing(image_buffer, bbox, train, thread_id)
-      images_and_labels.append([image, label_index])
-
-    images, label_index_batch = tf.train.batch_join(
-        images_and_labels,
-        batch_size=batch_size,
-        capacity=2 * num_preprocess_threads * batch_size)
+      images, label_index_batch = _queue_batch_inputs(
+          dataset, batch_size, train, num_preprocess_threads, num_readers)
 
     # Reshape images into these desired dimensions.
     height = FLAGS.image_size
@@ -512,3 +920,282 @@ def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
     tf.summary.image('images', images)
 
     return images, tf.reshape(label_index_batch, [batch_size])
+
+
+def _queue_batch_inputs(dataset, batch_size, train, num_preprocess_threads,
+                        num_readers):
+  """Batch examples with queue runners; see batch_inputs for the arguments."""
+  data_files = dataset.data_files()
+  if data_files is None:
+    raise ValueError('No data files found for this dataset')
+
+  # Create filename_queue
+  if train:
+    filename_queue = tf.train.string_input_producer(data_files,
+                                                    shuffle=True,
+                                                    capacity=16)
+  else:
+    filename_queue = tf.train.string_input_producer(data_files,
+                                                    shuffle=False,
+                                                    capacity=1)
+  if num_preprocess_threads is None:
+    num_preprocess_threads = FLAGS.num_preprocess_threads
+
+  if num_preprocess_threads % 4:
+    raise ValueError('Please make num_preprocess_threads a multiple '
+                     'of 4 (%d % 4 != 0).', num_preprocess_threads)
+
+  if num_readers is None:
+    num_readers = FLAGS.num_readers
+
+  if num_readers < 1:
+    raise ValueError('Please make num_readers at least 1')
+
+  # Approximate number of examples per shard.
+  examples_per_shard = 1024
+  if train:
+    # The queue holds serialized records; see _shuffle_buffer_examples.
+    min_queue_examples = _shuffle_buffer_examples(dataset, data_files,
+                                                  num_readers)
+    examples_capacity = min_queue_examples + 3 * batch_size
+    examples_queue = tf.RandomShuffleQueue(
+        capacity=examples_capacity,
+        min_after_dequeue=min_queue_examples,
+        dtypes=[tf.string])
+  else:
+    examples_capacity = examples_per_shard + 3 * batch_size
+    examples_queue = tf.FIFOQueue(
+        capacity=examples_capacity,
+        dtypes=[tf.string])
+
+  # Create multiple readers to populate the queue of examples.
+  if num_readers > 1:
+    enqueue_ops = []
+    for _ in range(num_readers):
+      reader = dataset.reader()
+      _, value = tracing.timed('read',
+                               lambda: reader.read(filename_queue))
+      enqueue_ops.append(examples_queue.enqueue([value]))
+
+    tf.train.queue_runner.add_queue_runner(
+        tf.train.queue_runner.QueueRunner(examples_queue, enqueue_ops))
+    tracing.watch_queue('examples', examples_queue, examples_capacity)
+    example_serialized = examples_queue.dequeue()
+  else:
+    reader = dataset.reader()
+    _, example_serialized = tracing.timed(
+        'read', lambda: reader.read(filename_queue))
+
+  images_and_labels = []
+  for thread_id in range(num_preprocess_threads):
+    # Parse a serialized Example proto to extract the image and metadata.
+    image_buffer, label_index, bbox, _ = tracing.timed(
+        'parse', lambda: parse_example_proto(example_serialized),
+        [example_serialized])
+    image = image_preprocessing(image_buffer, bbox, train, thread_id)
+    images_and_labels.append([image, label_index])
+
+  capacity = 2 * num_preprocess_threads * batch_size
+  # Timed from the start of the consuming run, so this is the time spent
+  # waiting for a full batch.
+  batch = tracing.timed('batch_join', lambda: tf.train.batch_join(
+      images_and_labels, batch_size=batch_size, capacity=capacity))
+  queue_runners = tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)
+  tracing.watch_queue('batch', queue_runners[-1].queue, capacity)
+  return batch
+
+
+def _globally_shuffled_records(dataset, worker_index, num_workers):
+  """Returns a tf.data.Dataset of records in a shuffled order of each epoch.
+
+  Every epoch is a fresh permutation of all records, seeded by
+  (--shuffle_seed, epoch) and read through the memory-mapped shard index.
+  Worker i of n takes every n-th record of the permutation. With
+  --input_state_dir the records consumed before the last saved input state
+  are skipped.
+
+  Args:
+    dataset: instance of Dataset class specifying the dataset.
+    worker_index: integer, index of this data-parallel worker.
+    num_workers: integer, number of data-parallel workers.
+
+  Returns:
+    tf.data.Dataset of scalar tf.string serialized records, repeated.
+  """
+  reader = dataset.indexed_reader()
+  state = input_state.latest_state()
+  start_record = state['records_consumed'] if state else 0
+
+  def _generate():
+    worker_epoch = len(range(worker_index, len(reader), num_workers))
+    epoch, position = divmod(start_record, worker_epoch)
+    while True:
+      order = reader.permutation(FLAGS.shuffle_seed, epoch)
+      order = order[worker_index::num_workers][position:]
+      for record in reader.read(order):
+        yield record
+      epoch, position = epoch + 1, 0
+
+  return tf.data.Dataset.from_generator(_generate, tf.string,
+                                        tf.TensorShape([]))
+
+
+def _shuffle_buffer_examples(dataset, data_files, cycle_length,
+                             num_examples=None, record_shard=None):
+  """Returns the number of serialized records to hold for shuffling.
+
+  Translates --shuffle_buffer_mb into records with the average serialized
+  record size of the shards and logs the mixing the buffer achieves.
+
+  Args:
+    dataset: instance of Dataset class specifying the dataset.
+    data_files: list of the shard files being read.
+    cycle_length: integer, number of shards read concurrently.
+    num_examples: integer examples in data_files, e.g. of a worker split.
+      None defaults to the examples of a whole epoch.
+    record_shard: optional (num_shards, index) of the records kept from
+      data_files, as in Dataset.worker_split.
+
+  Returns:
+    integer number of records in the shuffle buffer.
+  """
+  # Approximate number of examples per shard.
+  examples_per_shard = 1024
+  num_examples = (num_examples or dataset.num_examples_per_epoch() or
+                  examples_per_shard * len(data_files))
+  shard_bytes = sum(tf.gfile.Stat(f).length for f in data_files)
+  if record_shard:
+    # Only one in num_shards records of the files is read.
+    shard_bytes //= record_shard[0]
+  record_bytes = max(shard_bytes // num_examples, 1)
+
+  if FLAGS.shuffle_buffer_mb > 0:
+    buffer_examples = FLAGS.shuffle_buffer_mb * 2**20 // record_bytes
+  else:
+    buffer_examples = examples_per_shard * FLAGS.input_queue_memory_factor
+  buffer_examples = int(max(min(buffer_examples, num_examples), 1))
+
+  # Every record in the buffer is equally likely to be dequeued next, and the
+  # buffer spans a window of consecutive records of each concurrent shard.
+  tf.logging.info(
+      'Shuffling %d serialized records (~%d MB, %.2f%% of an epoch) from %d '
+      'concurrent shards, a window of ~%d records per shard. Shard order is '
+      'reshuffled every epoch.',
+      buffer_examples, buffer_examples * record_bytes // 2**20,
+      100. * buffer_examples / num_examples, cycle_length,
+      buffer_examples // cycle_length)
+  return buffer_examples
+
+
+def eval_cache_path(dataset, image_size=None, fused_decode_crop=None):
+  """Returns the evaluation cache file of a dataset subset.
+
+  The file name encodes the image size, the --fused_decode_crop variant and
+  EVAL_CACHE_VERSION, so caches written by different preprocessing are
+  never mixed up.
+
+  Args:
+    dataset: instance of Dataset class specifying the dataset.
+    image_size: integer, None defaults to FLAGS.image_size.
+    fused_decode_crop: boolean, None defaults to FLAGS.fused_decode_crop.
+
+  Returns:
+    string path inside FLAGS.eval_cache_dir, or None if no cache directory
+    is configured.
+  """
+  if not FLAGS.eval_cache_dir:
+    return None
+  if image_size is None:
+    image_size = FLAGS.image_size
+  if fused_decode_crop is None:
+    fused_decode_crop = FLAGS.fused_decode_crop
+  return os.path.join(FLAGS.eval_cache_dir, '%s-%s-%dpx%s-v%d.cache' % (
+      dataset.name, dataset.subset, image_size,
+      '-fused' if fused_decode_crop else '', EVAL_CACHE_VERSION))
+
+
+def read_eval_cache_header(cache_path):
+  """Reads and validates the JSON header of an evaluation cache.
+
+  Args:
+    cache_path: string path of a cache written by build_eval_cache.py.
+
+  Returns:
+    dict with the image_size, num_examples and record_bytes of the cache.
+
+  Raises:
+    ValueError: if the file is not an evaluation cache of this version.
+  """
+  with tf.gfile.GFile(cache_path, 'rb') as f:
+    header = f.read(EVAL_CACHE_HEADER_BYTES)
+  try:
+    header = json.loads(header.rstrip(b'\0').decode('utf-8'))
+  except ValueError:
+    raise ValueError('%s is not an evaluation cache' % cache_path)
+  if (header.get('magic') != EVAL_CACHE_MAGIC or
+      header.get('version') != EVAL_CACHE_VERSION):
+    raise ValueError('%s is not a version %d evaluation cache' %
+                     (cache_path, EVAL_CACHE_VERSION))
+  return header
+
+
+def cached_eval_dataset(cache_path, batch_size):
+  """Construct a tf.data pipeline of evaluation batches from a cache.
+
+  Records are read sequentially in large blocks and only reinterpreted and
+  rescaled to [-1, 1]; no JPEG decoding or resizing takes place.
+
+  Args:
+    cache_path: string path of a cache written by build_eval_cache.py.
+    batch_size: integer
+
+  Returns:
+    tf.data.Dataset of (images, labels) batches, as build_dataset.
+  """
+  header = read_eval_cache_header(cache_path)
+  image_size = header['image_size']
+  record_bytes = header['record_bytes']
+
+  def _decode(record):
+    label = tf.decode_raw(tf.substr(record, 0, 4), tf.int32,
+                          little_endian=True)
+    image = tf.decode_raw(tf.substr(record, 4, record_bytes - 4), tf.uint8)
+    image = tf.reshape(image, [image_size, image_size, 3])
+    image = tf.cast(image, tf.float32) * (1. / 127.5) - 1.
+    return image, label
+
+  records = tf.data.FixedLengthRecordDataset(
+      cache_path, record_bytes, header_bytes=EVAL_CACHE_HEADER_BYTES,
+      buffer_size=256 * record_bytes)
+  records = records.repeat()
+  batches = records.map(_decode,
+                        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+  batches = batches.batch(batch_size, drop_remainder=True)
+  batches = batches.map(
+      lambda images, labels: (images, tf.reshape(labels, [batch_size])))
+  return batches.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def load_eval_cache(cache_path):
+  """Memory-maps an evaluation cache as NumPy arrays without copying.
+
+  Args:
+    cache_path: string path of a local cache written by build_eval_cache.py.
+
+  Returns:
+    images: uint8 array of [num_examples, image_size, image_size, 3] whose
+      values map onto [-1, 1] as value / 127.5 - 1.
+    labels: int32 array of [num_examples].
+  """
+  header = read_eval_cache_header(cache_path)
+  records = np.memmap(cache_path, mode='r',
+                      offset=EVAL_CACHE_HEADER_BYTES,
+                      shape=(header['num_examples'],),
+                      dtype=eval_cache_record_dtype(header['image_size']))
+  return records['image'], records['label']
+
+
+def eval_cache_record_dtype(image_size):
+  """Returns the NumPy dtype of one evaluation cache record."""
+  return np.dtype([('label', '<i4'),
+                   ('image', np.uint8, (image_size, image_size, 3))])
@@ -0,0 +1,68 @@
+"""Tests of the input pipeline helpers of image_processing.py."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import tensorflow as tf
+
+import image_processing
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class _FakeDataset(object):
+
+  def __init__(self, num_examples):
+    self._num_examples = num_examples
+
+  def num_examples_per_epoch(self):
+    return self._num_examples
+
+
+class ShuffleBufferTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(ShuffleBufferTest, self).setUp()
+    self._shuffle_buffer_mb = FLAGS.shuffle_buffer_mb
+    FLAGS.shuffle_buffer_mb = 1
+    # Four 1 MB shards of 1024 records of 1 KB each.
+    self._files = []
+    for i in range(4):
+      path = os.path.join(self.get_temp_dir(), 'train-%05d' % i)
+      with open(path, 'wb') as f:
+        f.write(b'\0' * 2**20)
+      self._files.append(path)
+    self._dataset = _FakeDataset(4 * 1024)
+
+  def tearDown(self):
+    FLAGS.shuffle_buffer_mb = self._shuffle_buffer_mb
+    super(ShuffleBufferTest, self).tearDown()
+
+  def testWholeEpoch(self):
+    self.assertEqual(image_processing._shuffle_buffer_examples(
+        self._dataset, self._files, 4), 1024)
+
+  def testRoundRobinSplit(self):
+    # Worker 0 of 2 reads shards 0 and 2, 2048 records in 2 MB.
+    buffer_examples = image_processing._shuffle_buffer_examples(
+        self._dataset, self._files[::2], 2, num_examples=2048)
+    self.assertEqual(buffer_examples, 1024)
+
+  def testRecordShardSplit(self):
+    # Worker 0 of 2 keeps every other record of all shards, 2048 records.
+    buffer_examples = image_processing._shuffle_buffer_examples(
+        self._dataset, self._files, 4, num_examples=2048,
+        record_shard=(2, 0))
+    self.assertEqual(buffer_examples, 1024)
+
+  def testSmallSplitCapsTheBuffer(self):
+    FLAGS.shuffle_buffer_mb = 16
+    buffer_examples = image_processing._shuffle_buffer_examples(
+        self._dataset, self._files[::2], 2, num_examples=2048)
+    self.assertEqual(buffer_examples, 2048)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -0,0 +1,514 @@
+"""Dynamic batching CPU inference server for frozen MobileNet graphs.
+
+Serves a frozen GraphDef, e.g. written by export_graph.py or the notebook,
+over HTTP:
+
+  POST /predict   body: a JPEG file. Returns JSON with the top 5 class
+                  indices and scores, and the request latency.
+  GET  /metrics   JSON with the request count, throughput, p50/p99 latency,
+                  queueing delay, batch sizes and per-worker counts.
+
+Requests are grouped into dynamic batches: a batch is dispatched when it
+holds --serve_max_batch requests or when its oldest request has waited
+--serve_max_wait_ms. Batches run on a pool of worker processes, each pinned
+to its own set of cores and holding one session on the graph. The JPEG
+decoding and eval_image preprocessing of image_processing.py run inside that
+session, in front of the imported model. A batch failing on a malformed
+JPEG is re-run image by image, so only the bad requests fail; the running
+and queued requests of a worker that dies fail instead of hanging.
+
+A load generator for comparing models under concurrent load is included:
+
+  python inference_server.py --serve_graph=checkpoints/frozen_model.pb &
+  python inference_server.py --load_test_images='/tmp/val/*.JPEG' \\
+      --load_test_concurrency=32
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import json
+import multiprocessing
+import os
+import queue
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.request import urlopen
+
+import numpy as np
+import tensorflow as tf
+
+import image_processing
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('serve_graph', 'checkpoints/frozen_model.pb',
+                           """Frozen GraphDef to serve.""")
+tf.app.flags.DEFINE_string('serve_input', '',
+                           """Input tensor name; the only Placeholder of """
+                           """the graph if empty.""")
+tf.app.flags.DEFINE_string('serve_output', '',
+                           """Output tensor name; the only unconsumed node """
+                           """of the graph if empty.""")
+tf.app.flags.DEFINE_integer('serve_port', 8500, """HTTP port.""")
+tf.app.flags.DEFINE_integer('serve_workers', 0,
+                            """Worker processes, 0 for one per 4 cores.""")
+tf.app.flags.DEFINE_integer('serve_max_batch', 32,
+                            """Largest dynamic batch.""")
+tf.app.flags.DEFINE_float('serve_max_wait_ms', 5.,
+                          """Longest time the first request of a batch """
+                          """waits for more requests.""")
+tf.app.flags.DEFINE_string('load_test_images', '',
+                           """Glob of JPEGs; if set, run a load test """
+                           """against --load_test_url instead of serving.""")
+tf.app.flags.DEFINE_string('load_test_url', 'http://localhost:8500',
+                           """Server to load test.""")
+tf.app.flags.DEFINE_integer('load_test_concurrency', 16,
+                            """Concurrent load test clients.""")
+tf.app.flags.DEFINE_float('load_test_seconds', 30.,
+                          """Duration of the load test.""")
+
+# Latencies kept for the percentiles of /metrics.
+_LATENCY_WINDOW = 10000
+
+# Seconds between two checks that the workers are alive.
+_LIVENESS_INTERVAL = 1.
+
+
+def io_tensor_names(graph_def):
+  """Returns the input and output tensor names of a single-model graph.
+
+  Raises:
+    ValueError: if the graph has no unique Placeholder or unconsumed node.
+  """
+  consumed = set()
+  for node in graph_def.node:
+    for name in node.input:
+      consumed.add(name.lstrip('^').split(':')[0])
+  inputs = [node.name for node in graph_def.node if node.op == 'Placeholder']
+  outputs = [node.name for node in graph_def.node
+             if node.name not in consumed and
+             node.op not in ('Placeholder', 'Const', 'NoOp')]
+  if len(inputs) != 1 or len(outputs) != 1:
+    raise ValueError('Pass --serve_input and --serve_output, the graph has '
+                     'inputs %s and outputs %s' % (inputs, outputs))
+  return inputs[0] + ':0', outputs[0] + ':0'
+
+
+def _preprocess(image_buffer, image_size, fused_decode_crop):
+  """The evaluation preprocessing of image_processing.image_preprocessing."""
+  if fused_decode_crop:
+    image = image_processing.decode_and_eval_image(image_buffer, image_size,
+                                                   image_size)
+  else:
+    image = image_processing.eval_image(
+        image_processing.decode_jpeg(image_buffer), image_size, image_size)
+  return (image - 0.5) * 2.0
+
+
+def split_cores(num_workers):
+  """Returns num_workers disjoint, contiguous sets of the usable cores."""
+  cores = sorted(os.sched_getaffinity(0))
+  return [set(int(core) for core in chunk)
+          for chunk in np.array_split(cores, num_workers) if len(chunk)]
+
+
+def _run_batch(sess, image_buffers, outputs, buffers):
+  """Returns a (classes, scores) or error message per JPEG buffer.
+
+  A failed batch is re-run one image at a time, so a malformed JPEG only
+  fails its own request.
+  """
+  try:
+    classes, scores = sess.run(outputs, {image_buffers: buffers})
+  except tf.errors.OpError as e:
+    if len(buffers) == 1:
+      return [e.message]
+    return [item for buffer in buffers
+            for item in _run_batch(sess, image_buffers, outputs, [buffer])]
+  return [(c.tolist(), s.tolist()) for c, s in zip(classes, scores)]
+
+
+def _worker(worker_id, cores, config, tasks, results):
+  """Runs batches of JPEG buffers through the graph until told to stop."""
+  try:
+    sess, image_buffers, outputs = _load_graph(cores, config)
+  except Exception as e:
+    results.put(('failed', worker_id, str(e)))
+    raise
+  results.put(('ready', worker_id, None))
+  with sess:
+    while True:
+      task = tasks.get()
+      if task is None:
+        break
+      batch_id, buffers = task
+      # Tells the server which batch is lost if this process dies.
+      results.put(('started', worker_id, batch_id))
+      start_time = time.time()
+      items = _run_batch(sess, image_buffers, outputs, buffers)
+      results.put(('done', worker_id, (batch_id, items,
+                                       time.time() - start_time)))
+
+
+def _load_graph(cores, config):
+  """Pins the process and returns its session, input and top-5 outputs."""
+  # Pin before TensorFlow creates its thread pools.
+  os.sched_setaffinity(0, cores)
+  graph_def = tf.GraphDef()
+  with tf.gfile.GFile(config['graph'], 'rb') as f:
+    graph_def.ParseFromString(f.read())
+  input_name = config['input']
+  output_name = config['output']
+  if not input_name or not output_name:
+    input_name, output_name = io_tensor_names(graph_def)
+
+  with tf.Graph().as_default() as graph:
+    image_buffers = tf.placeholder(tf.string, [None])
+    images = tf.map_fn(
+        lambda image_buffer: _preprocess(image_buffer, config['image_size'],
+                                         config['fused_decode_crop']),
+        image_buffers, dtype=tf.float32, back_prop=False)
+    scores, = tf.import_graph_def(graph_def, input_map={input_name: images},
+                                  return_elements=[output_name], name='')
+    top_scores, top_classes = tf.nn.top_k(scores, k=5)
+  session_config = tf.ConfigProto(intra_op_parallelism_threads=len(cores),
+                                  inter_op_parallelism_threads=1,
+                                  device_count={'GPU': 0})
+  sess = tf.Session(graph=graph, config=session_config)
+  return sess, image_buffers, [top_classes, top_scores]
+
+
+class _Request(object):
+  """One pending prediction, completed by the result thread."""
+
+  def __init__(self, image_buffer):
+    self.image_buffer = image_buffer
+    self.arrival_time = time.time()
+    self.dispatch_time = None
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+
+class Metrics(object):
+  """Thread safe request counters and latency windows."""
+
+  def __init__(self, num_workers):
+    self._lock = threading.Lock()
+    self._start_time = time.time()
+    self._requests = 0
+    self._errors = 0
+    self._latencies = collections.deque(maxlen=_LATENCY_WINDOW)
+    self._queueing = collections.deque(maxlen=_LATENCY_WINDOW)
+    self._batch_sizes = collections.Counter()
+    self._worker_batches = [0] * num_workers
+    self._worker_seconds = [0.] * num_workers
+
+  def add_batch(self, worker_id, requests, run_seconds):
+    now = time.time()
+    with self._lock:
+      self._batch_sizes[len(requests)] += 1
+      self._worker_batches[worker_id] += 1
+      self._worker_seconds[worker_id] += run_seconds
+      for request in requests:
+        self._requests += 1
+        self._errors += int(request.error is not None)
+        self._latencies.append(now - request.arrival_time)
+        self._queueing.append(request.dispatch_time - request.arrival_time)
+
+  def as_dict(self):
+    with self._lock:
+      elapsed = time.time() - self._start_time
+      latencies = 1000. * np.array(self._latencies or [0.])
+      queueing = 1000. * np.array(self._queueing or [0.])
+      batches = sum(self._batch_sizes.values())
+      return {
+          'requests': self._requests,
+          'errors': self._errors,
+          'throughput': self._requests / elapsed,
+          'latency_ms': {'p50': float(np.percentile(latencies, 50)),
+                         'p99': float(np.percentile(latencies, 99))},
+          'queueing_ms': {'p50': float(np.percentile(queueing, 50)),
+                          'p99': float(np.percentile(queueing, 99))},
+          'mean_batch_size': self._requests / float(max(batches, 1)),
+          'batch_sizes': dict(self._batch_sizes),
+          'worker_batches': list(self._worker_batches),
+          'worker_busy_fraction': [s / elapsed for s in self._worker_seconds],
+      }
+
+
+class InferenceServer(object):
+  """Dynamic batcher in front of a pool of pinned worker processes."""
+
+  def __init__(self, graph_path, num_workers=0, max_batch=32,
+               max_wait_ms=5., input_name='', output_name='',
+               image_size=224, fused_decode_crop=False):
+    """Starts the worker processes and waits until they are ready.
+
+    Args:
+      graph_path: string frozen GraphDef.
+      num_workers: integer worker processes, 0 for one per 4 cores.
+      max_batch: integer largest dynamic batch.
+      max_wait_ms: float longest wait of a batch's first request.
+      input_name: string input tensor, or '' to detect it.
+      output_name: string output tensor, or '' to detect it.
+      image_size: integer model input size.
+      fused_decode_crop: boolean, decode only the central crop.
+    """
+    cores = os.sched_getaffinity(0)
+    num_workers = num_workers or max(len(cores) // 4, 1)
+    self._max_batch = max_batch
+    self._max_wait = max_wait_ms / 1000.
+    self._pending = queue.Queue()
+    self._in_flight = {}
+    self._in_flight_lock = threading.Lock()
+    self._next_batch_id = 0
+    # Worker id to the batch it runs, and the error once no worker is left.
+    self._running = {}
+    self._dead_workers = set()
+    self._broken = None
+    self._closing = False
+    config = {'graph': graph_path, 'input': input_name,
+              'output': output_name, 'image_size': image_size,
+              'fused_decode_crop': fused_decode_crop}
+    # TensorFlow is not fork safe, so workers are spawned.
+    context = multiprocessing.get_context('spawn')
+    self._tasks = context.Queue()
+    self._results = context.Queue()
+    core_sets = split_cores(num_workers)
+    self.metrics = Metrics(len(core_sets))
+    # At most two batches per worker are queued, the rest wait for batching.
+    self._slots = threading.Semaphore(2 * len(core_sets))
+    self._workers = [
+        context.Process(target=_worker, args=(i, cores, config, self._tasks,
+                                              self._results))
+        for i, cores in enumerate(core_sets)]
+    for worker in self._workers:
+      worker.daemon = True
+      worker.start()
+    for _ in self._workers:
+      kind, worker_id, message = self._results.get()
+      if kind != 'ready':
+        self.close()
+        raise RuntimeError('Worker %d failed to start: %s' % (worker_id,
+                                                             message))
+    for target in [self._batch_loop, self._result_loop]:
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+
+  def predict(self, image_buffer):
+    """Blocks until a JPEG is classified; returns (classes, scores).
+
+    Raises:
+      ValueError: if the JPEG cannot be decoded or classified.
+      RuntimeError: if the worker running the request died.
+    """
+    request = _Request(image_buffer)
+    self._pending.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.result
+
+  def _batch_loop(self):
+    while True:
+      requests = [self._pending.get()]
+      deadline = requests[0].arrival_time + self._max_wait
+      while len(requests) < self._max_batch:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        try:
+          requests.append(self._pending.get(timeout=timeout))
+        except queue.Empty:
+          break
+      self._slots.acquire()
+      now = time.time()
+      for request in requests:
+        request.dispatch_time = now
+      with self._in_flight_lock:
+        broken = self._broken
+        if not broken:
+          batch_id = self._next_batch_id
+          self._next_batch_id += 1
+          self._in_flight[batch_id] = requests
+      if broken:
+        self._slots.release()
+        for request in requests:
+          request.error = RuntimeError(broken)
+          request.done.set()
+        continue
+      self._tasks.put((batch_id, [r.image_buffer for r in requests]))
+
+  def _result_loop(self):
+    next_check = time.time() + _LIVENESS_INTERVAL
+    while True:
+      try:
+        self._handle_result(*self._results.get(timeout=_LIVENESS_INTERVAL))
+      except queue.Empty:
+        pass
+      if time.time() >= next_check:
+        self._check_workers()
+        next_check = time.time() + _LIVENESS_INTERVAL
+
+  def _handle_result(self, kind, worker_id, payload):
+    if kind == 'started':
+      self._running[worker_id] = payload
+    elif kind == 'done':
+      batch_id, items, run_seconds = payload
+      self._running.pop(worker_id, None)
+      self._finish(worker_id, batch_id, items, run_seconds)
+
+  def _finish(self, worker_id, batch_id, items, run_seconds):
+    """Completes the requests of a batch with its per-image items."""
+    with self._in_flight_lock:
+      requests = self._in_flight.pop(batch_id, None)
+    if requests is None:
+      return  # Already failed.
+    self._slots.release()
+    for request, item in zip(requests, items):
+      if isinstance(item, tuple):
+        request.result = item
+      elif isinstance(item, Exception):
+        request.error = item
+      else:
+        request.error = ValueError(item)
+    self.metrics.add_batch(worker_id, requests, run_seconds)
+    for request in requests:
+      request.done.set()
+
+  def _check_workers(self):
+    """Fails the batches lost with dead workers."""
+    if self._closing:
+      return
+    dead = [i for i, worker in enumerate(self._workers)
+            if i not in self._dead_workers and not worker.is_alive()]
+    if not dead:
+      return
+    # Results a worker sent before dying are already in the queue.
+    while True:
+      try:
+        self._handle_result(*self._results.get_nowait())
+      except queue.Empty:
+        break
+    for worker_id in dead:
+      self._dead_workers.add(worker_id)
+      error = RuntimeError('Worker %d died with exit code %s' % (
+          worker_id, self._workers[worker_id].exitcode))
+      tf.logging.error(str(error))
+      batch_id = self._running.pop(worker_id, None)
+      if batch_id is not None:
+        self._finish(worker_id, batch_id, [error] * self._max_batch, 0.)
+    if len(self._dead_workers) == len(self._workers):
+      # Nothing will run the queued batches.
+      with self._in_flight_lock:
+        self._broken = 'All workers died'
+        batch_ids = list(self._in_flight)
+      for batch_id in batch_ids:
+        self._finish(dead[-1], batch_id,
+                     [RuntimeError(self._broken)] * self._max_batch, 0.)
+
+  def close(self):
+    self._closing = True
+    for _ in self._workers:
+      self._tasks.put(None)
+    for worker in self._workers:
+      worker.join(timeout=10)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+def make_handler(server):
+  """Returns the HTTP request handler class of an InferenceServer."""
+
+  class Handler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, body):
+      data = json.dumps(body).encode('utf-8')
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def do_GET(self):
+      if self.path == '/metrics':
+        self._reply(200, server.metrics.as_dict())
+      else:
+        self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+      if self.path != '/predict':
+        self._reply(404, {'error': 'unknown path %s' % self.path})
+        return
+      start_time = time.time()
+      length = int(self.headers.get('Content-Length', 0))
+      try:
+        classes, scores = server.predict(self.rfile.read(length))
+      except ValueError as e:
+        self._reply(400, {'error': str(e)})
+        return
+      except RuntimeError as e:
+        self._reply(503, {'error': str(e)})
+        return
+      self._reply(200, {'classes': classes, 'scores': scores,
+                        'latency_ms': 1000. * (time.time() - start_time)})
+
+    def log_message(self, *args):
+      pass  # One line per request would dominate the output.
+
+  return Handler
+
+
+def load_test(url, image_paths, concurrency, seconds):
+  """Posts JPEGs from concurrent clients and returns the server metrics."""
+  images = []
+  for path in image_paths:
+    with tf.gfile.GFile(path, 'rb') as f:
+      images.append(f.read())
+  stop_time = time.time() + seconds
+
+  def _client(client_id):
+    i = client_id
+    while time.time() < stop_time:
+      urlopen(url + '/predict', data=images[i % len(images)]).read()
+      i += concurrency
+
+  threads = [threading.Thread(target=_client, args=(i,))
+             for i in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return json.loads(urlopen(url + '/metrics').read().decode('utf-8'))
+
+
+def main(unused_argv=None):
+  if FLAGS.load_test_images:
+    metrics = load_test(FLAGS.load_test_url,
+                        sorted(tf.gfile.Glob(FLAGS.load_test_images)),
+                        FLAGS.load_test_concurrency, FLAGS.load_test_seconds)
+    print(json.dumps(metrics, indent=2))
+    return
+  server = InferenceServer(
+      FLAGS.serve_graph, FLAGS.serve_workers, FLAGS.serve_max_batch,
+      FLAGS.serve_max_wait_ms, FLAGS.serve_input, FLAGS.serve_output,
+      FLAGS.image_size, FLAGS.fused_decode_crop)
+  httpd = _ThreadingHTTPServer(('', FLAGS.serve_port), make_handler(server))
+  print('Serving %s on port %d' % (FLAGS.serve_graph, FLAGS.serve_port))
+  try:
+    httpd.serve_forever()
+  finally:
+    server.close()
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,185 @@
+"""Checkpointing of the input pipeline position next to model checkpoints.
+
+The tf.data iterator built by image_processing.batch_inputs() is registered
+in INPUT_STATE_COLLECTION when --input_state_dir is set. Its serialized state
+covers the shard and record position, the shuffle buffer contents and the
+shuffle RNG state, so a restarted run continues mid-epoch with the very next
+batch instead of at the start of the epoch.
+
+The --global_shuffle order is generated in Python and cannot be serialized
+by tf.data; as it is a pure function of (--shuffle_seed, epoch), its state is
+the number of records consumed, kept in the JSON sidecar of every save.
+
+Methods:
+  register_iterator: Adds an iterator to the saved input state.
+  latest_state: Returns the sidecar of the most recent input state save.
+  InputStateSaver: Saves and restores the registered iterators.
+  InputStateCallback: Keras callback saving the input state during training.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import tensorflow as tf
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_integer('shuffle_seed', 0,
+                            """Seed of the training shuffles of the tf.data """
+                            """pipeline, saved with the input state.""")
+tf.app.flags.DEFINE_string('input_state_dir', '',
+                           """Directory, e.g. checkpoints, to save and """
+                           """restore the input pipeline state in. Empty """
+                           """disables input state checkpointing.""")
+
+INPUT_STATE_COLLECTION = 'input_pipeline_state'
+
+# Prefix of the input state checkpoints, and the name of their checkpoint
+# state file, which must not clobber the model's 'checkpoint' file.
+_STATE_PREFIX = 'input_state'
+_LATEST_FILENAME = 'input_checkpoint'
+
+
+def register_iterator(iterator):
+  """Adds a tf.data iterator to the saved input state."""
+  tf.add_to_collection(
+      INPUT_STATE_COLLECTION,
+      tf.data.experimental.make_saveable_from_iterator(iterator))
+
+
+def latest_state(state_dir=None):
+  """Returns the sidecar of the most recent input state save.
+
+  Args:
+    state_dir: string, None defaults to FLAGS.input_state_dir.
+
+  Returns:
+    dict with the checkpoint_path, global_step, records_consumed and
+    shuffle_seed of the save, or None if nothing was saved yet.
+  """
+  state_dir = state_dir or FLAGS.input_state_dir
+  if not state_dir:
+    return None
+  checkpoint_path = tf.train.latest_checkpoint(state_dir,
+                                               latest_filename=_LATEST_FILENAME)
+  if not checkpoint_path or not tf.gfile.Exists(checkpoint_path + '.json'):
+    return None
+  with tf.gfile.GFile(checkpoint_path + '.json', 'r') as f:
+    state = json.load(f)
+  state['checkpoint_path'] = checkpoint_path
+  return state
+
+
+class InputStateSaver(object):
+  """Saves and restores the input pipeline iterators of the default graph."""
+
+  def __init__(self, state_dir=None, max_to_keep=2):
+    """Initialize the saver.
+
+    Must be created after batch_inputs() has built the pipeline.
+
+    Args:
+      state_dir: string, None defaults to FLAGS.input_state_dir.
+      max_to_keep: integer, number of recent input states to keep.
+    """
+    self._state_dir = state_dir or FLAGS.input_state_dir
+    saveables = tf.get_collection(INPUT_STATE_COLLECTION)
+    self._saver = None
+    if saveables:
+      self._saver = tf.train.Saver(saveables, max_to_keep=max_to_keep,
+                                   save_relative_paths=True)
+
+  def save(self, sess, global_step, records_consumed):
+    """Saves the iterator state and the position of the pipeline.
+
+    Args:
+      sess: Session holding the iterators.
+      global_step: integer training step the state belongs to.
+      records_consumed: integer number of records consumed by training since
+        the start of the run, including restored runs.
+
+    Returns:
+      string path prefix of the saved state.
+    """
+    checkpoint_path = os.path.join(self._state_dir,
+                                   '%s-%d' % (_STATE_PREFIX, global_step))
+    if self._saver:
+      self._saver.save(sess, os.path.join(self._state_dir, _STATE_PREFIX),
+                       global_step=global_step,
+                       latest_filename=_LATEST_FILENAME,
+                       write_meta_graph=False)
+    else:
+      # Nothing serializable in the graph; keep the checkpoint state file so
+      # latest_state() still finds the sidecar.
+      tf.train.update_checkpoint_state(self._state_dir, checkpoint_path,
+                                       latest_filename=_LATEST_FILENAME)
+    with tf.gfile.GFile(checkpoint_path + '.json', 'w') as f:
+      json.dump({'global_step': int(global_step),
+                 'records_consumed': int(records_consumed),
+                 'shuffle_seed': FLAGS.shuffle_seed}, f)
+    return checkpoint_path
+
+  def restore(self, sess):
+    """Restores the most recent input state, if any.
+
+    Returns:
+      dict of latest_state(), or None if there was nothing to restore.
+    """
+    state = latest_state(self._state_dir)
+    if state is None:
+      return None
+    if state['shuffle_seed'] != FLAGS.shuffle_seed:
+      tf.logging.warning('Input state was saved with --shuffle_seed=%d, '
+                         'resuming with %d', state['shuffle_seed'],
+                         FLAGS.shuffle_seed)
+    if self._saver:
+      self._saver.restore(sess, state['checkpoint_path'])
+    tf.logging.info('Restored input pipeline state from %s',
+                    state['checkpoint_path'])
+    return state
+
+
+class InputStateCallback(tf.keras.callbacks.Callback):
+  """Keras callback saving the input pipeline state during training.
+
+  Restores the latest state when training begins and saves it every
+  save_steps batches and at the end of every epoch, so a restarted run loses
+  at most save_steps batches of input progress.
+  """
+
+  def __init__(self, batch_size, save_steps=1000, state_dir=None):
+    """Initialize the callback.
+
+    Args:
+      batch_size: integer number of records consumed per training batch.
+      save_steps: integer, number of batches between saves.
+      state_dir: string, None defaults to FLAGS.input_state_dir.
+    """
+    super(InputStateCallback, self).__init__()
+    self._batch_size = batch_size
+    self._save_steps = save_steps
+    self._state_saver = InputStateSaver(state_dir)
+    self._step = 0
+    self._records_consumed = 0
+
+  def on_train_begin(self, logs=None):
+    state = self._state_saver.restore(tf.keras.backend.get_session())
+    if state:
+      self._step = state['global_step']
+      self._records_consumed = state['records_consumed']
+
+  def on_batch_end(self, batch, logs=None):
+    self._step += 1
+    self._records_consumed += self._batch_size
+    if self._step % self._save_steps == 0:
+      self._save()
+
+  def on_epoch_end(self, epoch, logs=None):
+    self._save()
+
+  def _save(self):
+    self._state_saver.save(tf.keras.backend.get_session(), self._step,
+                           self._records_consumed)
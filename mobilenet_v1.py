@@ -0,0 +1,121 @@
+"""MobileNet V1 with a configurable width for every pointwise convolution.
+
+Builds the same graph, with the same layer names, as
+tf.keras.applications.MobileNet(alpha=1.0), except that the number of
+filters of each conv_pw_<i> layer can be set individually. Weights of the
+Keras application therefore load by name, and a channel-pruned MobileNet is
+just a MobileNet with smaller pointwise widths.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+
+import tensorflow as tf
+
+layers = tf.keras.layers
+
+# Filters and strides of the depthwise separable blocks conv_dw/pw_1..13.
+POINTWISE_FILTERS = [64, 128, 128, 256, 256, 512, 512, 512, 512, 512, 512,
+                     1024, 1024]
+BLOCK_STRIDES = [1, 2, 1, 2, 1, 2, 1, 1, 1, 1, 1, 2, 1]
+
+
+def _depthwise_conv_block(inputs, pointwise_filters, strides, block_id,
+                          batch_norm=True):
+  """Adds conv_dw_<block_id> and conv_pw_<block_id> with their BN and ReLU."""
+  if strides == 1:
+    x = inputs
+  else:
+    x = layers.ZeroPadding2D(((0, 1), (0, 1)),
+                             name='conv_pad_%d' % block_id)(inputs)
+  x = layers.DepthwiseConv2D((3, 3),
+                             padding='same' if strides == 1 else 'valid',
+                             strides=(strides, strides),
+                             use_bias=not batch_norm,
+                             name='conv_dw_%d' % block_id)(x)
+  if batch_norm:
+    x = layers.BatchNormalization(name='conv_dw_%d_bn' % block_id)(x)
+  x = layers.ReLU(6., name='conv_dw_%d_relu' % block_id)(x)
+  x = layers.Conv2D(pointwise_filters, (1, 1),
+                    padding='same',
+                    use_bias=not batch_norm,
+                    strides=(1, 1),
+                    name='conv_pw_%d' % block_id)(x)
+  if batch_norm:
+    x = layers.BatchNormalization(name='conv_pw_%d_bn' % block_id)(x)
+  return layers.ReLU(6., name='conv_pw_%d_relu' % block_id)(x)
+
+
+def pointwise_layer_names():
+  """Returns the names of the conv_pw_<i> layers, in order."""
+  return ['conv_pw_%d' % (i + 1) for i in range(len(POINTWISE_FILTERS))]
+
+
+def channel_batch_norms(pointwise_name):
+  """Returns the batch norm layers holding the output channels of a layer.
+
+  A masked output channel of conv_pw_<i> is only zero downstream if it is
+  masked in conv_pw_<i>_bn and in conv_dw_<i+1>_bn: conv_dw_<i+1> keeps the
+  zero channel zero, but its batch norm adds beta - gamma * mean / std.
+  """
+  names = ['%s_bn' % pointwise_name]
+  match = re.match(r'conv_pw_(\d+)$', pointwise_name)
+  if match and int(match.group(1)) < len(POINTWISE_FILTERS):
+    names.append('conv_dw_%d_bn' % (int(match.group(1)) + 1))
+  return names
+
+
+def pointwise_filters_from_widths(widths):
+  """Returns the filters of all blocks given a dict of conv_pw_<i> widths."""
+  return [widths.get(name, filters)
+          for name, filters in zip(pointwise_layer_names(), POINTWISE_FILTERS)]
+
+
+def MobileNetV1(pointwise_filters=None, input_shape=(224, 224, 3),
+                classes=1000, dropout=1e-3, batch_norm=True, name=None):
+  """Instantiates MobileNet V1 with per-block pointwise widths.
+
+  Args:
+    pointwise_filters: list of the 13 conv_pw_<i> filter counts, None
+      defaults to POINTWISE_FILTERS.
+    input_shape: tuple of the channels-last input shape.
+    classes: integer number of classes.
+    dropout: float dropout rate before conv_preds.
+    batch_norm: if False, the convolutions have biases instead of batch
+      norm layers, to hold weights with batch norm folded in.
+    name: optional model name.
+
+  Returns:
+    tf.keras.Model
+  """
+  if pointwise_filters is None:
+    pointwise_filters = POINTWISE_FILTERS
+  if len(pointwise_filters) != len(POINTWISE_FILTERS):
+    raise ValueError('Expected %d pointwise widths, got %d' %
+                     (len(POINTWISE_FILTERS), len(pointwise_filters)))
+
+  img_input = layers.Input(shape=input_shape)
+  x = layers.ZeroPadding2D(padding=((0, 1), (0, 1)),
+                           name='conv1_pad')(img_input)
+  x = layers.Conv2D(32, (3, 3), padding='valid', use_bias=not batch_norm,
+                    strides=(2, 2), name='conv1')(x)
+  if batch_norm:
+    x = layers.BatchNormalization(name='conv1_bn')(x)
+  x = layers.ReLU(6., name='conv1_relu')(x)
+
+  for block_id, (filters, strides) in enumerate(
+      zip(pointwise_filters, BLOCK_STRIDES), 1):
+    x = _depthwise_conv_block(x, int(filters), strides, block_id,
+                              batch_norm)
+
+  x = layers.GlobalAveragePooling2D()(x)
+  x = layers.Reshape((1, 1, int(pointwise_filters[-1])), name='reshape_1')(x)
+  x = layers.Dropout(dropout, name='dropout')(x)
+  x = layers.Conv2D(classes, (1, 1), padding='same', name='conv_preds')(x)
+  x = layers.Reshape((classes,), name='reshape_2')(x)
+  x = layers.Activation('softmax', name='act_softmax')(x)
+
+  return tf.keras.Model(img_input, x,
+                        name=name or 'mobilenet_v1_%d' % input_shape[0])
@@ -0,0 +1,249 @@
+"""Post-training int8 quantization of a pruned or surgered MobileNet V1.
+
+The float model is converted with the TFLite converter into a fully integer
+model: int8 weights with one scale per output channel, and int8 activations
+whose ranges are calibrated on --calibration_batches batches of inputs() on
+the validation subset. TFLite quantizes activations per tensor; the
+per-channel activation ranges seen during calibration are written to the
+calibration report, so channels whose range dwarfs the rest of their layer,
+and therefore lose most precision, can be spotted.
+
+The comparison harness runs the float and the int8 model on the same
+validation batches on the CPU and reports their top-1/top-5 accuracy, how
+often their top-1 predictions agree and their per-image latency.
+
+Usage:
+  python quantize.py --export_weights=checkpoints/new_surgery_model.hdf5 \\
+      --quantize_output=checkpoints/model_int8.tflite
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import re
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import channel_surgery
+import export_graph
+import image_processing
+import mobilenet_v1
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('quantize_output', 'checkpoints/model_int8.tflite',
+                           """Path of the int8 TFLite model.""")
+tf.app.flags.DEFINE_integer('calibration_batches', 300,
+                            """Validation batches used to calibrate the """
+                            """activation ranges.""")
+tf.app.flags.DEFINE_integer('compare_batches', 50,
+                            """Validation batches of the float vs. int8 """
+                            """comparison, 0 to skip it.""")
+tf.app.flags.DEFINE_string('quantize_report', '',
+                           """Optional JSON path of the calibration ranges """
+                           """and the comparison results.""")
+
+# Layers whose per-channel output ranges are reported.
+_RANGE_LAYERS = r'conv1_relu$|conv_(dw|pw)_\d+_relu$'
+
+
+class ActivationRanges(object):
+  """Per-channel min and max of layer outputs over calibration batches."""
+
+  def __init__(self, model, layer_regex=_RANGE_LAYERS):
+    names = [layer.name for layer in model.layers
+             if re.match(layer_regex, layer.name)]
+    self._names = names
+    self._model = tf.keras.Model(
+        model.inputs, [model.get_layer(name=name).output for name in names])
+    self.min = {}
+    self.max = {}
+
+  def update(self, images):
+    outputs = self._model.predict_on_batch(images)
+    if len(self._names) == 1:
+      outputs = [outputs]
+    for name, output in zip(self._names, outputs):
+      output = output.reshape(-1, output.shape[-1])
+      low = output.min(axis=0)
+      high = output.max(axis=0)
+      self.min[name] = np.minimum(self.min.get(name, low), low)
+      self.max[name] = np.maximum(self.max.get(name, high), high)
+
+  def report(self):
+    """Returns per layer the channel ranges and their spread.
+
+    The spread is the largest channel range over the median channel range;
+    with one per-tensor scale, the median channel keeps about
+    log2(256 / spread) bits.
+    """
+    layers = {}
+    for name in self._names:
+      ranges = self.max[name] - self.min[name]
+      layers[name] = {
+          'min': self.min[name].tolist(),
+          'max': self.max[name].tolist(),
+          'spread': float(ranges.max() / max(np.median(ranges), 1e-8)),
+      }
+    return layers
+
+
+def build_float_model(weights):
+  """Builds the float MobileNetV1 of a weights dict at its pruned widths."""
+  filters = mobilenet_v1.pointwise_filters_from_widths(
+      channel_surgery.plan_surgery(weights).num_channels)
+  model = mobilenet_v1.MobileNetV1(
+      filters, input_shape=(FLAGS.image_size, FLAGS.image_size, 3))
+  channel_surgery.set_model_weights(model, weights)
+  return model
+
+
+def quantize(model, dataset, num_batches, output_path):
+  """Converts a Keras model into a calibrated, fully integer TFLite model.
+
+  Args:
+    model: float tf.keras.Model in inference mode.
+    dataset: Dataset of the calibration images, usually validation.
+    num_batches: integer number of calibration batches of inputs().
+    output_path: string path of the .tflite model.
+
+  Returns:
+    ActivationRanges seen during calibration.
+  """
+  ranges = ActivationRanges(model)
+
+  def _representative_dataset():
+    for images, _ in image_processing.numpy_inputs(dataset, num_batches):
+      ranges.update(images)
+      # The converter calibrates on single examples of the input shape.
+      for image in images:
+        yield [image[np.newaxis]]
+
+  # from_keras_model_file would clear the Keras session, and with it this
+  # model and the ranges model run during calibration.
+  converter = tf.lite.TFLiteConverter.from_session(
+      tf.keras.backend.get_session(), model.inputs, model.outputs)
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  converter.representative_dataset = tf.lite.RepresentativeDataset(
+      _representative_dataset)
+  # Fail instead of falling back to float kernels for unsupported ops.
+  converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+  tflite_model = converter.convert()
+  with tf.gfile.GFile(output_path, 'wb') as f:
+    f.write(tflite_model)
+  return ranges
+
+
+class TFLiteModel(object):
+  """Runs a .tflite classifier on NumPy batches."""
+
+  def __init__(self, path, num_threads=None):
+    self._interpreter = tf.lite.Interpreter(model_path=path)
+    if num_threads and hasattr(self._interpreter, 'set_num_threads'):
+      self._interpreter.set_num_threads(num_threads)
+    self._input = self._interpreter.get_input_details()[0]
+    self._output = self._interpreter.get_output_details()[0]
+    self._batch_size = None
+
+  def predict(self, images):
+    """Returns the float class scores of a batch of float images."""
+    if self._batch_size != len(images):
+      self._interpreter.resize_tensor_input(self._input['index'],
+                                            [len(images)] +
+                                            list(images.shape[1:]))
+      self._interpreter.allocate_tensors()
+      self._batch_size = len(images)
+    scale, zero_point = self._input['quantization']
+    if self._input['dtype'] != np.float32 and scale:
+      images = np.round(images / scale + zero_point).astype(
+          self._input['dtype'])
+    self._interpreter.set_tensor(self._input['index'], images)
+    self._interpreter.invoke()
+    scores = self._interpreter.get_tensor(self._output['index'])
+    scale, zero_point = self._output['quantization']
+    if self._output['dtype'] != np.float32 and scale:
+      scores = (scores.astype(np.float32) - zero_point) * scale
+    return scores
+
+
+def top_k_hits(scores, labels, k=5):
+  """Returns the top-1 and top-k hits of a batch of class scores."""
+  top = np.argsort(-scores, axis=1)[:, :k]
+  return (int(np.sum(top[:, 0] == labels)),
+          int(np.sum(np.any(top == labels[:, None], axis=1))))
+
+
+def compare(float_model, tflite_model, dataset, num_batches):
+  """Evaluates a float and an int8 model on the same validation batches.
+
+  Returns:
+    dict with the examples, the float and int8 top1/top5 accuracy and
+    ms_per_image, and the top1_agreement of the two models.
+  """
+  results = {'float': [0, 0, 0.], 'int8': [0, 0, 0.]}
+  agreement = 0
+  examples = 0
+  for images, labels in image_processing.numpy_inputs(dataset, num_batches):
+    labels = labels - FLAGS.label_offset
+    top1 = {}
+    for name, predict in [('float', float_model.predict_on_batch),
+                          ('int8', tflite_model.predict)]:
+      start_time = time.time()
+      scores = predict(images)
+      results[name][2] += time.time() - start_time
+      hits1, hits5 = top_k_hits(scores, labels)
+      results[name][0] += hits1
+      results[name][1] += hits5
+      top1[name] = np.argmax(scores, axis=1)
+    agreement += int(np.sum(top1['float'] == top1['int8']))
+    examples += len(labels)
+  report = {'examples': examples,
+            'top1_agreement': agreement / float(max(examples, 1))}
+  for name, (hits1, hits5, seconds) in results.items():
+    report[name] = {'top1': hits1 / float(max(examples, 1)),
+                    'top5': hits5 / float(max(examples, 1)),
+                    'ms_per_image': 1000. * seconds / max(examples, 1)}
+  return report
+
+
+def main(unused_argv=None):
+  from imagenet_data import ImagenetData
+  dataset = ImagenetData(subset='validation')
+  tf.keras.backend.set_session(
+      tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})))
+  tf.keras.backend.set_learning_phase(0)
+  weights = export_graph.read_weights(FLAGS.export_weights, FLAGS.export_plan)
+  model = build_float_model(weights)
+
+  ranges = quantize(model, dataset, FLAGS.calibration_batches,
+                    FLAGS.quantize_output)
+  report = {'calibration': {'batches': FLAGS.calibration_batches,
+                            'layers': ranges.report()}}
+  print('Wrote %s (%.2f MB)' % (
+      FLAGS.quantize_output,
+      tf.gfile.Stat(FLAGS.quantize_output).length / 2.**20))
+  for name, layer in sorted(report['calibration']['layers'].items()):
+    if layer['spread'] > 16:
+      print('%s: channel range spread %.1fx' % (name, layer['spread']))
+
+  if FLAGS.compare_batches:
+    comparison = compare(model, TFLiteModel(FLAGS.quantize_output), dataset,
+                         FLAGS.compare_batches)
+    report['comparison'] = comparison
+    for name in ['float', 'int8']:
+      print('%-5s top-1 %.4f top-5 %.4f %.2f ms/image' % (
+          name, comparison[name]['top1'], comparison[name]['top5'],
+          comparison[name]['ms_per_image']))
+    print('top-1 agreement %.4f over %d examples' % (
+        comparison['top1_agreement'], comparison['examples']))
+
+  if FLAGS.quantize_report:
+    with tf.gfile.GFile(FLAGS.quantize_report, 'w') as f:
+      json.dump(report, f)
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,384 @@
+"""Per-layer pruning sensitivity of a trained MobileNet V1.
+
+For every conv_pw layer and every sparsity of a grid, prunes that layer
+alone, the rest of the network dense, and measures top-1/top-5 accuracy on
+a fixed calibration subset of the validation set. The evaluations run on a
+pool of CPU processes, each holding one model, and every result is cached
+as JSON under (checkpoint hash, calibration set, layer, sparsity), so
+reruns with a finer grid or more layers only evaluate what is new.
+
+The result is a plan of the largest sparsity per layer whose accuracy drop
+stays within --max_accuracy_drop, to be passed as the layer_sparsity of
+channel_pruning.ChannelPruningCallback.
+
+The calibration subset comes from the evaluation cache when one exists
+(see build_eval_cache.py) and is otherwise decoded from records sampled
+through the shard index. Either way it is stored once as uint8 .npy files
+that the workers memory-map.
+
+Usage:
+  python sensitivity_analysis.py --checkpoint=checkpoints/model.h5 \\
+      --sensitivity_dir=sensitivity --sensitivity_plan=sparsity_plan.json
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+
+import numpy as np
+import tensorflow as tf
+
+import channel_pruning
+import channel_surgery
+import image_processing
+import mobilenet_v1
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('checkpoint', 'checkpoints/model.h5',
+                           """Trained Keras .h5 weights or TensorFlow """
+                           """checkpoint prefix to analyze.""")
+tf.app.flags.DEFINE_string('sensitivity_dir', 'sensitivity',
+                           """Directory of the calibration set and the """
+                           """cached results.""")
+tf.app.flags.DEFINE_string('sensitivity_plan', '',
+                           """Optional path of the JSON sparsity plan.""")
+tf.app.flags.DEFINE_string('sensitivity_layers', r'conv_pw_\d+$',
+                           """Regex of the layers to analyze.""")
+tf.app.flags.DEFINE_string('sensitivity_sparsities',
+                           '0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9',
+                           """Comma separated sparsity grid.""")
+tf.app.flags.DEFINE_string('sensitivity_granularity', 'channel',
+                           """Prune whole output 'channel's, ranked by """
+                           """--sensitivity_norm, or single 'weight's.""")
+tf.app.flags.DEFINE_string('sensitivity_norm', 'l1',
+                           """Channel ranking norm, 'l1' or 'l2'.""")
+tf.app.flags.DEFINE_integer('calibration_examples', 2000,
+                            """Number of validation examples evaluated.""")
+tf.app.flags.DEFINE_integer('calibration_seed', 0,
+                            """Seed of the calibration subset.""")
+tf.app.flags.DEFINE_integer('sensitivity_processes', 0,
+                            """Worker processes, 0 for one per 4 CPUs.""")
+tf.app.flags.DEFINE_float('max_accuracy_drop', 0.01,
+                          """Largest top-1 accuracy drop a layer's planned """
+                          """sparsity may cause.""")
+
+# Worker process state, set up once per process by _init_worker.
+_worker = {}
+
+
+def checkpoint_hash(checkpoint):
+  """Returns the SHA-1 of a model file or of the files of a checkpoint."""
+  if tf.gfile.IsDirectory(checkpoint):
+    checkpoint = tf.train.latest_checkpoint(checkpoint)
+  paths = [checkpoint] if tf.gfile.Exists(checkpoint) else sorted(
+      tf.gfile.Glob(checkpoint + '.index') +
+      tf.gfile.Glob(checkpoint + '.data-*'))
+  if not paths:
+    raise ValueError('No checkpoint files at %s' % checkpoint)
+  sha = hashlib.sha1()
+  for path in paths:
+    with tf.gfile.GFile(path, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        sha.update(block)
+  return sha.hexdigest()
+
+
+def calibration_set(dataset, output_dir, num_examples, seed=0,
+                    image_size=None):
+  """Writes a fixed calibration subset of a dataset as uint8 .npy files.
+
+  Images are preprocessed as in evaluation and quantized like the
+  evaluation cache, labels are shifted by --label_offset.
+
+  Args:
+    dataset: instance of Dataset class, usually the validation subset.
+    output_dir: string directory to write the subset into.
+    num_examples: integer size of the subset.
+    seed: integer seed of the examples drawn.
+    image_size: integer, None defaults to FLAGS.image_size.
+
+  Returns:
+    string path prefix of <prefix>.images.npy and <prefix>.labels.npy.
+  """
+  if image_size is None:
+    image_size = FLAGS.image_size
+  # The images depend on the preprocessing and the labels on the offset;
+  # the result cache of analyze() is keyed by this prefix as well.
+  prefix = os.path.join(
+      output_dir, 'calibration-%s-%s-%dpx%s-offset%d-%d-seed%d' % (
+          dataset.name, dataset.subset, image_size,
+          '-fused' if FLAGS.fused_decode_crop else '', FLAGS.label_offset,
+          num_examples, seed))
+  if os.path.exists(prefix + '.labels.npy'):
+    return prefix
+  tf.gfile.MakeDirs(output_dir)
+
+  cache_path = image_processing.eval_cache_path(dataset, image_size)
+  if cache_path and tf.gfile.Exists(cache_path):
+    cached_images, cached_labels = image_processing.load_eval_cache(
+        cache_path)
+    positions = np.sort(np.random.RandomState(seed).choice(
+        len(cached_labels), size=min(num_examples, len(cached_labels)),
+        replace=False))
+    images = cached_images[positions]
+    labels = cached_labels[positions]
+  else:
+    reader = dataset.indexed_reader()
+    positions = reader.sample(num_examples, seed)
+    with tf.Graph().as_default():
+      def _preprocess(example_serialized):
+        image_buffer, label, bbox, _ = image_processing.parse_example_proto(
+            example_serialized)
+        image = image_processing.image_preprocessing(image_buffer, bbox,
+                                                     train=False,
+                                                     image_size=image_size)
+        image = tf.round((image + 1.) * 127.5)
+        image = tf.cast(tf.clip_by_value(image, 0., 255.), tf.uint8)
+        return image, tf.reshape(label, [])
+
+      examples = tf.data.Dataset.from_generator(
+          lambda: reader.read(positions), tf.string, tf.TensorShape([]))
+      examples = examples.map(
+          _preprocess, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+      next_batch = examples.batch(256).make_one_shot_iterator().get_next()
+      batches = []
+      with tf.Session() as sess:
+        while True:
+          try:
+            batches.append(sess.run(next_batch))
+          except tf.errors.OutOfRangeError:
+            break
+    reader.close()
+    images = np.concatenate([b[0] for b in batches])
+    labels = np.concatenate([b[1] for b in batches])
+
+  np.save(prefix + '.images.npy', images)
+  # Written last, as it marks the calibration set complete.
+  np.save(prefix + '.labels.npy', labels.astype(np.int32) - FLAGS.label_offset)
+  return prefix
+
+
+def prune_weights(kernel, sparsity, granularity='channel', norm='l1'):
+  """Returns the kernel pruned to sparsity and its output channel mask.
+
+  Args:
+    kernel: NumPy array whose last axis is the output channel.
+    sparsity: float fraction of the channels or weights to remove.
+    granularity: 'channel' to zero the weakest whole output channels,
+      'weight' to zero the smallest magnitude weights.
+    norm: 'l1' or 'l2', the channel ranking norm.
+
+  Returns:
+    pruned kernel, and the float output channel mask or None for 'weight'.
+  """
+  if granularity == 'channel':
+    mask = channel_pruning.channel_mask(
+        kernel, int(round(sparsity * kernel.shape[-1])), norm)
+    return kernel * mask, mask
+  if granularity == 'weight':
+    num_pruned = int(round(sparsity * kernel.size))
+    pruned = kernel.copy().ravel()
+    pruned[np.argsort(np.abs(pruned), kind='mergesort')[:num_pruned]] = 0.
+    return pruned.reshape(kernel.shape), None
+  raise ValueError('Unknown pruning granularity %s' % granularity)
+
+
+def _init_worker(checkpoint, calibration_prefix, image_size, num_threads):
+  """Builds the model of a worker process and maps the calibration set."""
+  config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                          inter_op_parallelism_threads=1,
+                          device_count={'GPU': 0})
+  tf.keras.backend.set_session(tf.Session(config=config))
+  tf.keras.backend.set_learning_phase(0)
+  model = mobilenet_v1.MobileNetV1(input_shape=(image_size, image_size, 3))
+  channel_surgery.load_model_weights(model, checkpoint)
+  _worker['model'] = model
+  _worker['dense'] = channel_surgery.model_weights(model)
+  _worker['images'] = np.load(calibration_prefix + '.images.npy',
+                              mmap_mode='r')
+  _worker['labels'] = np.load(calibration_prefix + '.labels.npy')
+
+
+def _accuracy(batch_size=100):
+  """Returns the top-1 and top-5 accuracy of the worker model."""
+  model = _worker['model']
+  images = _worker['images']
+  labels = _worker['labels']
+  top1 = 0
+  top5 = 0
+  for start in range(0, len(labels), batch_size):
+    batch = images[start:start + batch_size].astype(np.float32) / 127.5 - 1.
+    predictions = model.predict_on_batch(batch)
+    batch_labels = labels[start:start + batch_size]
+    top = np.argsort(-predictions, axis=1)[:, :5]
+    top1 += int(np.sum(top[:, 0] == batch_labels))
+    top5 += int(np.sum(np.any(top == batch_labels[:, None], axis=1)))
+  return top1 / float(len(labels)), top5 / float(len(labels))
+
+
+def _evaluate(task):
+  """Evaluates the worker model with one layer pruned to one sparsity.
+
+  Args:
+    task: (layer_name, sparsity, granularity, norm); a layer_name of None
+      evaluates the dense model.
+
+  Returns:
+    dict of the task and its top1 and top5 accuracy.
+  """
+  layer_name, sparsity, granularity, norm = task
+  model = _worker['model']
+  dense = _worker['dense']
+  # (variable, pruned value, dense value) of every weight the task changes.
+  changes = []
+  if layer_name is not None:
+    layer = model.get_layer(name=layer_name)
+    dense_kernel = dense['%s/kernel' % layer_name]
+    kernel, mask = prune_weights(dense_kernel, sparsity, granularity, norm)
+    changes.append((layer.kernel, kernel, dense_kernel))
+    for bn_name in mobilenet_v1.channel_batch_norms(layer_name):
+      if mask is None or '%s/gamma' % bn_name not in dense:
+        continue
+      bn = model.get_layer(name=bn_name)
+      for weight, key in [(bn.gamma, 'gamma'), (bn.beta, 'beta')]:
+        value = dense['%s/%s' % (bn_name, key)]
+        changes.append((weight, value * mask, value))
+  tf.keras.backend.batch_set_value([(w, pruned) for w, pruned, _ in changes])
+  top1, top5 = _accuracy()
+  tf.keras.backend.batch_set_value([(w, value) for w, _, value in changes])
+  return {'layer': layer_name, 'sparsity': sparsity,
+          'granularity': granularity, 'norm': norm,
+          'top1': top1, 'top5': top5}
+
+
+def _result_path(result_dir, task):
+  layer_name, sparsity, granularity, norm = task
+  if layer_name is None:
+    return os.path.join(result_dir, 'dense.json')
+  return os.path.join(result_dir, '%s-%s-%s-%.4f.json' % (
+      layer_name, granularity, norm, sparsity))
+
+
+def analyze(checkpoint, calibration_prefix, layer_names, sparsities,
+            granularity='channel', norm='l1', result_dir=None,
+            num_processes=0, image_size=None):
+  """Evaluates every (layer, sparsity) pair not found in the result cache.
+
+  Args:
+    checkpoint: string .h5 weights or checkpoint prefix.
+    calibration_prefix: string returned by calibration_set().
+    layer_names: list of the layers to prune, one at a time.
+    sparsities: list of float sparsities.
+    granularity: 'channel' or 'weight', see prune_weights().
+    norm: 'l1' or 'l2' channel ranking norm.
+    result_dir: string directory of the cached results of this checkpoint
+      and calibration set.
+    num_processes: integer number of worker processes, 0 for one per 4
+      CPUs.
+    image_size: integer, None defaults to FLAGS.image_size.
+
+  Returns:
+    dense: result dict of the unpruned model.
+    results: list of result dicts, one per (layer, sparsity).
+  """
+  if image_size is None:
+    image_size = FLAGS.image_size
+  tf.gfile.MakeDirs(result_dir)
+  tasks = [(None, 0., granularity, norm)] + [
+      (layer_name, float(sparsity), granularity, norm)
+      for layer_name in layer_names for sparsity in sparsities]
+  results = {}
+  for task in tasks:
+    path = _result_path(result_dir, task)
+    if tf.gfile.Exists(path):
+      with tf.gfile.GFile(path, 'r') as f:
+        results[task] = json.load(f)
+  pending = [task for task in tasks if task not in results]
+  tf.logging.info('%d of %d evaluations cached, %d to run',
+                  len(tasks) - len(pending), len(tasks), len(pending))
+
+  if pending:
+    cpus = multiprocessing.cpu_count()
+    num_processes = min(num_processes or max(cpus // 4, 1), len(pending))
+    num_threads = max(cpus // num_processes, 1)
+    # TensorFlow is not fork safe once initialized, so workers are spawned.
+    pool = multiprocessing.get_context('spawn').Pool(
+        num_processes, initializer=_init_worker,
+        initargs=(checkpoint, calibration_prefix, image_size, num_threads))
+    try:
+      for task, result in zip(pending, pool.imap(_evaluate, pending)):
+        with tf.gfile.GFile(_result_path(result_dir, task), 'w') as f:
+          json.dump(result, f)
+        results[task] = result
+        tf.logging.info('%s sparsity %.2f: top-1 %.4f', task[0] or 'dense',
+                        task[1], result['top1'])
+    finally:
+      pool.close()
+      pool.join()
+
+  return results[tasks[0]], [results[task] for task in tasks[1:]]
+
+
+def sparsity_plan(dense, results, max_accuracy_drop):
+  """Returns the largest sparsity of each layer within the accuracy budget.
+
+  Args:
+    dense: result dict of the unpruned model.
+    results: list of result dicts of analyze().
+    max_accuracy_drop: float, largest allowed drop in top-1 accuracy.
+
+  Returns:
+    dict of layer name to float sparsity, 0. if no grid sparsity fits.
+  """
+  plan = {}
+  for result in results:
+    layer_name = result['layer']
+    plan.setdefault(layer_name, 0.)
+    if (dense['top1'] - result['top1'] <= max_accuracy_drop and
+        result['sparsity'] > plan[layer_name]):
+      plan[layer_name] = result['sparsity']
+  return plan
+
+
+def main(unused_argv=None):
+  from imagenet_data import ImagenetData
+  dataset = ImagenetData(subset='validation')
+  calibration_prefix = calibration_set(
+      dataset, FLAGS.sensitivity_dir, FLAGS.calibration_examples,
+      FLAGS.calibration_seed)
+  layer_names = [name for name in mobilenet_v1.pointwise_layer_names()
+                 if re.match(FLAGS.sensitivity_layers, name)]
+  result_dir = os.path.join(FLAGS.sensitivity_dir,
+                            checkpoint_hash(FLAGS.checkpoint),
+                            os.path.basename(calibration_prefix))
+  sparsities = [float(s) for s in FLAGS.sensitivity_sparsities.split(',')]
+  dense, results = analyze(
+      FLAGS.checkpoint, calibration_prefix, layer_names, sparsities,
+      FLAGS.sensitivity_granularity, FLAGS.sensitivity_norm, result_dir,
+      FLAGS.sensitivity_processes)
+  plan = sparsity_plan(dense, results, FLAGS.max_accuracy_drop)
+
+  print('dense: top-1 %.4f, top-5 %.4f' % (dense['top1'], dense['top5']))
+  for layer_name in layer_names:
+    accuracies = ' '.join('%.2f:%.4f' % (r['sparsity'], r['top1'])
+                          for r in results if r['layer'] == layer_name)
+    print('%-12s plan %.2f  %s' % (layer_name, plan[layer_name],
+                                   accuracies))
+  if FLAGS.sensitivity_plan:
+    with tf.gfile.GFile(FLAGS.sensitivity_plan, 'w') as f:
+      json.dump({'checkpoint': FLAGS.checkpoint,
+                 'max_accuracy_drop': FLAGS.max_accuracy_drop,
+                 'granularity': FLAGS.sensitivity_granularity,
+                 'dense': dense,
+                 'layer_sparsity': plan,
+                 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,358 @@
+"""Multiprocess JPEG loader writing batches into shared memory.
+
+A drop-in replacement for ImageDataGenerator.flow_from_directory on the
+raw-data layout (one subdirectory of images per class). Images are decoded
+with PIL, resized, and scaled to [-1, 1] by a pool of worker processes,
+which write each batch directly into a slot of a ring of preallocated
+shared-memory buffers:
+
+  images  float32 [num_slots, batch_size, image_size, image_size, 3]
+  labels  float32 [num_slots, batch_size, num_classes], one-hot
+
+The trainer gets NumPy views of a slot, so no batch is ever pickled or
+copied between processes, and the decoding runs outside the GIL of the
+training process. A slot is returned to the workers when the next batch is
+requested; with fit_generator(loader.flow(), ..., workers=0) a batch is
+consumed before the next one is requested.
+
+Only batches that have a free slot are dispatched, so at most num_slots
+batches are decoded ahead of the trainer. With ordered=True batches are
+yielded in dispatch order, which with a fixed seed makes the sequence of
+batches reproducible; with ordered=False they are yielded as soon as any
+worker finishes one. Each worker counts its images, batches and busy time.
+
+Usage:
+  python shm_loader.py --loader_dir=/tf/workspace/imagenet/raw-data/train \\
+      --loader_workers=8 --loader_batches=200
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+_INTERPOLATIONS = {'nearest': Image.NEAREST, 'bilinear': Image.BILINEAR,
+                   'bicubic': Image.BICUBIC}
+
+# Per-worker counters: images, batches and busy seconds.
+_COUNTERS = 3
+
+# Default cap on the workers; each default worker adds two batch slots of
+# shared memory (19 MB each for 32 images of 224x224).
+MAX_DEFAULT_WORKERS = 8
+
+
+def list_images(directory):
+  """Lists the images of a directory with one subdirectory per class.
+
+  Classes are indexed in sorted order of their subdirectories, like
+  flow_from_directory.
+
+  Returns:
+    paths: list of image paths.
+    labels: int32 NumPy array of class indices.
+    class_names: list of the class subdirectory names.
+  """
+  class_names = sorted(name for name in os.listdir(directory)
+                       if os.path.isdir(os.path.join(directory, name)))
+  paths = []
+  labels = []
+  for label, name in enumerate(class_names):
+    class_dir = os.path.join(directory, name)
+    for filename in sorted(os.listdir(class_dir)):
+      if filename.lower().endswith(IMAGE_EXTENSIONS):
+        paths.append(os.path.join(class_dir, filename))
+        labels.append(label)
+  return paths, np.array(labels, dtype=np.int32), class_names
+
+
+def _views(buffers, config):
+  """Returns NumPy views of the shared image, label and size buffers."""
+  images, labels, sizes = buffers
+  size = config['image_size']
+  return (np.frombuffer(images, dtype=np.float32).reshape(
+              config['num_slots'], config['batch_size'], size, size, 3),
+          np.frombuffer(labels, dtype=np.float32).reshape(
+              config['num_slots'], config['batch_size'],
+              config['num_classes']),
+          np.frombuffer(sizes, dtype=np.int32))
+
+
+def _load_image(path, out, config):
+  """Decodes, resizes and scales one image into out."""
+  image = Image.open(path)
+  size = config['image_size']
+  if config['draft']:
+    # Let the JPEG decoder downscale by up to 8x while decoding.
+    image.draft('RGB', (size, size))
+  image = image.convert('RGB')
+  if image.size != (size, size):
+    image = image.resize((size, size), _INTERPOLATIONS[config['interpolation']])
+  np.multiply(np.asarray(image), 1. / 127.5, out=out, casting='unsafe')
+  out -= 1.
+
+
+def _worker(worker_id, config, buffers, counters, tasks, ready):
+  """Fills the slots of batch tasks until told to stop."""
+  images, labels, sizes = _views(buffers, config)
+  counts = np.frombuffer(counters, dtype=np.float64).reshape(-1, _COUNTERS)
+  while True:
+    task = tasks.get()
+    if task is None:
+      break
+    batch_id, slot, paths, batch_labels = task
+    start_time = time.time()
+    try:
+      for i, path in enumerate(paths):
+        _load_image(path, images[slot, i], config)
+      labels[slot] = 0.
+      labels[slot, np.arange(len(batch_labels)), batch_labels] = 1.
+      sizes[slot] = len(paths)
+    except Exception:
+      ready.put(('error', worker_id, batch_id, slot, traceback.format_exc()))
+      continue
+    # Only this worker writes its row, so no lock is needed.
+    counts[worker_id] += (len(paths), 1, time.time() - start_time)
+    ready.put(('done', worker_id, batch_id, slot, None))
+
+
+class SharedMemoryLoader(object):
+  """Yields (images, one-hot labels) batches decoded by worker processes."""
+
+  def __init__(self, directory, batch_size=32, image_size=224,
+               num_workers=None, num_slots=None, shuffle=True, seed=None,
+               ordered=True, interpolation='nearest', draft=False):
+    """Starts the workers and dispatches the first batches.
+
+    Args:
+      directory: string directory with one subdirectory of images per class.
+      batch_size: integer batch size; the last batch of an epoch may be
+        smaller.
+      image_size: integer height and width the images are resized to.
+      num_workers: integer worker processes, defaults to the usable cores,
+        at most MAX_DEFAULT_WORKERS.
+      num_slots: integer shared-memory batch buffers, defaults to twice the
+        workers; bounds the batches decoded ahead of the trainer.
+      shuffle: boolean, reshuffle the images every epoch.
+      seed: integer seed of the shuffling, None for a random one.
+      ordered: boolean, yield batches in dispatch order instead of in
+        completion order.
+      interpolation: string resize filter, 'nearest' as Keras by default,
+        'bilinear' or 'bicubic'.
+      draft: boolean, let PIL decode JPEGs at a reduced scale that is still
+        at least image_size; much faster, slightly different pixels.
+    """
+    if interpolation not in _INTERPOLATIONS:
+      raise ValueError('Unknown interpolation %s' % interpolation)
+    self.paths, self.labels, self.class_names = list_images(directory)
+    if not self.paths:
+      raise ValueError('No images found in %s' % directory)
+    num_workers = num_workers or min(len(os.sched_getaffinity(0)),
+                                     MAX_DEFAULT_WORKERS)
+    num_slots = num_slots or 2 * num_workers
+    self.batch_size = batch_size
+    self.ordered = ordered
+    self._shuffle = shuffle
+    self._random = np.random.RandomState(seed)
+    self._config = {'batch_size': batch_size, 'image_size': image_size,
+                    'num_slots': num_slots,
+                    'num_classes': len(self.class_names),
+                    'interpolation': interpolation, 'draft': draft}
+
+    # PIL is fork safe, but the trainer may already run TensorFlow.
+    context = multiprocessing.get_context('spawn')
+    self._buffers = (
+        context.RawArray('f', num_slots * batch_size * image_size *
+                         image_size * 3),
+        context.RawArray('f', num_slots * batch_size *
+                         len(self.class_names)),
+        context.RawArray('i', num_slots))
+    self._images, self._labels, self._sizes = _views(self._buffers,
+                                                     self._config)
+    self._counters = context.RawArray('d', num_workers * _COUNTERS)
+    self._tasks = context.Queue()
+    self._ready = context.Queue()
+    self._workers = [
+        context.Process(target=_worker,
+                        args=(i, self._config, self._buffers, self._counters,
+                              self._tasks, self._ready))
+        for i in range(num_workers)]
+    for worker in self._workers:
+      worker.daemon = True
+      worker.start()
+
+    self._batches = self._batch_indices()
+    self._next_batch_id = 0
+    self._next_yield_id = 0
+    self._finished = {}
+    self._held_slot = None
+    self._start_time = time.time()
+    self.wait_seconds = 0.
+    for slot in range(num_slots):
+      self._dispatch(slot)
+
+  def __len__(self):
+    """Returns the number of batches per epoch."""
+    return -(-len(self.paths) // self.batch_size)
+
+  def _batch_indices(self):
+    """Yields the image indices of every batch, epoch after epoch."""
+    while True:
+      order = (self._random.permutation(len(self.paths)) if self._shuffle
+               else np.arange(len(self.paths)))
+      for start in range(0, len(order), self.batch_size):
+        yield order[start:start + self.batch_size]
+
+  def _dispatch(self, slot):
+    indices = next(self._batches)
+    self._tasks.put((self._next_batch_id, slot,
+                     [self.paths[i] for i in indices], self.labels[indices]))
+    self._next_batch_id += 1
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    """Returns views of the next batch, valid until the next call."""
+    if self._held_slot is not None:
+      self._dispatch(self._held_slot)
+      self._held_slot = None
+    start_time = time.time()
+    while True:
+      if self.ordered and self._next_yield_id in self._finished:
+        slot = self._finished.pop(self._next_yield_id)
+        break
+      kind, worker_id, batch_id, slot, message = self._ready.get()
+      if kind == 'error':
+        raise RuntimeError('Worker %d failed on batch %d:\n%s' % (
+            worker_id, batch_id, message))
+      if not self.ordered:
+        break
+      self._finished[batch_id] = slot
+    self.wait_seconds += time.time() - start_time
+    self._next_yield_id += 1
+    self._held_slot = slot
+    size = self._sizes[slot]
+    return self._images[slot, :size], self._labels[slot, :size]
+
+  def flow(self):
+    """Returns an endless generator of the batches, for fit_generator.
+
+    Keras only recognizes generators and Sequences as generator input, not
+    plain iterators such as the loader itself.
+    """
+    while True:
+      yield next(self)
+
+  def stats(self):
+    """Returns the throughput of the loader and of each worker.
+
+    Returns:
+      dict with the batches yielded, the seconds the consumer waited for
+      them, and per worker its images, batches, busy seconds and
+      images_per_sec while busy.
+    """
+    counts = np.frombuffer(self._counters, dtype=np.float64).reshape(
+        -1, _COUNTERS)
+    workers = []
+    for images, batches, seconds in counts.tolist():
+      workers.append({'images': int(images), 'batches': int(batches),
+                      'seconds': seconds,
+                      'images_per_sec': images / max(seconds, 1e-9)})
+    return {'batches': self._next_yield_id,
+            'wall_seconds': time.time() - self._start_time,
+            'wait_seconds': self.wait_seconds, 'workers': workers}
+
+  def close(self):
+    for _ in self._workers:
+      self._tasks.put(None)
+    for worker in self._workers:
+      worker.join(timeout=10)
+      if worker.is_alive():
+        worker.terminate()
+    self._workers = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+
+def main(unused_argv=None):
+  FLAGS = tf.app.flags.FLAGS
+  with SharedMemoryLoader(FLAGS.loader_dir, FLAGS.batch_size,
+                          FLAGS.image_size, FLAGS.loader_workers or None,
+                          FLAGS.loader_slots or None,
+                          seed=FLAGS.loader_seed,
+                          ordered=FLAGS.loader_ordered,
+                          interpolation=FLAGS.loader_interpolation,
+                          draft=FLAGS.loader_draft) as loader:
+    # The first batches include the worker start up.
+    for _ in range(min(FLAGS.loader_batches, 10)):
+      next(loader)
+    start_time = time.time()
+    wait_before = loader.wait_seconds
+    images = 0
+    for _ in range(FLAGS.loader_batches):
+      images += len(next(loader)[0])
+    seconds = time.time() - start_time
+    stats = loader.stats()
+  print('%d images in %.1f s: %.1f images/sec, consumer waited %.1f s' % (
+      images, seconds, images / seconds, stats['wait_seconds'] - wait_before))
+  for i, worker in enumerate(stats['workers']):
+    print('worker %d: %d images, %.1f images/sec while busy' % (
+        i, worker['images'], worker['images_per_sec']))
+
+  if FLAGS.loader_compare:
+    from keras.preprocessing.image import ImageDataGenerator
+    datagen = ImageDataGenerator(rescale=1. / 127.5,
+                                 preprocessing_function=lambda x: x - 1)
+    flow = datagen.flow_from_directory(
+        FLAGS.loader_dir, (FLAGS.image_size, FLAGS.image_size),
+        batch_size=FLAGS.batch_size, seed=FLAGS.loader_seed)
+    start_time = time.time()
+    images = 0
+    for _ in range(FLAGS.loader_batches):
+      images += len(next(flow)[0])
+    seconds = time.time() - start_time
+    print('ImageDataGenerator in the main thread: %.1f images/sec' % (
+        images / seconds))
+
+
+if __name__ == '__main__':
+  # Only here: the spawned workers re-import this module and need neither
+  # TensorFlow nor the flags.
+  import tensorflow as tf
+  # Defines --batch_size and --image_size.
+  import image_processing
+  tf.app.flags.DEFINE_string('loader_dir', '',
+                             """Directory with one subdirectory of images """
+                             """per class.""")
+  tf.app.flags.DEFINE_integer('loader_workers', 0,
+                              """Decoding processes, 0 for one per core.""")
+  tf.app.flags.DEFINE_integer('loader_slots', 0,
+                              """Shared-memory batch buffers, 0 for two per """
+                              """worker.""")
+  tf.app.flags.DEFINE_integer('loader_batches', 200,
+                              """Batches to time.""")
+  tf.app.flags.DEFINE_integer('loader_seed', 0, """Shuffling seed.""")
+  tf.app.flags.DEFINE_boolean('loader_ordered', True,
+                              """Yield batches in dispatch order.""")
+  tf.app.flags.DEFINE_string('loader_interpolation', 'nearest',
+                             """Resize filter: nearest, bilinear or """
+                             """bicubic.""")
+  tf.app.flags.DEFINE_boolean('loader_draft', False,
+                              """Decode JPEGs at a reduced scale.""")
+  tf.app.flags.DEFINE_boolean('loader_compare', False,
+                              """Also time ImageDataGenerator in the main """
+                              """thread.""")
+  tf.app.run(main)
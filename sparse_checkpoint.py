@@ -0,0 +1,359 @@
+"""Compressed checkpoint format for pruned models.
+
+A TensorFlow checkpoint stores a pruned kernel as a dense float32 tensor,
+half of it zeros. A sparse checkpoint stores every tensor in the smallest of
+three encodings:
+
+  dense:    all values.
+  elements: a bitmask of the nonzero elements (np.packbits, one bit per
+            element) and the nonzero values in C order.
+  channels: a bitmask of the nonzero output channels (last axis) and the
+            values of those channels; a kernel pruned by whole channels
+            costs almost only its kept channels.
+
+Kernels (tensors of rank 2 or more) can be stored as float16, or as int8
+with one symmetric scale per output channel; other tensors, e.g. batch norm
+statistics, are always kept in their own dtype. The channels of depthwise
+kernels [height, width, in, multiplier] are their input channels (axis 2).
+
+File layout:
+  8 bytes   MAGIC
+  8 bytes   little-endian uint64 length of the JSON header
+  header    JSON: version and, per tensor, its shape, dtype, encoding,
+            stored dtype and the offsets and sizes of its blobs
+  blobs     each aligned to ALIGNMENT bytes, offsets relative to the first
+
+SparseCheckpointReader memory-maps the file and decodes a tensor only when
+it is requested, with the interface of tf.train.NewCheckpointReader.
+
+Usage:
+  python sparse_checkpoint.py --sparse_input=checkpoints/pruned_model.ckpt \\
+      --sparse_output=checkpoints/pruned_model.sparse --sparse_dtype=float16
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import mmap
+import re
+import struct
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import channel_surgery
+import mobilenet_v1
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('sparse_input', 'checkpoints/pruned_model.ckpt',
+                           """Checkpoint prefix or Keras .h5 file to """
+                           """convert.""")
+tf.app.flags.DEFINE_string('sparse_output', '',
+                           """Path of the sparse checkpoint, defaults to """
+                           """<input>.sparse.""")
+tf.app.flags.DEFINE_string('sparse_dtype', 'float32',
+                           """Stored dtype of the kernels: float32, """
+                           """float16 or int8.""")
+tf.app.flags.DEFINE_string('sparse_skip_regex',
+                           r'/Adam(_\d+)?$|^beta\d_power$|^training/|'
+                           r'^iterations$|^global_step$|/mask$|'
+                           r'/threshold$|/pruning_step$',
+                           """Variables, by default optimizer slots and """
+                           """pruning masks, not to store.""")
+
+MAGIC = b'SPARSECK'
+VERSION = 1
+ALIGNMENT = 64
+
+KERNEL_DTYPES = ('float32', 'float16', 'int8')
+
+
+def _align(offset):
+  return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def channel_axis(name, value):
+  """Returns the channel axis of a weight tensor, 2 for depthwise kernels."""
+  if 'depthwise_kernel' in name and np.ndim(value) == 4:
+    return 2
+  return -1
+
+
+def _quantize(value, dtype):
+  """Returns the stored values of a kernel and its per-channel scales."""
+  if dtype == 'int8':
+    channel_max = np.abs(value.reshape(-1, value.shape[-1])).max(axis=0)
+    scales = np.where(channel_max > 0, channel_max / 127., 1.).astype(
+        np.float32)
+    return np.round(value / scales).astype(np.int8), scales
+  return value.astype(dtype), None
+
+
+def _encodings(value):
+  """Returns the candidate (encoding, blobs) of a stored tensor value."""
+  flat = value.ravel()
+  nonzero = flat != 0
+  candidates = [('dense', {'values': flat})]
+  candidates.append(('elements', {'mask': np.packbits(nonzero),
+                                  'values': flat[nonzero]}))
+  if value.ndim >= 2:
+    channels = value.reshape(-1, value.shape[-1])
+    kept = np.any(channels != 0, axis=0)
+    candidates.append(('channels', {'mask': np.packbits(kept),
+                                    'values': channels[:, kept].ravel()}))
+  return candidates
+
+
+def encode(value, dtype='float32', axis=-1):
+  """Encodes one tensor in its smallest encoding.
+
+  Args:
+    value: NumPy array.
+    dtype: stored dtype of tensors of rank 2 or more, one of KERNEL_DTYPES.
+    axis: integer channel axis of the int8 scales and the channels
+      encoding, see channel_axis().
+
+  Returns:
+    entry: dict of the header entry of the tensor, without blob offsets.
+    blobs: dict of blob name to NumPy array.
+  """
+  value = np.asarray(value)
+  scales = None
+  # Channels are stored along the last axis.
+  stored = np.moveaxis(value, axis, -1) if value.ndim >= 2 else value
+  if value.ndim >= 2 and value.dtype.kind == 'f':
+    stored, scales = _quantize(stored, dtype)
+  encoding, blobs = min(_encodings(stored),
+                        key=lambda c: sum(b.nbytes for b in c[1].values()))
+  if scales is not None:
+    blobs['scales'] = scales
+  entry = {'shape': list(value.shape), 'dtype': value.dtype.name,
+           'stored_dtype': stored.dtype.name, 'encoding': encoding}
+  if value.ndim >= 2:
+    entry['channel_axis'] = axis % value.ndim
+  return entry, blobs
+
+
+def decode(entry, blobs):
+  """Returns a new NumPy array of a tensor from its header entry and blobs."""
+  axis = entry.get('channel_axis', -1)
+  # The shape of the stored values, channels last.
+  shape = list(entry['shape'])
+  if len(shape) >= 2:
+    shape.append(shape.pop(axis))
+  stored_dtype = np.dtype(entry['stored_dtype'])
+  size = int(np.prod(shape))
+  values = blobs['values']
+  if entry['encoding'] == 'dense':
+    stored = values.reshape(shape)
+  elif entry['encoding'] == 'elements':
+    mask = np.unpackbits(blobs['mask'])[:size].astype(bool)
+    stored = np.zeros(size, dtype=stored_dtype)
+    stored[mask] = values
+    stored = stored.reshape(shape)
+  else:
+    channels = shape[-1]
+    kept = np.unpackbits(blobs['mask'])[:channels].astype(bool)
+    stored = np.zeros((size // channels, channels), dtype=stored_dtype)
+    stored[:, kept] = values.reshape(size // channels, -1)
+    stored = stored.reshape(shape)
+  if 'scales' in blobs:
+    stored = stored * blobs['scales']
+  if len(shape) >= 2:
+    stored = np.moveaxis(stored, -1, axis)
+  # Always a copy: dense values are views of the reader's memory map, which
+  # could not be closed while they exist.
+  return np.array(stored, dtype=entry['dtype'], order='C')
+
+
+def save(weights, path, dtype='float32', skip_regex=''):
+  """Writes a dict of weights as a sparse checkpoint.
+
+  Args:
+    weights: dict of weight name to NumPy value, e.g.
+      channel_surgery.model_weights(model) or checkpoint_weights(path).
+    path: string path of the sparse checkpoint.
+    dtype: stored dtype of the kernels, one of KERNEL_DTYPES.
+    skip_regex: weights whose names match this regex are not stored.
+
+  Returns:
+    integer size of the written file in bytes.
+  """
+  if dtype not in KERNEL_DTYPES:
+    raise ValueError('Unsupported sparse checkpoint dtype %s' % dtype)
+  tensors = {}
+  blob_list = []
+  offset = 0
+  for name in sorted(weights):
+    if skip_regex and re.search(skip_regex, name):
+      continue
+    if np.asarray(weights[name]).dtype.kind not in 'biuf':
+      tf.logging.warning('Not storing non-numeric tensor %s', name)
+      continue
+    entry, blobs = encode(weights[name], dtype,
+                          channel_axis(name, weights[name]))
+    entry['blobs'] = {}
+    for blob_name in sorted(blobs):
+      blob = np.ascontiguousarray(blobs[blob_name])
+      entry['blobs'][blob_name] = {'offset': offset, 'nbytes': blob.nbytes,
+                                   'dtype': blob.dtype.name}
+      blob_list.append((offset, blob))
+      offset = _align(offset + blob.nbytes)
+    tensors[name] = entry
+
+  header = json.dumps({'version': VERSION, 'tensors': tensors},
+                      sort_keys=True).encode('utf-8')
+  data_start = _align(len(MAGIC) + 8 + len(header))
+  tmp_path = path + '.tmp'
+  with tf.gfile.GFile(tmp_path, 'wb') as f:
+    f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+    position = len(MAGIC) + 8 + len(header)
+    for blob_offset, blob in blob_list:
+      f.write(b'\0' * (data_start + blob_offset - position))
+      f.write(blob.tobytes())
+      position = data_start + blob_offset + blob.nbytes
+  tf.gfile.Rename(tmp_path, path, overwrite=True)
+  return position
+
+
+class SparseCheckpointReader(object):
+  """Reads the tensors of a sparse checkpoint lazily from a memory map.
+
+  Offers get_tensor, has_tensor, get_variable_to_shape_map and
+  get_variable_to_dtype_map like the reader of tf.train.NewCheckpointReader.
+  """
+
+  def __init__(self, path):
+    self._file = open(path, 'rb')
+    self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    if self._map[:len(MAGIC)] != MAGIC:
+      raise ValueError('%s is not a sparse checkpoint' % path)
+    header_bytes, = struct.unpack_from('<Q', self._map, len(MAGIC))
+    start = len(MAGIC) + 8
+    header = json.loads(self._map[start:start + header_bytes].decode('utf-8'))
+    if header['version'] != VERSION:
+      raise ValueError('%s is a version %d sparse checkpoint, expected %d' %
+                       (path, header['version'], VERSION))
+    self._tensors = header['tensors']
+    self._data_start = _align(start + header_bytes)
+
+  def has_tensor(self, name):
+    return name in self._tensors
+
+  def get_variable_to_shape_map(self):
+    return {name: entry['shape'] for name, entry in self._tensors.items()}
+
+  def get_variable_to_dtype_map(self):
+    return {name: tf.as_dtype(entry['dtype'])
+            for name, entry in self._tensors.items()}
+
+  def encoding(self, name):
+    """Returns the encoding a tensor is stored in."""
+    return self._tensors[name]['encoding']
+
+  def get_tensor(self, name):
+    """Decodes and returns the NumPy value of one tensor."""
+    entry = self._tensors[name]
+    blobs = {}
+    for blob_name, blob in entry['blobs'].items():
+      dtype = np.dtype(blob['dtype'])
+      # A view of the mapping; only decode() copies.
+      blobs[blob_name] = np.frombuffer(
+          self._map, dtype=dtype, count=blob['nbytes'] // dtype.itemsize,
+          offset=self._data_start + blob['offset'])
+    return decode(entry, blobs)
+
+  def weights(self):
+    """Returns a dict of every tensor name to its decoded value."""
+    return {name: self.get_tensor(name) for name in self._tensors}
+
+  def close(self):
+    self._map.close()
+    self._file.close()
+
+
+def save_model(model, path, dtype='float32'):
+  """Writes the weights of a Keras model as a sparse checkpoint."""
+  return save(channel_surgery.model_weights(model), path, dtype)
+
+
+def restore(model, path):
+  """Restores a sparse checkpoint into a Keras model of matching shapes."""
+  reader = SparseCheckpointReader(path)
+  try:
+    channel_surgery.set_model_weights(model, reader.weights())
+  finally:
+    reader.close()
+
+
+def load_model(path, surgery=False, **kwargs):
+  """Builds a MobileNetV1 and restores a sparse checkpoint into it.
+
+  Args:
+    path: string path of a sparse checkpoint of a MobileNet.
+    surgery: if True, the all-zero conv_pw channels are removed and the
+      surgered model is returned, see channel_surgery.operate().
+    **kwargs: further arguments of mobilenet_v1.MobileNetV1.
+
+  Returns:
+    tf.keras.Model
+  """
+  reader = SparseCheckpointReader(path)
+  try:
+    weights = reader.weights()
+  finally:
+    reader.close()
+  plan = channel_surgery.plan_surgery(weights)
+  if surgery:
+    return channel_surgery.operate(weights, plan, **kwargs)
+  model = mobilenet_v1.MobileNetV1(
+      mobilenet_v1.pointwise_filters_from_widths(plan.num_channels), **kwargs)
+  channel_surgery.set_model_weights(model, weights)
+  return model
+
+
+def _checkpoint_bytes(path):
+  if path.endswith('.h5') or path.endswith('.hdf5'):
+    return tf.gfile.Stat(path).length
+  return sum(tf.gfile.Stat(p).length for p in
+             tf.gfile.Glob(path + '.index') + tf.gfile.Glob(path + '.data-*'))
+
+
+def main(unused_argv=None):
+  source = FLAGS.sparse_input
+  if tf.gfile.IsDirectory(source):
+    source = tf.train.latest_checkpoint(source)
+  output = FLAGS.sparse_output or source + '.sparse'
+  if source.endswith('.h5') or source.endswith('.hdf5'):
+    model = mobilenet_v1.MobileNetV1()
+    model.load_weights(source, by_name=True)
+    weights = channel_surgery.model_weights(model)
+  else:
+    weights = channel_surgery.checkpoint_weights(source)
+  size = save(weights, output, FLAGS.sparse_dtype, FLAGS.sparse_skip_regex)
+
+  start_time = time.time()
+  reader = SparseCheckpointReader(output)
+  decoded = reader.weights()
+  load_seconds = time.time() - start_time
+  max_error = max(float(np.abs(decoded[name] - weights[name]).max())
+                  for name in decoded if decoded[name].dtype.kind == 'f')
+  encodings = {}
+  for name in decoded:
+    encoding = reader.encoding(name)
+    encodings[encoding] = encodings.get(encoding, 0) + 1
+  reader.close()
+  print('%s: %.2f MB -> %s: %.2f MB (%s), loaded in %.3f s, '
+        'max abs error %.2e' % (
+            source, _checkpoint_bytes(source) / 2.**20, output,
+            size / 2.**20, ', '.join('%d %s' % (count, encoding)
+                                     for encoding, count in
+                                     sorted(encodings.items())),
+            load_seconds, max_error))
+
+
+if __name__ == '__main__':
+  tf.app.run()
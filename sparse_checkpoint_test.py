@@ -0,0 +1,62 @@
+"""Tests of the sparse checkpoint format."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import tensorflow as tf
+
+import sparse_checkpoint
+
+
+class SparseCheckpointTest(tf.test.TestCase):
+
+  def _weights(self):
+    rng = np.random.RandomState(0)
+    kernel = rng.normal(size=(1, 1, 8, 16)).astype(np.float32)
+    kernel[..., ::2] = 0.
+    return {'conv_pw_1/kernel': kernel,
+            'conv_pw_1_bn/gamma': rng.normal(size=16).astype(np.float32),
+            'conv_pw_1_bn/moving_mean': np.zeros(16, dtype=np.float32)}
+
+  def testRoundTripAndClose(self):
+    weights = self._weights()
+    for dtype, tolerance in [('float32', 0.), ('float16', 1e-2),
+                             ('int8', 5e-2)]:
+      path = os.path.join(self.get_temp_dir(), 'model_%s.sparse' % dtype)
+      sparse_checkpoint.save(weights, path, dtype)
+      reader = sparse_checkpoint.SparseCheckpointReader(path)
+      decoded = reader.weights()
+      # Fails with a BufferError if a decoded value still views the map.
+      reader.close()
+      self.assertEqual(sorted(decoded), sorted(weights))
+      for name, value in weights.items():
+        self.assertEqual(decoded[name].dtype, value.dtype)
+        self.assertAllClose(decoded[name], value, atol=tolerance)
+
+  def testDepthwiseKernelChannels(self):
+    rng = np.random.RandomState(0)
+    # Input channels of very different ranges, two of them pruned.
+    kernel = rng.normal(size=(3, 3, 8, 1)) * np.logspace(-3, 1, 8)[:, None]
+    kernel[:, :, [1, 5]] = 0.
+    weights = {'conv_dw_1/depthwise_kernel': kernel.astype(np.float32)}
+    path = os.path.join(self.get_temp_dir(), 'depthwise.sparse')
+    sparse_checkpoint.save(weights, path, 'int8')
+    reader = sparse_checkpoint.SparseCheckpointReader(path)
+    self.assertEqual(reader.encoding('conv_dw_1/depthwise_kernel'),
+                     'channels')
+    decoded = reader.get_tensor('conv_dw_1/depthwise_kernel')
+    reader.close()
+    self.assertEqual(decoded.shape, kernel.shape)
+    for channel in range(8):
+      value = weights['conv_dw_1/depthwise_kernel'][:, :, channel]
+      # At most half a step of the channel's own int8 scale.
+      tolerance = np.abs(value).max() / 127. / 2. * 1.001
+      self.assertAllClose(decoded[:, :, channel], value, rtol=0.,
+                          atol=tolerance)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -0,0 +1,183 @@
+"""Weight sparsity report of checkpoints, read tensor by tensor.
+
+Reads a TensorFlow checkpoint (.index/.data) such as
+checkpoints/pruned_model.ckpt through a CheckpointReader, one tensor at a
+time, without building the model or a session. For every weight tensor it
+reports the zero fraction, L1/L2 norms and, for kernels, the zero fraction
+and L2 norm of each output channel: the last axis, or the input channel
+axis 2 of depthwise kernels [height, width, in, multiplier]. A histogram of
+all weight values is accumulated over fixed bins as the tensors stream by,
+so memory is bounded by the largest tensor.
+
+Usage:
+  python sparsity_report.py --checkpoints=checkpoints/pruned_model.ckpt \\
+      --report_dir=reports
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import re
+
+import numpy as np
+import tensorflow as tf
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('checkpoints', 'checkpoints/pruned_model.ckpt',
+                           """Comma separated checkpoint prefixes or """
+                           """directories to analyze.""")
+tf.app.flags.DEFINE_string('report_dir', '',
+                           """Directory to write <checkpoint>.sparsity.json """
+                           """reports into; only printed if empty.""")
+tf.app.flags.DEFINE_string('variable_regex', '',
+                           """Only analyze variables matching this regex.""")
+tf.app.flags.DEFINE_string('skip_regex',
+                           r'/Adam(_\d+)?$|^beta\d_power$|^training/|'
+                           r'^iterations$|^global_step$',
+                           """Skip variables, by default optimizer slots, """
+                           """matching this regex.""")
+tf.app.flags.DEFINE_float('histogram_range', 2.5,
+                          """Weight histogram covers [-range, range].""")
+tf.app.flags.DEFINE_integer('histogram_bins', 200,
+                            """Number of weight histogram bins.""")
+
+
+class StreamingHistogram(object):
+  """Histogram over fixed bins, accumulated one array at a time."""
+
+  def __init__(self, value_range, num_bins):
+    self.edges = np.linspace(-value_range, value_range, num_bins + 1)
+    self.counts = np.zeros(num_bins, dtype=np.int64)
+    self.underflow = 0
+    self.overflow = 0
+
+  def add(self, values):
+    """Adds the values of an array of any shape to the histogram."""
+    values = values.ravel()
+    self.counts += np.histogram(values, bins=self.edges)[0]
+    self.underflow += int(np.count_nonzero(values < self.edges[0]))
+    self.overflow += int(np.count_nonzero(values > self.edges[-1]))
+
+  def as_dict(self):
+    return {'edges': self.edges.tolist(), 'counts': self.counts.tolist(),
+            'underflow': self.underflow, 'overflow': self.overflow}
+
+
+def tensor_sparsity(value, channel_axis=-1):
+  """Returns the sparsity statistics of one weight tensor.
+
+  Args:
+    value: NumPy array of the tensor.
+    channel_axis: integer axis of the channels, 2 for depthwise kernels.
+
+  Returns:
+    dict with the shape, size, zero count and fraction and L1/L2 norms of
+    the tensor. Tensors of rank 2 or more also get the zero fraction and L2
+    norm of every output channel and the indices of all-zero channels.
+  """
+  value = np.asarray(value, dtype=np.float64)
+  zeros = value.size - np.count_nonzero(value)
+  stats = {
+      'shape': list(value.shape),
+      'size': int(value.size),
+      'zeros': int(zeros),
+      'zero_fraction': float(zeros) / max(value.size, 1),
+      'l1_norm': float(np.abs(value).sum()),
+      'l2_norm': float(np.sqrt(np.square(value).sum())),
+  }
+  if value.ndim >= 2:
+    channels = np.moveaxis(value, channel_axis, -1)
+    channels = channels.reshape(-1, value.shape[channel_axis])
+    channel_zero_fraction = 1. - (np.count_nonzero(channels, axis=0) /
+                                  float(channels.shape[0]))
+    channel_norms = np.sqrt(np.square(channels).sum(axis=0))
+    stats['channel_zero_fraction'] = np.round(channel_zero_fraction,
+                                              4).tolist()
+    stats['channel_l2_norm'] = np.round(channel_norms, 6).tolist()
+    stats['zero_channels'] = np.flatnonzero(
+        channel_zero_fraction == 1.).tolist()
+  return stats
+
+
+def analyze_checkpoint(checkpoint, variable_regex='', skip_regex='',
+                       histogram_range=2.5, histogram_bins=200):
+  """Returns the sparsity report of a checkpoint.
+
+  Args:
+    checkpoint: string checkpoint prefix, or a directory holding one.
+    variable_regex: only analyze variables matching this regex.
+    skip_regex: skip variables matching this regex.
+    histogram_range: float, the histogram covers [-range, range].
+    histogram_bins: integer number of histogram bins.
+
+  Returns:
+    dict with a 'variables' entry of tensor_sparsity() per floating point
+    variable, the 'total' size, zeros and zero fraction, and the weight
+    'histogram'.
+  """
+  if tf.gfile.IsDirectory(checkpoint):
+    checkpoint = tf.train.latest_checkpoint(checkpoint)
+  reader = tf.train.NewCheckpointReader(checkpoint)
+  dtypes = reader.get_variable_to_dtype_map()
+  histogram = StreamingHistogram(histogram_range, histogram_bins)
+  variables = {}
+  total_size = 0
+  total_zeros = 0
+  for name in sorted(reader.get_variable_to_shape_map()):
+    if not dtypes[name].is_floating:
+      continue
+    if variable_regex and not re.search(variable_regex, name):
+      continue
+    if skip_regex and re.search(skip_regex, name):
+      continue
+    value = reader.get_tensor(name)
+    # The channels of a depthwise kernel are its input channels.
+    depthwise = 'depthwise_kernel' in name and value.ndim == 4
+    stats = tensor_sparsity(value, channel_axis=2 if depthwise else -1)
+    histogram.add(value)
+    variables[name] = stats
+    total_size += stats['size']
+    total_zeros += stats['zeros']
+  return {
+      'checkpoint': checkpoint,
+      'variables': variables,
+      'total': {'size': total_size, 'zeros': total_zeros,
+                'zero_fraction': float(total_zeros) / max(total_size, 1)},
+      'histogram': histogram.as_dict(),
+  }
+
+
+def print_report(report):
+  """Prints a one line summary per variable of a sparsity report."""
+  print(report['checkpoint'])
+  for name, stats in sorted(report['variables'].items()):
+    line = '  %-48s %10d  zeros %6.2f%%' % (name, stats['size'],
+                                            100. * stats['zero_fraction'])
+    if 'zero_channels' in stats:
+      line += '  zero channels %d/%d' % (len(stats['zero_channels']),
+                                         len(stats['channel_l2_norm']))
+    print(line)
+  total = report['total']
+  print('  total %d weights, %.2f%% zeros' %
+        (total['size'], 100. * total['zero_fraction']))
+
+
+def main(unused_argv=None):
+  for checkpoint in FLAGS.checkpoints.split(','):
+    report = analyze_checkpoint(checkpoint, FLAGS.variable_regex,
+                                FLAGS.skip_regex, FLAGS.histogram_range,
+                                FLAGS.histogram_bins)
+    print_report(report)
+    if FLAGS.report_dir:
+      tf.gfile.MakeDirs(FLAGS.report_dir)
+      path = os.path.join(FLAGS.report_dir, '%s.sparsity.json' %
+                          os.path.basename(report['checkpoint']))
+      with tf.gfile.GFile(path, 'w') as f:
+        json.dump(report, f)
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,277 @@
+"""Index of the records stored in a set of TFRecord shards.
+
+A TFRecord file is a sequence of records framed as
+
+  uint64 length
+  uint32 masked crc32c of length
+  byte   data[length]
+  uint32 masked crc32c of data
+
+so the byte offset of every record is found by reading the 12 byte headers.
+The index records, per shard, the number of records, the offset of each
+record and the histogram of class labels, and is persisted next to the data
+so epoch sizes and worker splits never need another scan.
+
+Methods:
+  scan_shard: Returns the record offsets and class histogram of one shard.
+  build_index: Scans a list of shards into a ShardIndex.
+  load_index: Loads a persisted ShardIndex if it matches the shards on disk.
+
+IndexedRecordReader uses an index to read any record by its global position
+without scanning, from memory-mapped shards.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+import tensorflow as tf
+
+INDEX_VERSION = 1
+
+# Length of the header preceding, and the crc following, each record.
+_HEADER_BYTES = 12
+_FOOTER_BYTES = 4
+
+
+def scan_shard(path, label_key='image/class/label'):
+  """Returns the record offsets and class histogram of one TFRecord shard.
+
+  Args:
+    path: string path of a TFRecord file.
+    label_key: Example feature holding the int64 class label, or None to skip
+      parsing the records.
+
+  Returns:
+    offsets: int64 array of the byte offset of each record header.
+    class_counts: collections.Counter of class label to number of records.
+
+  Raises:
+    ValueError: if the file ends in the middle of a record.
+  """
+  offsets = []
+  class_counts = collections.Counter()
+  with tf.gfile.GFile(path, 'rb') as f:
+    offset = 0
+    while True:
+      header = f.read(_HEADER_BYTES)
+      if not header:
+        break
+      if len(header) != _HEADER_BYTES:
+        raise ValueError('Truncated record header at %d in %s' %
+                         (offset, path))
+      length, = struct.unpack('<Q', header[:8])
+      data = f.read(length)
+      if len(data) != length or len(f.read(_FOOTER_BYTES)) != _FOOTER_BYTES:
+        raise ValueError('Truncated record at %d in %s' % (offset, path))
+      if label_key:
+        example = tf.train.Example.FromString(data)
+        label = example.features.feature[label_key].int64_list.value
+        class_counts[label[0] if label else -1] += 1
+      offsets.append(offset)
+      offset += _HEADER_BYTES + length + _FOOTER_BYTES
+  return np.array(offsets, dtype=np.int64), class_counts
+
+
+class ShardIndex(object):
+  """Record counts, offsets and class histograms of a list of shards."""
+
+  def __init__(self, shards, offsets):
+    """Initialize the index.
+
+    Args:
+      shards: list of dicts with the path, num_records, num_bytes, mtime,
+        first_record and class_counts of each shard, in reading order.
+      offsets: int64 array of the byte offset of every record within its
+        shard, concatenated in shard order.
+    """
+    self.shards = shards
+    self.offsets = offsets
+    self.first_records = np.array([s['first_record'] for s in shards] +
+                                  [len(offsets)], dtype=np.int64)
+
+  @property
+  def files(self):
+    """Returns the shard paths in reading order."""
+    return [s['path'] for s in self.shards]
+
+  @property
+  def num_records(self):
+    """Returns the total number of records of all shards."""
+    return len(self.offsets)
+
+  def class_counts(self):
+    """Returns a dict of class label to number of records in all shards."""
+    counts = collections.Counter()
+    for shard in self.shards:
+      counts.update({int(k): v for k, v in shard['class_counts'].items()})
+    return dict(counts)
+
+  def record_shards(self):
+    """Returns an int32 array of the shard position of every record."""
+    return np.repeat(np.arange(len(self.shards), dtype=np.int32),
+                     np.diff(self.first_records))
+
+  def shard_records(self, shard):
+    """Returns the offsets of the records of the shard at position shard."""
+    return self.offsets[self.first_records[shard]:
+                        self.first_records[shard + 1]]
+
+  def save(self, index_path):
+    """Writes the index as <index_path>.json and <index_path>.npy."""
+    with tf.gfile.GFile(index_path + '.json', 'w') as f:
+      json.dump({'version': INDEX_VERSION, 'shards': self.shards}, f)
+    with tf.gfile.GFile(index_path + '.npy', 'wb') as f:
+      np.save(f, self.offsets)
+
+
+def _shard_stat(path):
+  stat = tf.gfile.Stat(path)
+  return stat.length, stat.mtime_nsec
+
+
+def build_index(data_files, label_key='image/class/label'):
+  """Scans a list of TFRecord shards into a ShardIndex.
+
+  Args:
+    data_files: list of TFRecord paths, in reading order.
+    label_key: Example feature holding the int64 class label.
+
+  Returns:
+    ShardIndex of data_files.
+  """
+  shards = []
+  offsets = []
+  first_record = 0
+  for i, path in enumerate(data_files):
+    shard_offsets, class_counts = scan_shard(path, label_key)
+    num_bytes, mtime = _shard_stat(path)
+    shards.append({
+        'path': path,
+        'num_records': len(shard_offsets),
+        'num_bytes': num_bytes,
+        'mtime': mtime,
+        'first_record': first_record,
+        'class_counts': {str(k): v for k, v in class_counts.items()},
+    })
+    offsets.append(shard_offsets)
+    first_record += len(shard_offsets)
+    tf.logging.info('Indexed shard %d/%d: %s (%d records)', i + 1,
+                    len(data_files), path, len(shard_offsets))
+  offsets = (np.concatenate(offsets) if offsets
+             else np.zeros([0], dtype=np.int64))
+  return ShardIndex(shards, offsets)
+
+
+def load_index(index_path, data_files):
+  """Loads a persisted ShardIndex if it still matches the shards on disk.
+
+  Args:
+    index_path: path prefix the index was saved under.
+    data_files: list of TFRecord paths the index must describe, in order.
+
+  Returns:
+    ShardIndex, or None if there is no index or it is stale.
+  """
+  if not (tf.gfile.Exists(index_path + '.json') and
+          tf.gfile.Exists(index_path + '.npy')):
+    return None
+  with tf.gfile.GFile(index_path + '.json', 'r') as f:
+    index = json.load(f)
+  shards = index['shards']
+  if (index.get('version') != INDEX_VERSION or
+      [s['path'] for s in shards] != list(data_files)):
+    return None
+  for shard in shards:
+    if (shard['num_bytes'], shard['mtime']) != _shard_stat(shard['path']):
+      return None
+  with tf.gfile.GFile(index_path + '.npy', 'rb') as f:
+    offsets = np.load(f)
+  return ShardIndex(shards, offsets)
+
+
+def index_path_for(index_dir, name, subset):
+  """Returns the path prefix of the index of a dataset subset."""
+  return os.path.join(index_dir, '%s-%s-index' % (name, subset))
+
+
+class IndexedRecordReader(object):
+  """Reads the records of indexed TFRecord shards by global position.
+
+  Record i is the i-th record of the shards concatenated in index order.
+  Local shards are memory-mapped on first use, so a read is a table lookup
+  and a slice of the mapping; other file systems fall back to a seek and a
+  read through tf.gfile.
+  """
+
+  def __init__(self, index):
+    """Initialize the reader.
+
+    Args:
+      index: ShardIndex of the shards to read.
+    """
+    self._index = index
+    self._record_shards = index.record_shards()
+    self._files = {}
+
+  def __len__(self):
+    return self._index.num_records
+
+  def __getitem__(self, i):
+    """Returns the serialized record at global position i."""
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError('record %d out of range' % i)
+    shard = self._record_shards[i]
+    offset = int(self._index.offsets[i])
+    f = self._open(shard)
+    if isinstance(f, mmap.mmap):
+      length, = struct.unpack_from('<Q', f, offset)
+      start = offset + _HEADER_BYTES
+      return f[start:start + length]
+    f.seek(offset)
+    length, = struct.unpack('<Q', f.read(_HEADER_BYTES)[:8])
+    return f.read(length)
+
+  def _open(self, shard):
+    f = self._files.get(shard)
+    if f is None:
+      path = self._index.shards[shard]['path']
+      if os.path.exists(path):
+        with open(path, 'rb') as shard_file:
+          f = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+        f = tf.gfile.GFile(path, 'rb')
+      self._files[shard] = f
+    return f
+
+  def permutation(self, seed, epoch=0):
+    """Returns a uniformly shuffled order of all records.
+
+    The order depends only on (seed, epoch), so it can be regenerated to
+    resume an epoch at any position.
+    """
+    return np.random.RandomState([seed, epoch]).permutation(len(self))
+
+  def sample(self, num_records, seed=0):
+    """Returns the sorted positions of num_records records drawn at random."""
+    return np.sort(np.random.RandomState(seed).choice(
+        len(self), size=min(num_records, len(self)), replace=False))
+
+  def read(self, positions):
+    """Yields the serialized records at the given global positions."""
+    for i in positions:
+      yield self[i]
+
+  def close(self):
+    """Releases the memory mappings and open files."""
+    for f in self._files.values():
+      f.close()
+    self._files = {}
@@ -0,0 +1,347 @@
+"""Low overhead tracing of the input pipeline and training loop stages.
+
+With --trace, the stages of a training step are timed:
+
+  input pipeline  read, parse, decode, distort/eval and batch_join (the time
+                  the consumer waits on the batch queue), timed inside the
+                  graph with tf.timestamp around the stage's ops; with
+                  --use_tf_data the latency of every tf.data stage is also
+                  recorded with latency_stats;
+  queues          the fill level of the example and batch queues;
+  training loop   the data wait between batches, the train step, and every
+                  Keras callback hook, e.g. the channel mask updates of
+                  ChannelPruningCallback, see trace_callbacks(). The weight
+                  masks of tfmot's prune_low_magnitude layers are updated by
+                  ops inside the train step and count toward it; the hook
+                  of UpdatePruningStep only advances the pruning step.
+
+Every --trace_every_n_batches batches the spans recorded since the last
+flush are written as a Chrome trace (chrome://tracing or Perfetto) to
+<--trace_dir>/trace/, and the mean duration and time share of every stage
+and the queue fill levels are written as TensorBoard scalars to --trace_dir,
+by default the __logs/ directory of the notebook's TensorBoard callback.
+
+Without --trace, timed() and trace_callbacks() return their input
+unchanged, so nothing is added to the graph or the training loop.
+
+Usage:
+  callbacks = tracing.trace_callbacks([checkpoint, tensorboard, update_step])
+  model.fit_generator(..., callbacks=callbacks)
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_boolean('trace', False,
+                            """Time the input pipeline and training loop """
+                            """stages.""")
+tf.app.flags.DEFINE_string('trace_dir', '__logs',
+                           """TensorBoard directory of the stage metrics; """
+                           """Chrome traces go to its trace/ subdirectory.""")
+tf.app.flags.DEFINE_integer('trace_every_n_batches', 100,
+                            """Training batches between two flushes.""")
+tf.app.flags.DEFINE_integer('trace_max_events', 200000,
+                            """Spans kept between two flushes; older ones """
+                            """are dropped.""")
+
+# Graph collections of the queue sizes and tf.data statistics summaries
+# evaluated at every flush.
+QUEUES_COLLECTION = 'tracing_queues'
+SUMMARIES_COLLECTION = 'tracing_summaries'
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+class Tracer(object):
+  """Collects timed spans and counters and flushes them to disk."""
+
+  def __init__(self, trace_dir, max_events):
+    self._trace_dir = trace_dir
+    self._events = collections.deque(maxlen=max_events)
+    self._lock = threading.Lock()
+    # Stage name to [count, seconds] since the last flush.
+    self._stages = collections.defaultdict(lambda: [0, 0.])
+    self._last_flush = time.time()
+    self._flushes = 0
+    self._writer = None
+
+  def record(self, name, start, end):
+    """Records a span of a stage, in seconds since the epoch."""
+    self._events.append((name, start, end, threading.current_thread().ident))
+    with self._lock:
+      stage = self._stages[name]
+      stage[0] += 1
+      stage[1] += end - start
+
+  @contextlib.contextmanager
+  def span(self, name):
+    """Records the time spent in the body of a with statement."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.record(name, start, time.time())
+
+  def _chrome_events(self, counters, now):
+    pid = os.getpid()
+    events = []
+    while self._events:
+      name, start, end, tid = self._events.popleft()
+      events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': start * 1e6, 'dur': (end - start) * 1e6})
+    for name, value in sorted(counters.items()):
+      events.append({'name': name, 'ph': 'C', 'pid': pid, 'ts': now * 1e6,
+                     'args': {'value': value}})
+    return events
+
+  def flush(self, step, sess=None):
+    """Writes the spans and stage metrics recorded since the last flush.
+
+    Args:
+      step: integer global step of the TensorBoard scalars.
+      sess: optional tf.Session whose graph's watched queues and tf.data
+        statistics are evaluated.
+    """
+    now = time.time()
+    counters = {}
+    summaries = []
+    if sess is not None:
+      queues = sess.graph.get_collection(QUEUES_COLLECTION)
+      stats = sess.graph.get_collection(SUMMARIES_COLLECTION)
+      if queues or stats:
+        sizes, summaries = sess.run([[size for _, size, _ in queues], stats])
+        for (name, _, capacity), size in zip(queues, sizes):
+          counters['queue/%s/size' % name] = int(size)
+          counters['queue/%s/fraction_full' % name] = size / float(capacity)
+    with self._lock:
+      stages = dict(self._stages)
+      self._stages.clear()
+    seconds = max(now - self._last_flush, 1e-9)
+    for name, (count, total) in stages.items():
+      counters['trace/%s/mean_ms' % name] = 1000. * total / count
+      # Summed over threads, so parallel stages can exceed 1.
+      counters['trace/%s/time_share' % name] = total / seconds
+
+    trace_dir = os.path.join(self._trace_dir, 'trace')
+    tf.gfile.MakeDirs(trace_dir)
+    path = os.path.join(trace_dir, 'trace-%d-%05d.json' % (os.getpid(),
+                                                            self._flushes))
+    with tf.gfile.GFile(path, 'w') as f:
+      json.dump({'traceEvents': self._chrome_events(counters, now),
+                 'displayTimeUnit': 'ms'}, f)
+
+    if self._writer is None:
+      self._writer = tf.summary.FileWriterCache.get(self._trace_dir)
+    self._writer.add_summary(tf.Summary(value=[
+        tf.Summary.Value(tag=name, simple_value=value)
+        for name, value in sorted(counters.items())]), step)
+    for summary in summaries:
+      self._writer.add_summary(summary, step)
+    self._writer.flush()
+    self._last_flush = now
+    self._flushes += 1
+
+
+def get_tracer():
+  """Returns the tracer of this process."""
+  global _tracer
+  with _tracer_lock:
+    if _tracer is None:
+      _tracer = Tracer(FLAGS.trace_dir, FLAGS.trace_max_events)
+    return _tracer
+
+
+def _tensors(structure):
+  return [t for t in tf.nest.flatten(structure) if isinstance(t, tf.Tensor)]
+
+
+def timed(name, fn, inputs=None):
+  """Builds the ops of fn() and records how long they take every run.
+
+  The span starts once inputs are computed, or when the run starts if
+  inputs is None, and ends once all output tensors are computed. Do not
+  pass the inputs of a queue's enqueue side when timing its dequeue, or
+  every dequeue would recompute them.
+
+  Args:
+    name: string stage name.
+    fn: function building the stage ops and returning a structure of
+      tensors.
+    inputs: optional structure of tensors the stage consumes.
+
+  Returns:
+    the outputs of fn(); with --trace, identities of them depending on the
+    recorded span.
+  """
+  if not FLAGS.trace:
+    return fn()
+  with tf.control_dependencies(_tensors(inputs)):
+    start = tf.timestamp()
+  with tf.control_dependencies([start]):
+    outputs = fn()
+  with tf.control_dependencies(_tensors(outputs)):
+    end = tf.timestamp()
+
+  def _record(start, end):
+    get_tracer().record(name, float(start), float(end))
+    return np.float64(end - start)
+
+  recorded = tf.py_func(_record, [start, end], tf.float64, stateful=True,
+                        name='trace_%s' % name)
+  with tf.control_dependencies([recorded]):
+    return tf.nest.map_structure(
+        lambda t: tf.identity(t) if isinstance(t, tf.Tensor) else t, outputs)
+
+
+def watch_queue(name, queue, capacity):
+  """Reports the fill level of a queue at every flush."""
+  if FLAGS.trace:
+    tf.add_to_collection(QUEUES_COLLECTION, (name, queue.size(), capacity))
+
+
+def latency_stats(dataset, name):
+  """Records the latency of every element of a tf.data stage."""
+  if not FLAGS.trace:
+    return dataset
+  return dataset.apply(tf.data.experimental.latency_stats(name))
+
+
+def with_stats_aggregator(dataset):
+  """Makes the latency_stats of a dataset reported at every flush."""
+  if not FLAGS.trace:
+    return dataset
+  aggregator = tf.data.experimental.StatsAggregator()
+  options = tf.data.Options()
+  options.experimental_stats.aggregator = aggregator
+  tf.add_to_collection(SUMMARIES_COLLECTION, aggregator.get_summary())
+  return dataset.with_options(options)
+
+
+class _StageCallback(tf.keras.callbacks.Callback):
+  """First or last callback of a traced list, see trace_callbacks()."""
+
+  def __init__(self, timer, first):
+    super(_StageCallback, self).__init__()
+    self._timer = timer
+    self._first = first
+
+  def on_train_batch_begin(self, batch, logs=None):
+    self._timer.batch_begin(self._first)
+
+  def on_train_batch_end(self, batch, logs=None):
+    self._timer.batch_end(self._first)
+
+  def on_epoch_end(self, epoch, logs=None):
+    if not self._first:
+      # Validation and checkpointing are not data waits.
+      self._timer.last_end = None
+
+  def on_train_end(self, logs=None):
+    if not self._first:
+      self._timer.tracer.flush(self._timer.step,
+                               tf.keras.backend.get_session())
+
+
+class _StageTimer(object):
+  """Times the data wait and the train step of the Keras training loop.
+
+  Keras calls the batch hooks of all callbacks in list order, so the data
+  wait runs from the last callback's batch end to the first callback's
+  batch begin, and the train step from the last callback's batch begin to
+  the first callback's batch end.
+  """
+
+  def __init__(self, tracer, every_n_batches):
+    self.tracer = tracer
+    self.every_n_batches = every_n_batches
+    self.step = 0
+    self.last_end = None
+    self.step_start = None
+    self.first = _StageCallback(self, first=True)
+    self.last = _StageCallback(self, first=False)
+
+  def batch_begin(self, first):
+    now = time.time()
+    if not first:
+      self.step_start = now
+    elif self.last_end is not None:
+      self.tracer.record('data_wait', self.last_end, now)
+
+  def batch_end(self, first):
+    now = time.time()
+    if first:
+      if self.step_start is not None:
+        self.tracer.record('train_step', self.step_start, now)
+      return
+    self.last_end = now
+    self.step += 1
+    if self.step % self.every_n_batches == 0:
+      self.tracer.flush(self.step, tf.keras.backend.get_session())
+
+
+_CALLBACK_HOOKS = [
+    'on_epoch_begin', 'on_epoch_end', 'on_train_begin', 'on_train_end',
+    'on_train_batch_begin', 'on_train_batch_end', 'on_test_begin',
+    'on_test_end', 'on_test_batch_begin', 'on_test_batch_end',
+    'on_predict_begin', 'on_predict_end', 'on_predict_batch_begin',
+    'on_predict_batch_end']
+
+
+class _TimedCallback(tf.keras.callbacks.Callback):
+  """Records a span for every hook of a wrapped callback."""
+
+  def __init__(self, callback, tracer):
+    super(_TimedCallback, self).__init__()
+    self.callback = callback
+    self._tracer = tracer
+    self._name = 'callback/%s' % type(callback).__name__
+
+  def set_model(self, model):
+    super(_TimedCallback, self).set_model(model)
+    self.callback.set_model(model)
+
+  def set_params(self, params):
+    super(_TimedCallback, self).set_params(params)
+    self.callback.set_params(params)
+
+
+def _timed_hook(hook):
+  def _hook(self, *args, **kwargs):
+    with self._tracer.span('%s/%s' % (self._name, hook)):
+      return getattr(self.callback, hook)(*args, **kwargs)
+  _hook.__name__ = hook
+  return _hook
+
+
+for _hook_name in _CALLBACK_HOOKS:
+  setattr(_TimedCallback, _hook_name, _timed_hook(_hook_name))
+
+
+def trace_callbacks(callbacks):
+  """Returns Keras callbacks that time the training loop, with --trace.
+
+  The callbacks are wrapped so that each of their hooks is timed, and
+  surrounded by callbacks timing the data wait and the train step and
+  flushing every --trace_every_n_batches batches. Without --trace, or if
+  the callbacks are already traced, they are returned unchanged.
+  """
+  callbacks = list(callbacks or [])
+  if not FLAGS.trace or any(isinstance(c, _StageCallback) for c in callbacks):
+    return callbacks
+  tracer = get_tracer()
+  timer = _StageTimer(tracer, FLAGS.trace_every_n_batches)
+  return ([timer.first] + [_TimedCallback(c, tracer) for c in callbacks] +
+          [timer.last])